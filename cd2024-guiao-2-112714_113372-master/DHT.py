@@ -2,26 +2,35 @@ import logging
 import time
 import sys
 import argparse
-from DHTNode import DHTNode
+import asyncio
+from DHTNode import DHTHost
+import DHTAsyncNode
+import utils
 
 
-def main(number_nodes, timeout):
+def main(number_nodes, timeout, replicas=1, consistency="one", vnodes=1, capacities=(1.0,), data_dir=None,
+         batch_window=0.005):
     """ Script to launch several DHT nodes. """
 
     # logger for the main
     logger = logging.getLogger("DHT")
     # list with all the nodes
     dht = []
-    # initial node on DHT
-    node = DHTNode(("localhost", 5000))
+    # initial node on DHT; with virtual nodes each host takes a block of consecutive ports
+    port = 5000
+    node = DHTHost(("localhost", port), vnodes=vnodes, capacity=capacities[0], replicas=replicas,
+                   consistency=consistency, data_dir=data_dir, batch_window=batch_window)
     node.start()
     dht.append(node)
     logger.info(node)
 
     for i in range(number_nodes - 1):
         time.sleep(0.2)
+        port += len(node.vnodes)
         # Create DHT_Node threads on ports 5001++ and with initial DHT_Node on port 5000
-        node = DHTNode(("localhost", 5001 + i), ("localhost", 5000), timeout)
+        node = DHTHost(("localhost", port), ("localhost", 5000), vnodes=vnodes,
+                       capacity=capacities[(i + 1) % len(capacities)], timeout=timeout, replicas=replicas,
+                       consistency=consistency, data_dir=data_dir, batch_window=batch_window)
         node.start()
         dht.append(node)
         logger.info(node)
@@ -39,8 +48,22 @@ if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
     parser.add_argument("--savelog", default=False, action="store_true")
+    parser.add_argument("--log-level", default="INFO", choices=["DEBUG", "INFO", "WARNING", "ERROR"])
     parser.add_argument("--nodes", type=int, default=5)
     parser.add_argument("--timeout", type=int, default=3)
+    parser.add_argument("--replicas", type=int, default=1, help="copies of each key (owner + successors)")
+    parser.add_argument("--consistency", choices=["one", "quorum"], default="one")
+    parser.add_argument("--vnodes", type=int, default=1, help="virtual nodes per unit of capacity")
+    parser.add_argument("--asyncio", default=False, action="store_true",
+                        help="run all the nodes on one asyncio event loop instead of a thread each")
+    parser.add_argument("--bits", type=int, default=10, help="ring ids have this many bits (up to 64 with fnv)")
+    parser.add_argument("--hash", choices=["fnv", "blake2b"], default="fnv")
+    parser.add_argument("--placement", choices=["hash", "order"], default="hash",
+                        help="spread keys by hash, or keep them in key order for range scans")
+    parser.add_argument("--capacity", type=str, default="1", help="comma separated capacities, cycled over the nodes")
+    parser.add_argument("--data-dir", default=None, help="keep the keys on disk, one directory per node (default in memory)")
+    parser.add_argument("--batch-window", type=float, default=0.005,
+                        help="seconds forwarded PUT/GETs may wait to be batched per next hop (0 disables batching)")
     args = parser.parse_args()
 
     logfile = {}
@@ -48,11 +71,19 @@ if __name__ == "__main__":
         logfile = {"filename":"dht.txt", "filemode": "w"}
 
     logging.basicConfig(
-            level=logging.DEBUG,
+            level=getattr(logging, args.log_level),
             format="%(asctime)s %(name)-12s %(levelname)-8s %(message)s",
             datefmt="%m-%d %H:%M:%S",
             **logfile
         )
 
 
-    main(args.nodes, timeout=args.timeout)
+    utils.configure(args.bits, args.hash, args.placement)
+    capacities = [float(c) for c in args.capacity.split(",")]
+    if args.asyncio:
+        asyncio.run(DHTAsyncNode.main(args.nodes, args.timeout, vnodes=args.vnodes, capacities=capacities,
+                                      replicas=args.replicas, consistency=args.consistency, data_dir=args.data_dir,
+                                      batch_window=args.batch_window))
+    else:
+        main(args.nodes, timeout=args.timeout, replicas=args.replicas, consistency=args.consistency,
+             vnodes=args.vnodes, capacities=capacities, data_dir=args.data_dir, batch_window=args.batch_window)
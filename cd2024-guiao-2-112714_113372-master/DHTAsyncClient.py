@@ -0,0 +1,241 @@
+""" Pipelined asyncio DHT client. """
+import asyncio
+import itertools
+import logging
+import socket
+from DHTClient import IterativeLookup, RoutingCache
+from codec import Codec, CodecError, MAX_MESSAGE
+from utils import key_id
+
+
+class _ClientProtocol(asyncio.DatagramProtocol):
+    """ Hands every datagram received to the client."""
+
+    def __init__(self, client):
+        self.client = client
+
+    def datagram_received(self, data, addr):
+        self.client.reply_received(data, addr)
+
+    def error_received(self, exc):
+        self.client.logger.warning("Socket error: %s", exc)
+
+
+class AsyncDHTClient:
+    """ DHT client keeping many requests in flight over a single UDP socket.
+
+    Every request is tagged with a msg_id, which DHTNode echoes in its reply, so
+    replies are matched to requests regardless of arrival order. Lost requests
+    or replies are resent after `timeout` seconds, up to `retries` times.
+
+    Usage:
+        client = await AsyncDHTClient.connect(("localhost", 5000))
+        await asyncio.gather(*(client.put(k, v) for k, v in items))
+        value = await client.get("A")
+        client.close()
+    """
+
+    def __init__(self, address, timeout=1.0, retries=3, max_message=MAX_MESSAGE, lookup="recursive", alpha=3,
+                 lookup_timeout=0.5):
+        """ Initialize client (use AsyncDHTClient.connect to also open the socket).
+
+        lookup, alpha and lookup_timeout select the routing of requests, see DHTClient.
+        """
+        self.dht_addr = address
+        self.timeout = timeout
+        self.lookup = lookup
+        self.alpha = alpha
+        self.lookup_timeout = lookup_timeout
+        self.retries = retries
+        self.transport = None
+        self.msg_ids = itertools.count(1)
+        self.pending = {}  # msg_id -> (future, datagrams, address, retries left, timer)
+        self.routes = RoutingCache()
+        self.codec = Codec(max_message=max_message)
+        self.logger = logging.getLogger("AsyncDHTClient")
+
+    @classmethod
+    async def connect(cls, address, **kwargs):
+        """ Create a client and its UDP endpoint."""
+        client = cls(address, **kwargs)
+        loop = asyncio.get_running_loop()
+        client.transport, _ = await loop.create_datagram_endpoint(
+            lambda: _ClientProtocol(client), family=socket.AF_INET
+        )
+        return client
+
+    def close(self):
+        """ Fail every outstanding request and close the socket."""
+        for msg_id in list(self.pending):
+            future, _, _, _, timer = self.pending.pop(msg_id)
+            timer.cancel()
+            if not future.done():
+                future.cancel()
+        if self.transport is not None:
+            self.transport.close()
+
+    def request(self, msg, address=None, timeout=None, retries=None):
+        """ Send msg and return a future resolved with the reply message."""
+        loop = asyncio.get_running_loop()
+        msg_id = next(self.msg_ids)
+        msg["args"] = dict(msg.get("args", {}), msg_id=msg_id)
+        payload = self.codec.frames(msg)
+        address = address or self.dht_addr
+        future = loop.create_future()
+        retries = self.retries if retries is None else retries
+        timeout = self.timeout if timeout is None else timeout
+        self._sendto(payload, address)
+        timer = loop.call_later(timeout, self._expired, msg_id, timeout)
+        self.pending[msg_id] = (future, payload, address, retries, timer)
+        return future
+
+    def _expired(self, msg_id, timeout):
+        """ Resend a request whose reply did not arrive in time, or fail it."""
+        if msg_id not in self.pending:
+            return
+        future, payload, address, retries, _ = self.pending[msg_id]
+        if future.done():
+            del self.pending[msg_id]
+        elif retries <= 0:
+            del self.pending[msg_id]
+            future.set_exception(asyncio.TimeoutError("no reply to request {}".format(msg_id)))
+        else:
+            self.logger.debug("Resending request %d", msg_id)
+            self._sendto(payload, address)
+            timer = asyncio.get_running_loop().call_later(timeout, self._expired, msg_id, timeout)
+            self.pending[msg_id] = (future, payload, address, retries - 1, timer)
+
+    def _sendto(self, datagrams, address):
+        for datagram in datagrams:
+            self.transport.sendto(datagram, address)
+
+    def reply_received(self, data, addr):
+        """ Resolve the future of the request the reply belongs to."""
+        try:
+            out = self.codec.feed(data, addr)
+        except CodecError as e:
+            self.logger.warning("Dropping datagram from %s: %s", addr, e)
+            return
+        if out is None:  # more chunks to come
+            return
+        entry = self.pending.pop(out.get("msg_id"), None)
+        if entry is None:
+            # Duplicate reply to a resent request, or a request that already gave up
+            self.logger.debug("Ignoring msg: %s", out)
+            return
+        future, _, _, _, timer = entry
+        timer.cancel()
+        if not future.done():
+            future.set_result(out)
+
+    async def routed_request(self, key, msg, read=False, lookup=None):
+        """ Send msg about key straight to its cached owner, falling back to dht_addr.
+
+        A REDIRECT reply (or a timeout) drops the stale cached range and routes
+        the request through the ring from dht_addr, or sends it to the owner
+        found by an iterative lookup (lookup="iterative", default self.lookup).
+        Reads (read=True) may be sent to one of the owner's replicas.
+        """
+        addr = self.routes.lookup(key_id(key), read)
+        if addr is not None:
+            try:
+                out = await self.request(dict(msg, args=dict(msg["args"], direct=True)), addr)
+            except asyncio.TimeoutError:
+                out = None
+            if out is not None and out["method"] != "REDIRECT":
+                self.routes.learn(out.get("node"))
+                return out
+            self.logger.debug("Stale route for %s: %s", key, addr)
+            self.routes.forget(addr)
+            if out is not None:
+                self.routes.learn(out.get("node"))
+        if (lookup or self.lookup) == "iterative":
+            out = await self.iterative_request(key, msg)
+            if out is not None:
+                return out
+        out = await self.request(msg)
+        self.routes.learn(out.get("node"))
+        return out
+
+    async def find_owner(self, key_hash, alpha=None, start=None):
+        """ Iterative lookup of key_hash from start (default dht_addr); returns (owner address, hops) or None."""
+        lookup = IterativeLookup(key_hash, start or self.dht_addr, alpha or self.alpha)
+        queries = {}  # future -> addr
+        try:
+            while not lookup.done:
+                for addr in lookup.next():
+                    msg = {"method": "LOOKUP", "args": {"id": key_hash, "count": lookup.alpha}}
+                    queries[self.request(msg, addr, self.lookup_timeout, retries=0)] = addr
+                if not queries:
+                    break
+                done, _ = await asyncio.wait(queries, return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    addr = queries.pop(future)
+                    try:
+                        out = future.result()
+                    except asyncio.TimeoutError:
+                        lookup.failed(addr)
+                        continue
+                    self.routes.learn(out.get("node"))
+                    lookup.answered(addr, out["args"])
+        finally:
+            for future in queries:
+                future.cancel()
+        return lookup.owner
+
+    async def iterative_request(self, key, msg, start=None):
+        """ Send msg about key to the owner found by an iterative lookup from start; None if none answered for it."""
+        owner = await self.find_owner(key_id(key), start=start)
+        if owner is None:
+            return None
+        addr, hops = owner
+        try:
+            out = await self.request(dict(msg, args=dict(msg["args"], direct=True, hops=hops)), addr)
+        except asyncio.TimeoutError:
+            return None
+        if out["method"] == "REDIRECT":
+            self.logger.debug("Owner of %s moved: %s", key, addr)
+            return None
+        self.routes.learn(out.get("node"))
+        return out
+
+    async def put(self, key, value, lookup=None, ttl=None):
+        """ Store value to key in the DHT (lookup: "recursive" or "iterative", default self.lookup).
+
+        With ttl, the key expires ttl seconds later.
+        """
+        args = {"key": key, "value": value}
+        if ttl is not None:
+            args["ttl"] = ttl
+        out = await self.routed_request(key, {"method": "PUT", "args": args}, lookup=lookup)
+        if out["method"] != "ACK":
+            self.logger.error("Invalid msg: %s", out)
+            return False
+        return True
+
+    async def get(self, key, lookup=None):
+        """ Retrieve key from DHT (lookup: "recursive" or "iterative", default self.lookup); None if it is not stored."""
+        out = await self.routed_request(key, {"method": "GET", "args": {"key": key}}, read=True, lookup=lookup)
+        if out["method"] == "NOT_FOUND":
+            return None
+        if out["method"] != "ACK":
+            self.logger.error("Invalid msg: %s", out)
+            return None
+        return out["args"]
+
+
+async def main():
+    client = await AsyncDHTClient.connect(("localhost", 5000))
+    keys = ["key-{}".format(i) for i in range(1000)]
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    await asyncio.gather(*(client.put(key, key) for key in keys))
+    values = await asyncio.gather(*(client.get(key) for key in keys))
+    elapsed = loop.time() - start
+    assert values == keys
+    print("{} ops in {:.2f}s ({:.0f} ops/s)".format(2 * len(keys), elapsed, 2 * len(keys) / elapsed))
+    client.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
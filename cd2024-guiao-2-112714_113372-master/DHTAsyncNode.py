@@ -0,0 +1,166 @@
+""" Chord DHT node on an asyncio event loop. """
+import asyncio
+import logging
+import socket
+import time
+from DHTNode import ChordNode, vnode_count, vnode_ids
+from storage import open_storage
+
+
+class _NodeProtocol(asyncio.DatagramProtocol):
+    """ Hands every datagram received to the node."""
+
+    def __init__(self, node):
+        self.node = node
+
+    def datagram_received(self, data, addr):
+        self.node.datagram_received(data, addr)
+
+    def error_received(self, exc):
+        self.node.logger.debug("Socket error: %s", exc)
+
+
+class AsyncDHTNode(ChordNode):
+    """ DHT node sharing an event loop with many others, without a thread each.
+
+    Messages go through the same dispatch table as DHTNode, and stabilize
+    rounds (and key handoff) run from a loop timer re-armed after every
+    message, so hundreds of nodes can run in one process.
+
+    Usage:
+        node = AsyncDHTNode(("localhost", 5000))
+        await node.start()
+        ...
+        node.stop()
+    """
+
+    def __init__(self, address, dht_address=None, timeout=3, **kwargs):
+        """Constructor, see ChordNode for the parameters."""
+        ChordNode.__init__(self, address, dht_address, timeout, **kwargs)
+        self.transport = None
+        self.timer = None
+        self.timer_at = None
+        self.flush_pending = False
+        self.stopped = None  # future resolved once the node stopped (or left the DHT)
+
+    async def start(self):
+        """ Bind the node's socket and join the DHT (in the background)."""
+        loop = asyncio.get_running_loop()
+        self.stopped = loop.create_future()
+        self.transport, _ = await loop.create_datagram_endpoint(
+            lambda: _NodeProtocol(self), local_addr=self.addr, family=socket.AF_INET
+        )
+        if self.inside_dht:
+            self.schedule()
+        else:
+            self.request_join()
+
+    def request_join(self):
+        """ Send JOIN_REQ every timeout seconds until JOIN_REP arrives."""
+        if self.inside_dht or self.done:
+            return
+        self.send(self.dht_address, self.join_request())
+        self.timer = asyncio.get_running_loop().call_later(self.timeout, self.request_join)
+
+    def sendto(self, payload, address):
+        if self.transport is not None:
+            self.transport.sendto(payload, address)
+
+    def datagram_received(self, data, addr):
+        output = self.decode(data, addr)
+        if output is None or self.done:
+            return
+        if not self.inside_dht:
+            self.logger.debug("O: %s", output)
+            if output["method"] == "JOIN_REP" and self.on_join_rep(output):
+                self.timer.cancel()
+                self.timer = None
+                self.schedule()
+            return
+        self.dispatch(output, addr)
+        if self.outbox and not self.flush_pending:
+            # send the forwarded requests waiting to be batched once the datagrams already received are handled
+            self.flush_pending = True
+            asyncio.get_running_loop().call_soon(self.flush_idle)
+        self.run_tick()
+
+    def flush_idle(self):
+        self.flush_pending = False
+        if not self.done:
+            self.flush_batches()
+
+    def run_tick(self):
+        self.tick()
+        if self.done:
+            self.stop()
+        else:
+            self.schedule()
+
+    def on_timer(self):
+        self.timer = None
+        self.run_tick()
+
+    def schedule(self):
+        """ (Re)arm the timer if the node needs to wake up sooner than it is armed for."""
+        at = self.wakeup()
+        if self.timer is not None and self.timer_at <= at:
+            return
+        if self.timer is not None:
+            self.timer.cancel()
+        loop = asyncio.get_running_loop()
+        self.timer_at = at
+        self.timer = loop.call_later(max(at - time.monotonic(), 0), self.on_timer)
+
+    def leave(self):
+        """ Leave the DHT gracefully (see ChordNode.leave), starting right away."""
+        ChordNode.leave(self)
+        self.run_tick()
+
+    def stop(self):
+        """ Stop the node and close its socket (see leave() to leave the DHT gracefully first)."""
+        self.done = True
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+            self.keystore.close()
+        if self.stopped is not None and not self.stopped.done():
+            self.stopped.set_result(None)
+
+
+async def start_ring(host, ports, timeout=3, delay=0.01, data_dir=None, identifications=None, **kwargs):
+    """ Start one AsyncDHTNode per port, the first one creating the DHT and the others joining it.
+
+    With data_dir, every node keeps its keys on disk (see storage.open_storage).
+    identifications gives the ring position of the node on each port (default the hash of its address).
+    """
+    nodes = []
+    for i, port in enumerate(ports):
+        identification = None if identifications is None else identifications[i]
+        node = AsyncDHTNode((host, port), (host, ports[0]) if nodes else None, timeout, identification=identification,
+                            storage=open_storage(data_dir, (host, port)), **kwargs)
+        await node.start()
+        nodes.append(node)
+        await asyncio.sleep(delay)
+    return nodes
+
+
+async def main(number_nodes, timeout, vnodes=1, capacities=(1.0,), **kwargs):
+    """ Run number_nodes nodes on ports 5000++ until they all stop (used by DHT.py --asyncio).
+
+    Like DHT.py's DHTHost, every node owns vnodes ring positions per unit of its capacity (capacities are
+    cycled over the nodes), one AsyncDHTNode each on consecutive ports.
+    """
+    ports, identifications = [], []
+    port = 5000
+    for i in range(number_nodes):
+        ids = vnode_ids(("localhost", port), vnode_count(vnodes, capacities[i % len(capacities)]))
+        ports.extend(range(port, port + len(ids)))
+        identifications.extend(ids)
+        port += len(ids)
+    nodes = await start_ring("localhost", ports, timeout, identifications=identifications, **kwargs)
+    logging.getLogger("DHT").info("%d nodes running", len(nodes))
+    await asyncio.gather(*(node.stopped for node in nodes))
+
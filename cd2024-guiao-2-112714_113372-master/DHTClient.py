@@ -1,39 +1,540 @@
 import socket
-import pickle
 import logging
+import itertools
+import random
+import time
+from collections import deque
+from bisect import bisect_left, insort
+from utils import key_id, key_ids, contains, placement, ring_bits
+from codec import Codec, CodecError, HEADER, MAX_DATAGRAM, MAX_MESSAGE
+from stream import Streams
+
+
+class RingView:
+    """ Client side view of the ring: sorted node ids and their addresses."""
+
+    def __init__(self, nodes):
+        """ Build the view from a list of (id, addr)."""
+        nodes = sorted(set(nodes))
+        self.ids = [node_id for node_id, _ in nodes]
+        self.addrs = [addr for _, addr in nodes]
+
+    def owner(self, key_hash):
+        """ Address of the node responsible for key_hash (its successor in the ring)."""
+        idx = bisect_left(self.ids, key_hash)
+        if idx == len(self.ids):
+            idx = 0
+        return self.addrs[idx]
+
+    def owners(self, first, last):
+        """ Addresses of the nodes responsible for the ids in [first, last] (first <= last), in ring order."""
+        idx = bisect_left(self.ids, first)
+        count = min(bisect_left(self.ids, last) - idx + 1, len(self.ids))
+        return [self.addrs[(idx + i) % len(self.ids)] for i in range(count)]
+
+    def __len__(self):
+        return len(self.ids)
+
+
+class RoutingCache:
+    """ Key range -> node mappings learned from reply metadata.
+
+    Each node reply carries the range it owns, (predecessor_id, id]; requests
+    for keys in a known range are sent straight to the owner. When the DHT
+    keeps replicas, reads are spread over the owner and its replicas.
+    """
+
+    def __init__(self):
+        self.ids = []  # sorted node ids
+        self.nodes = {}  # node id -> (predecessor_id, addr)
+        self.replicas = {}  # node id -> addresses holding replicas of its range
+
+    def learn(self, node):
+        """ Record the range owned by node (dict with id, addr and predecessor_id)."""
+        if node is None or node.get("predecessor_id") is None:
+            return
+        node_id, pred_id = node["id"], node["predecessor_id"]
+        # Nodes we knew inside (pred_id, node_id) have left or moved: the range is node's now
+        for other in [i for i in self.ids if i != node_id and contains(pred_id, node_id, i)]:
+            self.ids.remove(other)
+            del self.nodes[other]
+            self.replicas.pop(other, None)
+        if node_id not in self.nodes:
+            insort(self.ids, node_id)
+        self.nodes[node_id] = (pred_id, tuple(node["addr"]))
+        self.replicas[node_id] = [tuple(addr) for addr in node.get("replicas", [])]
+
+    def lookup(self, key_hash, read=False):
+        """ Address of the cached owner of key_hash, or None if its range is unknown.
+
+        With read=True any of the owner's replicas may be returned instead.
+        """
+        if not self.ids:
+            return None
+        idx = bisect_left(self.ids, key_hash)
+        node_id = self.ids[idx % len(self.ids)]
+        pred_id, addr = self.nodes[node_id]
+        if contains(pred_id, node_id, key_hash):
+            if read and self.replicas.get(node_id):
+                return random.choice([addr] + self.replicas[node_id])
+            return addr
+        return None
+
+    def forget(self, addr):
+        """ Drop every range mapped to addr."""
+        for node_id in [i for i in self.ids if self.nodes[i][1] == tuple(addr)]:
+            self.ids.remove(node_id)
+            del self.nodes[node_id]
+            self.replicas.pop(node_id, None)
+
+    def __len__(self):
+        return len(self.ids)
+
+
+class IterativeLookup:
+    """ State of an iterative lookup: the client finds the owner of key_hash itself.
+
+    Instead of forwarding the request hop by hop (recursive routing, where
+    one slow node on the path stalls it), the client asks nodes where the
+    key is. A node answers with the owner if it is itself or its successor,
+    else with its fingers closest to the key. Like in Kademlia, up to `alpha`
+    of the nodes closest to the key (clockwise distance to it) that were not
+    asked yet are queried in parallel, so a slow or failed node only delays
+    the lookup until another one answers.
+    """
+
+    def __init__(self, key_hash, start, alpha=3):
+        """ Look up key_hash starting at the node at address start."""
+        self.key_hash = key_hash
+        self.alpha = alpha
+        self.size = 2 ** ring_bits()
+        self.candidates = {tuple(start): (self.size, 0)}  # addr -> (distance to the key, answers it took to learn it)
+        self.queried = set()
+        self.inflight = set()
+        self.owner = None  # (addr, hops) once found
+
+    def next(self):
+        """ Addresses to query now, keeping at most alpha queries in flight."""
+        free = self.alpha - len(self.inflight)
+        if self.owner is not None or free <= 0:
+            return []
+        waiting = sorted((distance, addr) for addr, (distance, _) in self.candidates.items() if addr not in self.queried)
+        addrs = [addr for _, addr in waiting[:free]]
+        self.queried.update(addrs)
+        self.inflight.update(addrs)
+        return addrs
+
+    def answered(self, addr, args):
+        """ Process the LOOKUP_REP args of the node at addr."""
+        self.inflight.discard(addr)
+        hops = self.candidates[addr][1] + 1
+        if args.get("owner") is not None:
+            owner = tuple(args["owner"][1])
+            self.owner = (owner, hops - 1 if owner == addr else hops)
+            return
+        for node_id, node_addr in args.get("nodes", []):
+            node_addr = tuple(node_addr)
+            distance = (self.key_hash - node_id) % self.size
+            if node_addr not in self.candidates or distance < self.candidates[node_addr][0]:
+                self.candidates[node_addr] = (distance, hops)
+
+    def failed(self, addr):
+        """ The node at addr did not answer in time."""
+        self.inflight.discard(addr)
+
+    @property
+    def done(self):
+        """ Owner found, or nobody left to ask."""
+        return self.owner is not None or not self.inflight and len(self.queried) == len(self.candidates)
 
 
 class DHTClient:
-    def __init__(self, address):
-        """ Initialize client."""
+    def __init__(self, address, timeout=1.0, retries=3, max_message=MAX_MESSAGE, stream_threshold=None,
+                 lookup="recursive", alpha=3, lookup_timeout=0.5):
+        """ Initialize client.
+
+        Parameters:
+            address: address of a node in the DHT
+            timeout: seconds to wait for a reply before resending the request (None waits forever, a lost
+                datagram then blocks the caller)
+            retries: number of times a batch is resent after a timeout
+            max_message: largest message (in bytes) sent or accepted
+            stream_threshold: messages larger than this (in bytes, encoded) are sent over a TCP connection
+                to the node (default: the ones not fitting in one datagram)
+            lookup: default routing of requests whose owner is not cached: "recursive" (forwarded by the
+                nodes) or "iterative" (the client finds the owner, see IterativeLookup)
+            alpha: parallel queries of an iterative lookup
+            lookup_timeout: seconds to wait for a node answering an iterative lookup before asking others
+        """
         self.dht_addr = address
+        self.timeout = timeout
+        self.lookup = lookup
+        self.alpha = alpha
+        self.lookup_timeout = lookup_timeout
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.settimeout(timeout)
+        self.socket.bind(("", 0))
+        self.retries = retries
         self.logger = logging.getLogger("DHTClient")
+        self.msg_ids = itertools.count(1)
+        self.ring = None
+        self.routes = RoutingCache()
+        self.codec = Codec(max_message=max_message)
+        self.streams = Streams(self.socket.getsockname()[1], max_message, logger=self.logger,
+                               fallback=self.send_datagrams)
+        self.streams.watch(self.socket)
+        try:
+            # large replies from the nodes we did not open a connection to
+            self.streams.listen(("", self.socket.getsockname()[1]))
+        except OSError as e:
+            self.logger.warning("Large replies will come as datagrams, cannot listen for connections: %s", e)
+        self.stream_threshold = MAX_DATAGRAM - HEADER.size if stream_threshold is None else stream_threshold
+        self.inbox = deque()  # messages received over TCP, not returned by recv yet
 
-    def put(self, key, value):
-        """ Store value to key in the DHT."""
+    def put(self, key, value, lookup=None, ttl=None):
+        """ Store value to key in the DHT (lookup: "recursive" or "iterative", default self.lookup).
+
+        With ttl, the key expires ttl seconds later.
+        """
         msg = {"method": "PUT", "args": {"key": key, "value": value}}
-        pickled_msg = pickle.dumps(msg)
-        self.socket.sendto(pickled_msg, self.dht_addr)
-        pickled_msg, addr = self.socket.recvfrom(1024)
-        out = pickle.loads(pickled_msg)
-        if out["method"] != "ACK":
+        if ttl is not None:
+            msg["args"]["ttl"] = ttl
+        out = self.routed_request(key, msg, lookup=lookup)
+        if out is None or out["method"] != "ACK":
             self.logger.error("Invalid msg: %s", out)
             return False
         return True
 
-    def get(self, key):
-        """ Retrieve key from DHT."""
+    def get(self, key, lookup=None):
+        """ Retrieve key from DHT (lookup: "recursive" or "iterative", default self.lookup); None if it is not stored."""
         msg = {"method": "GET", "args": {"key": key}}
-        pickled_msg = pickle.dumps(msg)
-        self.socket.sendto(pickled_msg, self.dht_addr)
-        pickled_msg, addr = self.socket.recvfrom(1024)
-        out = pickle.loads(pickled_msg)
-        if out["method"] != "ACK":
+        out = self.routed_request(key, msg, read=True, lookup=lookup)
+        if out is not None and out["method"] == "NOT_FOUND":
+            return None
+        if out is None or out["method"] != "ACK":
+            self.logger.error("Invalid msg: %s", out)
+            return None
+        return out["args"]
+
+    def request(self, address, msg):
+        """ Send msg to address tagged with a fresh msg_id and wait for the matching reply.
+
+        Replies to earlier (timed out) requests are discarded instead of being
+        taken as the answer to this one. Returns None if every retry timed out.
+        """
+        msg_id = next(self.msg_ids)
+        msg["args"] = dict(msg.get("args", {}), msg_id=msg_id)
+        for _ in range(self.retries + 1):
+            self.send(address, msg)
+            try:
+                while True:
+                    out, addr = self.recv()
+                    if out.get("msg_id") == msg_id:
+                        return out
+                    self.logger.debug("Ignoring stale msg: %s", out)
+            except socket.timeout:
+                continue
+        return None
+
+    def send(self, address, msg):
+        """ Send msg to address, over TCP if it is large. """
+        body = self.codec.encode(msg)
+        if len(body) > self.stream_threshold and self.streams.send(address, body):
+            return
+        self.send_datagrams(address, body)
+
+    def send_datagrams(self, address, body):
+        """ Send an encoded message as datagrams, chunked if needed."""
+        for payload in self.codec.datagrams(body):
+            self.socket.sendto(payload, address)
+
+    def recv(self, timeout=None):
+        """ Wait for the next complete message, at most timeout seconds (default self.timeout); raises socket.timeout."""
+        timeout = self.timeout if timeout is None else timeout
+        while True:
+            if self.streams.listener is not None or self.streams.connections or self.inbox:
+                # wait for datagrams and connections alike (which also sends what is queued on them, and
+                # accepts the connections of nodes sending large replies)
+                deadline = None if timeout is None else time.monotonic() + timeout
+                while not self.inbox:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        raise socket.timeout("timed out")
+                    messages, readable = self.streams.poll(remaining)
+                    self.inbox.extend(messages)
+                    if readable:
+                        break
+                if self.inbox:
+                    return self.inbox.popleft()
+            self.socket.settimeout(timeout)
+            payload, addr = self.socket.recvfrom(MAX_DATAGRAM)
+            try:
+                out = self.codec.feed(payload, addr)
+            except CodecError as e:
+                self.logger.warning("Dropping datagram from %s: %s", addr, e)
+                continue
+            if out is not None:
+                return out, addr
+
+    def routed_request(self, key, msg, read=False, lookup=None):
+        """ Send msg about key straight to its cached owner, falling back to dht_addr.
+
+        A REDIRECT reply (or no reply) means the cached range is stale: it is
+        dropped and the request is routed through the ring from dht_addr, or
+        sent to the owner found by an iterative lookup (lookup="iterative",
+        default self.lookup). Reads (read=True) may be sent to one of the
+        owner's replicas.
+        """
+        addr = self.routes.lookup(key_id(key), read)
+        if addr is not None:
+            out = self.request(addr, dict(msg, args=dict(msg["args"], direct=True)))
+            if out is not None and out["method"] != "REDIRECT":
+                self.routes.learn(out.get("node"))
+                return out
+            self.logger.debug("Stale route for %s: %s", key, addr)
+            self.routes.forget(addr)
+            if out is not None:
+                self.routes.learn(out.get("node"))
+        if (lookup or self.lookup) == "iterative":
+            out = self.iterative_request(key, msg)
+            if out is not None:
+                return out
+        out = self.request(self.dht_addr, msg)
+        if out is not None:
+            self.routes.learn(out.get("node"))
+        return out
+
+    def find_owner(self, key_hash, alpha=None, start=None):
+        """ Iterative lookup of key_hash from start (default dht_addr); returns (owner address, hops) or None."""
+        lookup = IterativeLookup(key_hash, start or self.dht_addr, alpha or self.alpha)
+        queries = {}  # msg_id -> (addr, time sent)
+        while not lookup.done:
+            for addr in lookup.next():
+                msg_id = next(self.msg_ids)
+                self.send(addr, {"method": "LOOKUP", "args": {"id": key_hash, "count": lookup.alpha, "msg_id": msg_id}})
+                queries[msg_id] = (addr, time.monotonic())
+            if not queries:
+                break
+            # wait for an answer, until the oldest query times out
+            now = time.monotonic()
+            timeout = min(sent for _, sent in queries.values()) + self.lookup_timeout - now
+            try:
+                out, _ = self.recv(max(timeout, 0.001))
+            except socket.timeout:
+                for msg_id, (addr, sent) in list(queries.items()):
+                    if sent + self.lookup_timeout <= time.monotonic():
+                        del queries[msg_id]
+                        lookup.failed(addr)
+                continue
+            query = queries.pop(out.get("msg_id"), None)
+            if query is None or out["method"] != "LOOKUP_REP":
+                self.logger.debug("Ignoring stale msg: %s", out)
+                continue
+            self.routes.learn(out.get("node"))
+            lookup.answered(query[0], out["args"])
+        return lookup.owner
+
+    def iterative_request(self, key, msg, start=None):
+        """ Send msg about key to the owner found by an iterative lookup from start; None if none answered for it."""
+        owner = self.find_owner(key_id(key), start=start)
+        if owner is None:
+            return None
+        addr, hops = owner
+        out = self.request(addr, dict(msg, args=dict(msg["args"], direct=True, hops=hops)))
+        if out is None or out["method"] == "REDIRECT":
+            self.logger.debug("Owner of %s moved: %s", key, addr)
+            return None
+        self.routes.learn(out.get("node"))
+        return out
+
+    def refresh_ring(self):
+        """ Walk the successor pointers starting at dht_addr and cache the ring view; None if dht_addr does not answer."""
+        nodes = []
+        addr = self.dht_addr
+        while True:
+            out = self.request(addr, {"method": "INFO"})
+            if out is None or out["method"] != "INFO_REP":
+                self.logger.error("Invalid msg: %s", out)
+                break
+            info = out["args"]
+            if nodes and info["id"] == nodes[0][0]:
+                break
+            nodes.append((info["id"], info["addr"]))
+            self.routes.learn(info)
+            if info["successor_addr"] is None:
+                break
+            addr = info["successor_addr"]
+        if not nodes:
+            return None
+        self.ring = RingView(nodes)
+        self.logger.debug("Ring view: %s", nodes)
+        return self.ring
+
+    def stats(self, address=None):
+        """ Metrics of the node at address (default dht_addr), see ChordNode.stats; None if it does not answer."""
+        out = self.request(address or self.dht_addr, {"method": "STATS"})
+        if out is None or out["method"] != "STATS_REP":
             self.logger.error("Invalid msg: %s", out)
             return None
         return out["args"]
 
+    def _batches(self, ring, keys, batch_size):
+        """ Group keys by responsible node (according to ring) in chunks of batch_size."""
+        groups = {}
+        for key, key_hash in zip(keys, key_ids(keys)):
+            groups.setdefault(ring.owner(key_hash), []).append(key)
+        for addr, group in groups.items():
+            for i in range(0, len(group), batch_size):
+                yield addr, group[i:i + batch_size]
+
+    def _send_batches(self, method, keys, make_args, batch_size):
+        """ Send all batches at once, then collect ACK_MANY replies correlated by msg_id.
+
+        Returns the list of reply args and the set of keys left unanswered.
+        """
+        ring = self.ring or self.refresh_ring()
+        if ring is None:
+            return [], set(keys)
+        pending = {}  # msg_id -> keys still unanswered
+        replies = []
+        for addr, batch in self._batches(ring, keys, batch_size):
+            msg_id = next(self.msg_ids)
+            pending[msg_id] = set(batch)
+            self.send(addr, {"method": method, "args": make_args(batch, msg_id)})
+
+        while any(pending.values()):
+            try:
+                out, addr = self.recv()
+            except socket.timeout:
+                break
+            if out["method"] != "ACK_MANY" or out.get("msg_id") not in pending:
+                self.logger.debug("Ignoring msg: %s", out)
+                continue
+            args = out["args"]
+            pending[out["msg_id"]].difference_update(args["keys"])
+            replies.append(args)
+            if ring.owner(key_id(args["keys"][0])) != args["node_addr"]:
+                # Keys were answered by another node than expected: the ring changed
+                self.ring = None
+
+        missing = set()
+        for keys_left in pending.values():
+            missing.update(keys_left)
+        return replies, missing
+
+    def put_many(self, items, batch_size=100, ttl=None):
+        """ Store all key/values of items in the DHT, batched by responsible node (expiring ttl seconds later)."""
+        items = dict(items)
+        missing = set(items)
+        extra = {} if ttl is None else {"ttl": ttl}
+        for _ in range(self.retries + 1):
+            _, missing = self._send_batches(
+                "PUT_MANY", list(missing),
+                lambda batch, msg_id: dict(extra, items={k: items[k] for k in batch}, msg_id=msg_id),
+                batch_size)
+            if not missing:
+                return True
+            self.ring = None
+        self.logger.error("No ACK for %d keys", len(missing))
+        return False
+
+    def get_many(self, keys, batch_size=100):
+        """ Retrieve keys from the DHT, batched by responsible node. Missing keys map to None."""
+        values = dict.fromkeys(keys)
+        missing = set(values)
+        for _ in range(self.retries + 1):
+            replies, missing = self._send_batches(
+                "GET_MANY", list(missing),
+                lambda batch, msg_id: {"keys": batch, "msg_id": msg_id},
+                batch_size)
+            for args in replies:
+                values.update(args["values"])
+            if not missing:
+                break
+            self.ring = None
+        else:
+            self.logger.error("No reply for %d keys", len(missing))
+        return values
+
+    def scan(self, start=None, end=None, limit=None, page_size=100):
+        """ Iterate over the (key, value) pairs with start <= key < end in key order (None: unbounded).
+
+        With "order" placement (see utils.key_id) only the nodes owning the
+        range are asked, otherwise every node is. All of them are asked at
+        once; each one answers with pages of its keys in order, the next page
+        being requested while the current one is consumed, and the pages are
+        merged as they come.
+
+        Parameters:
+            start, end: key range
+            limit: stop after this many pairs
+            page_size: pairs per SCAN_REP
+        """
+        ring = self.refresh_ring()
+        if ring is None:
+            return
+        if placement() == "order":
+            first = 0 if start is None else key_id(start)
+            last = 2**ring_bits() - 1 if end is None else key_id(end)
+            addrs = ring.owners(first, last)
+        else:
+            addrs = ring.addrs
+        page = page_size if limit is None else min(page_size, limit)
+        streams = [{"addr": addr, "items": deque(), "more": True, "after": None, "msg_id": None, "tries": 0}
+                   for addr in addrs]
+        waiting = {}  # msg_id -> stream whose next page was requested
+
+        def request_page(stream):
+            # the next page, or the same one again after a timeout
+            if stream["msg_id"] is None:
+                stream["msg_id"] = next(self.msg_ids)
+                waiting[stream["msg_id"]] = stream
+            args = {"start": start, "end": end, "after": stream["after"], "limit": page, "msg_id": stream["msg_id"]}
+            self.send(stream["addr"], {"method": "SCAN", "args": args})
+
+        for stream in streams:
+            request_page(stream)
+        count = 0
+        previous = None
+        while limit is None or count < limit:
+            if any(not stream["items"] and stream["more"] for stream in streams):
+                # every stream must have its smallest key at hand before picking the next one
+                try:
+                    out, addr = self.recv()
+                except socket.timeout:
+                    for stream in list(waiting.values()):
+                        stream["tries"] += 1
+                        if stream["tries"] > self.retries:
+                            self.logger.error("No scan reply from %s", stream["addr"])
+                            del waiting[stream["msg_id"]]
+                            stream["more"] = False
+                        else:
+                            request_page(stream)
+                    continue
+                stream = waiting.pop(out.get("msg_id"), None)
+                if out["method"] != "SCAN_REP" or stream is None:
+                    self.logger.debug("Ignoring msg: %s", out)
+                    continue
+                items = out["args"]["items"]
+                stream["items"].extend(items)
+                stream["more"] = out["args"]["more"]
+                stream["after"] = items[-1][0] if items else stream["after"]
+                stream["msg_id"] = None
+                stream["tries"] = 0
+                continue
+            ready = [stream for stream in streams if stream["items"]]
+            if not ready:
+                break
+            stream = min(ready, key=lambda s: s["items"][0][0])
+            key, value = stream["items"].popleft()
+            if stream["more"] and stream["msg_id"] is None and len(stream["items"]) <= page // 2:
+                request_page(stream)
+            if key == previous:  # also stored by a node still handing it over
+                continue
+            previous = key
+            count += 1
+            yield key, value
+
 
 if __name__ == "__main__":
     client = DHTClient(("localhost", 5000))
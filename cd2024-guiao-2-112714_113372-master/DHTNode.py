@@ -2,56 +2,244 @@
 import socket
 import threading
 import logging
-import pickle
-from utils import dht_hash, contains
-import sys
+import itertools
+import time
+from bisect import bisect_left, bisect_right, insort
+from utils import dht_hash, key_id, key_ids, contains, ring_bits
+from codec import Codec, CodecError, HEADER, MAX_DATAGRAM, MAX_MESSAGE, decode
+from storage import MemoryStorage, open_storage
+from cache import ReadCache
+from metrics import NodeMetrics
+from stream import Streams
+from timers import TimingWheel
+
+# errors of handlers given a message of the wrong shape (missing arguments, wrong types)
+MALFORMED = (KeyError, IndexError, TypeError, ValueError, AttributeError)
+
+
+def scan_order(key):
+    """Position of key in ChordNode.key_order: key order, keys of different types grouped by type."""
+    return type(key).__name__, key
+
 
 class FingerTable:
-    """Finger Table."""
+    """Finger Table.
+
+    Besides the entries themselves, the distinct finger nodes are kept sorted
+    by clockwise distance from node_id, so the closest preceding finger is a
+    binary search, and finger start ids are indexed in a dict.
+
+    Proximity neighbour selection: entry i may route via any node in its
+    interval [node_id + 2^i, node_id + 2^(i+1)), not only the first one (the
+    entry itself, the successor of its start), and still halve the distance
+    to any key past the interval. Up to `candidates` nodes of an interval
+    are kept, the entry and the nodes following it, with their measured
+    round trip times (see ChordNode.probe); the index used for routing holds
+    the fastest measured one of each interval, the entry until any is measured.
+    """
+
+    def __init__(self, node_id, node_addr, m_bits=None, candidates=1):
+        """ Initialize Finger Table (m_bits defaults to the configured ring size).
 
-    def __init__(self, node_id, node_addr, m_bits=10):
-        """ Initialize Finger Table."""
+        candidates: nodes considered per interval for proximity neighbour selection (1 disables it)
+        """
         self.node_id = node_id
         self.node_addr = node_addr
-        self.m_bits = m_bits
+        self.m_bits = ring_bits() if m_bits is None else m_bits
+        self.size = 2**self.m_bits
+        self.candidates = candidates
         self.finger_table = []
         self.idxtable = []
+        self.idx_by_id = {}  # finger start id -> index
+        self.confirmed = []  # entry learned from a SUCCESSOR_REP (or a join) since the last fill
+        self.distances = []  # sorted clockwise distances from node_id of the distinct routing nodes
+        self.by_distance = {}  # distance -> [number of entries routing via that node, node addr]
+        self.routes = []  # (id, addr) entry i routes via: the entry, or a faster node of its interval
+        self.alternates = []  # per entry, {addr: id} of the nodes following it in its interval
+        self.rtt = {}  # addr -> smoothed round trip time (seconds)
 
         # Initialize finger table with node information
         for i in range(self.m_bits):
             self.finger_table.append((node_id, node_addr))
             self.idxtable.append((i+1, (self.node_id + 2**(i)) % 2**self.m_bits))  
+            self.idx_by_id[self.idxtable[-1][1]] = i + 1
+            self.confirmed.append(False)
+            self.routes.append((node_id, node_addr))
+            self.alternates.append({})
+        self.distances = [0]
+        self.by_distance = {0: [self.m_bits, node_addr]}
+
+    def _distance(self, node_id):
+        return (node_id - self.node_id) % self.size
+
+    def _set(self, i, node_id, node_addr):
+        """ Replace entry i (0 based), keeping the sorted distances in sync."""
+        self.finger_table[i] = (node_id, node_addr)
+        self._reroute(i)
+
+    def _interval(self, node_id):
+        """ Index (0 based) of the entry whose interval holds node_id, None for node_id itself."""
+        distance = self._distance(node_id)
+        return distance.bit_length() - 1 if distance else None
+
+    def _reroute(self, i):
+        """ Pick the node entry i routes via, keeping the sorted distances in sync."""
+        node_id, node_addr = self.finger_table[i]
+        best = self.rtt.get(node_addr)
+        if self._interval(node_id) == i:
+            # only the nodes following the entry in its interval: the ones before it have left
+            reach = self._distance(node_id)
+            for addr, other in self.alternates[i].items():
+                rtt = self.rtt.get(addr)
+                if rtt is not None and (best is None or rtt < best) and self._distance(other) > reach:
+                    node_id, node_addr, best = other, addr, rtt
+        if self.routes[i] == (node_id, node_addr):
+            return
+        old = self._distance(self.routes[i][0])
+        entry = self.by_distance[old]
+        entry[0] -= 1
+        if entry[0] == 0:
+            del self.by_distance[old]
+            del self.distances[bisect_left(self.distances, old)]
+        self.routes[i] = (node_id, node_addr)
+        new = self._distance(node_id)
+        if new in self.by_distance:
+            self.by_distance[new][0] += 1
+            self.by_distance[new][1] = node_addr
+        else:
+            self.by_distance[new] = [1, node_addr]
+            insort(self.distances, new)
 
     def fill(self, node_id, node_addr):
         """ Fill all entries of finger_table with node_id, node_addr."""
         for i in range(self.m_bits):
             self.finger_table[i] = ((node_id, node_addr))  # Update all entries
+            self.routes[i] = (node_id, node_addr)
+            self.confirmed[i] = False
+        distance = self._distance(node_id)
+        self.distances = [distance]
+        self.by_distance = {distance: [self.m_bits, node_addr]}
+
+    def add_candidate(self, node_id, node_addr):
+        """ Consider node_id for the interval holding it; returns whether it was added."""
+        i = self._interval(node_id)
+        if i is None or self.candidates <= 1 or node_addr == self.finger_table[i][1] \
+                or node_addr in self.alternates[i] or len(self.alternates[i]) >= self.candidates - 1 \
+                or self._distance(node_id) <= self._distance(self.finger_table[i][0]):
+            return False
+        self.alternates[i][node_addr] = node_id
+        self._reroute(i)
+        return True
+
+    def observe(self, node_addr, rtt):
+        """ Record a round trip time measured to node_addr."""
+        old = self.rtt.get(node_addr)
+        self.rtt[node_addr] = rtt if old is None else 0.8 * old + 0.2 * rtt
+        self._reroute_all(node_addr)
+
+    def forget(self, node_addr):
+        """ node_addr did not answer: drop its measurements and stop considering it as an alternate."""
+        self.rtt.pop(node_addr, None)
+        for alternates in self.alternates:
+            alternates.pop(node_addr, None)
+        self._reroute_all(node_addr)
+
+    def _reroute_all(self, node_addr):
+        for i in range(self.m_bits):
+            if self.finger_table[i][1] == node_addr or self.routes[i][1] == node_addr or node_addr in self.alternates[i]:
+                self._reroute(i)
+
+    def probe_targets(self):
+        """ Nodes worth measuring: the entries lying in their own interval, and their alternates."""
+        targets = {}
+        for i, (node_id, node_addr) in enumerate(self.finger_table):
+            if self._interval(node_id) == i:
+                targets[node_addr] = node_id
+                targets.update(self.alternates[i])
+        return list(targets.items())
 
     def update(self, index, node_id, node_addr):
         """Update index of table with node_id and node_addr."""
-        self.finger_table[index-1] = (node_id, node_addr)  # Update specific index
+        self._set(index - 1, node_id, node_addr)  # Update specific index
+        self.confirmed[index - 1] = True
+
+    def update_run(self, index, node_id, node_addr):
+        """Update index with its successor node, and the following entries whose start also precedes that node.
+
+        successor(start) = node means no node in [start, node), so every later
+        start up to node has the same successor. Returns whether an entry changed.
+        """
+        if index is None:
+            return False
+        changed = False
+        start = self.idxtable[index - 1][1]
+        reach = (node_id - start) % self.size
+        for i in range(index - 1, self.m_bits):
+            if (self.idxtable[i][1] - start) % self.size > reach:
+                break
+            if self.finger_table[i] != (node_id, node_addr):
+                self._set(i, node_id, node_addr)
+                changed = True
+            self.confirmed[i] = True
+        return changed
 
     def find(self, identification):
         """ Get node address of closest preceding node (in finger table) of identification. """
-        for i in reversed(range(self.m_bits)): # Iterate through the finger table in reverse order (from higher to lower)
-            if contains(self.finger_table[i][0], self.node_id, identification):
-                return self.finger_table[i][1]
-            
+        # Closest preceding: the farthest finger strictly between us and identification
+        target = self._distance(identification) or self.size
+        pos = bisect_left(self.distances, target) - 1
+        if pos >= 0 and self.distances[pos] > 0:
+            return self.by_distance[self.distances[pos]][1]
+
         return self.finger_table[0][1] ## If no closer node is found, return the address of the first node in the finger table
 
+    def closest(self, identification, count):
+        """ Up to count distinct fingers preceding identification, as (id, addr), the closest to it first,
+        followed by the first finger past it (the owner of identification, as far as this table knows)."""
+        target = self._distance(identification) or self.size
+        pos = bisect_left(self.distances, target)
+        nodes = [((self.node_id + d) % self.size, self.by_distance[d][1])
+                 for d in reversed(self.distances[max(pos - count, 0):pos]) if d > 0]
+        if pos < len(self.distances):
+            nodes.append(((self.node_id + self.distances[pos]) % self.size, self.by_distance[self.distances[pos]][1]))
+        return nodes
+
     def refresh(self):
         """ Retrieve finger table entries requiring refresh."""
         refresh = []
 
         for i in range(len(self.finger_table)):
-            refresh.append((i+1, (self.node_id + 2**(i)) % 2**self.m_bits, self.finger_table[i][1]))
+            refresh.append((i+1, self.idxtable[i][1], self.finger_table[i][1]))
+        return refresh
+
+    def stale(self, successor_id=None, successor_addr=None):
+        """ Finger table entries to query, as (index, start id, node to ask).
+
+        Entries whose start is in (node_id, successor_id] are set to the
+        successor without asking. A confirmed entry whose start precedes the
+        node of an entry being queried is skipped: the reply to that query
+        (see update_run) refreshes it too.
+        """
+        refresh = []
+        run_start, run_reach = None, -1
+        for i, (index, start) in enumerate(self.idxtable):
+            if successor_id is not None and contains(self.node_id, successor_id, start):
+                if self.finger_table[i][0] != successor_id:
+                    self._set(i, successor_id, successor_addr)
+                self.confirmed[i] = True
+                continue
+            if self.confirmed[i] and run_start is not None and (start - run_start) % self.size <= run_reach:
+                continue
+            refresh.append((index, start, self.finger_table[i][1]))
+            if self.confirmed[i]:
+                run_start, run_reach = start, (self.finger_table[i][0] - start) % self.size
+            else:
+                run_start, run_reach = None, -1
         return refresh
 
     def getIdxFromId(self, id):
         """ Get index of finger table entry with id."""
-        for i in self.idxtable:
-            if (i[1] == id):
-                return i[0] # Return the index of the entry with provided id
+        return self.idx_by_id.get(id)
 
     def __repr__(self):
         return str(self.as_list)
@@ -66,20 +254,54 @@ class FingerTable:
             idxlist.append(i) 
         return idxlist
 
-class DHTNode(threading.Thread):
-    """ DHT Node Agent. """
+class ChordNode:
+    """ Chord protocol state and message handlers.
 
-    def __init__(self, address, dht_address=None, timeout=3):
+    Independent of how datagrams are sent and received: DHTNode runs one node
+    per thread on a blocking socket, DHTAsyncNode.AsyncDHTNode runs many nodes
+    on one asyncio event loop. Transports call dispatch() for every message,
+    and tick() after it and whenever wakeup() is due, and flush_batches()
+    once no more messages are waiting.
+    """
+
+    def __init__(self, address, dht_address=None, timeout=3, max_message=MAX_MESSAGE, replicas=1, consistency="one",
+                 migrate_batch=50, migrate_interval=0.02, identification=None, min_interval=None, max_interval=None, storage=None, cache_size=256,
+                 cache_lease=None, cache_admit=2, stream_threshold=None, finger_candidates=3, batch_window=0.005,
+                 batch_size=64, batch_bytes=60000, ttl_tick=0.1):
         """Constructor
 
         Parameters:
             address: self's address
             dht_address: address of a node in the DHT
-            timeout: impacts how often stabilize algorithm is carried out
+            timeout: impacts how often stabilize algorithm is carried out, and how soon silent neighbours are
+                considered failed
+            max_message: largest message (in bytes) sent or accepted, larger ones are chunked over several datagrams
+            replicas: number of copies of each key, kept on the owner and its next replicas - 1 successors
+            consistency: "one" (ACK writes once stored on the owner, serve reads from any replica)
+                or "quorum" (writes and reads wait for a majority of the replicas)
+            migrate_batch: keys per MIGRATE message when handing keys over on join/leave
+            migrate_interval: minimum seconds between MIGRATE messages, so handoff does not starve requests
+            identification: ring position, defaults to the hash of address (see vnode_ids)
+            min_interval: stabilize interval right after a membership change (default timeout / 10)
+            max_interval: stabilize interval reached by exponential backoff on a stable ring (default timeout)
+            storage: storage engine holding the keys we own and their versions, e.g. a storage.LogStorage
+                to keep them on disk (default a storage.MemoryStorage); closed when the node stops
+            cache_size: hot keys cached when routing GETs for other nodes (0 disables the cache, so does
+                quorum consistency)
+            cache_lease: seconds a cached value is served before asking its owner again (default timeout)
+            cache_admit: GETs of a key forwarded by this node before it caches the key
+            stream_threshold: messages larger than this (in bytes, encoded) are sent over TCP by the transports
+                supporting it (default: the ones not fitting in one datagram)
+            finger_candidates: nodes per finger interval whose round trip time is measured, routing via the
+                fastest one (proximity neighbour selection, 1 disables it)
+            batch_window: longest delay (seconds) of a forwarded PUT/GET waiting to be sent in one BATCH with
+                others to the same next hop (0 forwards every request on its own)
+            batch_size: forwarded requests per BATCH at most
+            batch_bytes: encoded size of a BATCH at most
+            ttl_tick: precision (seconds) of the expiry of keys written with a TTL
         """
-        threading.Thread.__init__(self)
         self.done = False
-        self.identification = dht_hash(address.__str__())
+        self.identification = dht_hash(address.__str__()) if identification is None else identification
         self.addr = address  # My address
         self.dht_address = dht_address  # Address of the initial Node
         if dht_address is None:
@@ -96,28 +318,149 @@ class DHTNode(threading.Thread):
             self.predecessor_id = None
             self.predecessor_addr = None
 
-        self.finger_table = FingerTable(self.identification, self.addr)             #TODO create finger_table
+        self.finger_table = FingerTable(self.identification, self.addr, candidates=finger_candidates)
+        self.batch_window = batch_window
+        self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
+        self.outbox = {}  # next hop -> [deadline, encoded forwarded requests, their size] waiting to be batched
+        self.pings = {}  # token -> (addr, time sent) of the PINGs measuring finger candidates
+        self.probe_queue = []  # finger candidates left to PING in the current pass
 
-        self.keystore = {}  # Where all data is stored
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.socket.settimeout(timeout)
+        self.keystore = MemoryStorage() if storage is None else storage  # Where all data is stored
+        # scan_order of the keys in keystore, sorted: a SCAN page is a binary search and a slice
+        self.key_order = sorted(map(scan_order, self.keystore))
+        # key -> version of the value in keystore, bumped on every put, kept by the storage engine: an owner
+        # restarted on its LogStorage goes on from the versions its replicas hold
+        self.versions = self.keystore.versions
+        # keys written with a TTL, by expiry time (time.time(): deadlines are sent along with replicas)
+        self.ttl = TimingWheel(ttl_tick, now=time.time())
+
+        self.replicas = replicas
+        self.consistency = consistency
+        self.quorum = replicas // 2 + 1
+        self.successor_list = []  # (id, addr) of the nodes following us, holding our replicas
+        # (id, addr) of the nodes preceding us, nearest first: our predecessor tells us its own list
+        self.predecessor_list = []
+        # we are in the replica set of the owners of (replica_start, predecessor_id], None until predecessor_list is known
+        self.replica_start = None
+        self.replica_store = {}  # key -> (version, value) replicated from a predecessor
+        self.replica_expires = {}  # key -> expiry time (time.time()) of the replicated keys written with a TTL
+        self.cache_lease = timeout if cache_lease is None else cache_lease
+        self.read_cache = ReadCache(cache_size, self.cache_lease, cache_admit) \
+            if cache_size and consistency == "one" else None
+        self.leases = {}  # key -> {address of a node caching it: lease end}
+        self.exports = {}  # token -> [keystore view, its keys, their expiry times, last paged] (see export)
+        self.replicated_to = []  # replica addresses the whole keystore was last pushed to
+        self.pending = {}  # token -> quorum read/write waiting for replica answers
+        self.tokens = itertools.count(1)
+        self.successor_seen = time.monotonic()  # last STABILIZE reply from our successor
+        self.suspected = {}  # id -> time of successors skipped because they stopped answering
+        self.predecessor_seen = time.monotonic()  # last NOTIFY from our predecessor
+
+        self.migrate_batch = migrate_batch
+        self.migrate_interval = migrate_interval
+        self.handoff = {}  # addr -> keys waiting to be handed over to that node
+        self.inflight = {}  # token -> (addr, keys, time sent) of MIGRATE batches not yet acknowledged
+        self.last_migrate = 0
+        self.receiving_from = None  # previous owner of our range while it hands keys over to us
+        self.receiving_since = None
+        self.leave_requested = False
+        self.leaving = False
+        self.timeout = timeout
+        self.min_interval = timeout / 10 if min_interval is None else min_interval
+        self.max_interval = timeout if max_interval is None else max_interval
+        self.interval = self.min_interval  # current stabilize interval
+        self.next_stabilize = time.monotonic()
+        self.ring_changed = False  # membership or fingers changed since the last stabilize round
+        self.next_finger = 0  # index of the last finger fixed, one finger is fixed per round
+        self.finger_pass_changed = False  # a finger changed during the current pass over the stale fingers
+        self.fingers_settled = False  # the last full pass over the stale fingers changed nothing
+        self.stabilize_rounds = 0
+        self.unsettled_since = 0  # stabilize round of the first membership change the fingers have not caught up with
+        self.started = time.monotonic()
+        self.metrics = NodeMetrics()
+        self.codec = Codec(max_message=max_message)
+        self.stream_threshold = MAX_DATAGRAM - HEADER.size if stream_threshold is None else stream_threshold
         self.logger = logging.getLogger("Node {}".format(self.identification))
 
-    def send(self, address, msg):
-        """ Send msg to address. """
-        payload = pickle.dumps(msg)
-        self.socket.sendto(payload, address)
+        # Message dispatch table: method -> handler(msg, addr)
+        self.handlers = {
+            "JOIN_REQ": lambda msg, addr: self.node_join(msg["args"]),
+            "NOTIFY": lambda msg, addr: self.notify(msg["args"]),
+            "PUT": self.on_put,
+            "GET": self.on_get,
+            "PUT_MANY": self.on_put_many,
+            "GET_MANY": self.on_get_many,
+            "SCAN": self.on_scan,
+            "EXPORT": self.on_export,
+            "EXPIRE": lambda msg, addr: self.expire_replicas(msg["args"]["keys"]),
+            "CACHE": self.on_cache,
+            "INVALIDATE": self.on_invalidate,
+            "STATS": self.on_stats,
+            "LOOKUP": self.on_lookup,
+            "BATCH": self.on_batch,
+            "PING": self.on_ping,
+            "PONG": self.on_pong,
+            "MIGRATE": lambda msg, addr: self.migrate(msg["args"], addr),
+            "MIGRATE_ACK": lambda msg, addr: self.migrate_ack(msg["args"]),
+            "MIGRATE_DONE": self.on_migrate_done,
+            "LEAVE": lambda msg, addr: self.neighbour_left(msg["args"]),
+            "SUCCESSOR_LIST": self.on_successor_list,
+            "SUCCESSOR_LIST_REP": lambda msg, addr: self.update_successor_list(msg["args"]["nodes"]),
+            "REPLICATE": lambda msg, addr: self.replicate(msg["args"], addr),
+            "REPLICA_GET": self.on_replica_get,
+            "REPLICA_ACK": lambda msg, addr: self.replica_answer(msg["args"]),
+            "REPLICA_VALUE": lambda msg, addr: self.replica_answer(msg["args"]),
+            "INFO": self.on_info,
+            "PREDECESSOR": self.on_predecessor,
+            # Reply with successor of id
+            "SUCCESSOR": lambda msg, addr: self.get_successor(msg["args"]),
+            # Initiate stabilize protocol
+            "STABILIZE": lambda msg, addr: self.stabilize(msg["args"], msg.get("addr") or addr),
+            "SUCCESSOR_REP": self.on_successor_rep,
+            # Answer to a JOIN_REQ we resent before the first answer arrived
+            "JOIN_REP": lambda msg, addr: None,
+        }
 
-    def recv(self):
-        """ Retrieve msg payload and from address."""
+    def send(self, address, msg):
+        """ Send msg to address, over a stream if it is large and the transport has them."""
         try:
-            payload, addr = self.socket.recvfrom(1024)
-        except socket.timeout:
-            return None, None
+            body = self.codec.encode(msg)
+        except CodecError as e:
+            self.logger.error("Cannot send %s to %s: %s", msg.get("method"), address, e)
+            return
+        self.send_body(address, body)
+
+    def send_body(self, address, body):
+        """ Send an encoded message, over a stream if it is large and the transport has them."""
+        if len(body) > self.stream_threshold and self.stream(address, body):
+            self.metrics.counters["streamed"] += 1
+            return
+        self.send_datagrams(address, body)
+
+    def send_datagrams(self, address, body):
+        """ Send an encoded message as datagrams, chunked if needed."""
+        for payload in self.codec.datagrams(body):
+            self.sendto(payload, address)
+
+    def sendto(self, payload, address):
+        """ Send one datagram (provided by the transport)."""
+        raise NotImplementedError
 
-        if len(payload) == 0:
-            return None, addr
-        return payload, addr
+    def stream(self, address, body):
+        """ Send an encoded message over a stream connection (provided by the transport).
+
+        Returns False when the transport has none, the message is then chunked over datagrams.
+        """
+        return False
+
+    def decode(self, payload, addr):
+        """ Decode a received datagram; None for chunks of an incomplete message or invalid data."""
+        try:
+            return self.codec.feed(payload, addr)
+        except CodecError as e:
+            self.logger.warning("Dropping datagram from %s: %s", addr, e)
+            return None
 
     def node_join(self, args):
         """Process JOIN_REQ message.
@@ -130,12 +473,14 @@ class DHTNode(threading.Thread):
         addr = args["addr"]
         identification = args["id"]
         if self.identification == self.successor_id:  # I'm the only node in the DHT
+            self.membership_changed()
             self.successor_id = identification
             self.successor_addr = addr
             self.finger_table.update(1, self.successor_id , self.successor_addr)
             args = {"successor_id": self.identification, "successor_addr": self.addr}
             self.send(addr, {"method": "JOIN_REP", "args": args})
         elif contains(self.identification, self.successor_id, identification):
+            self.membership_changed()
             args = {
                 "successor_id": self.successor_id,
                 "successor_addr": self.successor_addr,
@@ -146,7 +491,8 @@ class DHTNode(threading.Thread):
             self.send(addr, {"method": "JOIN_REP", "args": args})
         else:
             self.logger.debug("Find Successor(%d)", args["id"])
-            self.send(self.successor_addr, {"method": "JOIN_REQ", "args": args})
+            # Route through the fingers: O(log n) hops instead of walking the ring
+            self.send(self.finger_table.find(identification), {"method": "JOIN_REQ", "args": args})
         self.logger.info(self)
 
     def get_successor(self, args):
@@ -162,29 +508,37 @@ class DHTNode(threading.Thread):
         address = args["from"]  
 
         if contains(self.identification, self.successor_id, identification): #if key is between node and successor
-            arguments = {"req_id": identification, "successor_id": self.successor_id, "successor_addr": self.successor_addr,"msg":1}
+            arguments = {"req_id": identification, "successor_id": self.successor_id, "successor_addr": self.successor_addr}
             self.send(address, {"method": "SUCCESSOR_REP", "args": arguments})
         elif self.predecessor_id is None or contains(self.predecessor_id, self.identification, identification): #if key is between predecessor and node
-            arguments = {"req_id": identification, "successor_id": self.identification, "successor_addr": self.addr,"msg":2}
+            arguments = {"req_id": identification, "successor_id": self.identification, "successor_addr": self.addr}
             self.send(address, {"method": "SUCCESSOR_REP", "args": arguments})
         else:
             arguments = {"id": identification, "from": address}
-            self.send(self.successor_addr,{"method": "SUCCESSOR", "args": {"id": identification, "from": address}}) 
+            self.forward(self.finger_table.find(identification), {"method": "SUCCESSOR", "args": arguments})
                 
     def notify(self, args):
         """Process NOTIFY message.
-            Updates predecessor pointers.
+            Updates predecessor pointers. A predecessor that stopped notifying
+            us for several stabilize periods is considered failed and replaced.
 
         Parameters:
             args (dict): id and addr of the predecessor node
         """
 
         self.logger.debug("Notify: %s", args)
-        if self.predecessor_id is None or contains(
+        if args["predecessor_id"] == self.predecessor_id:
+            self.predecessor_seen = time.monotonic()
+        elif self.predecessor_id in (None, self.identification) or contains(
             self.predecessor_id, self.identification, args["predecessor_id"]
-        ):
+        ) or time.monotonic() - self.predecessor_seen > 4 * self.timeout:
+            self.predecessor_seen = time.monotonic()
             self.predecessor_id = args["predecessor_id"]
             self.predecessor_addr = args["predecessor_addr"]
+            self.predecessor_list, self.replica_start = [], None
+            self.promote_replicas()
+            self.start_handoff()
+            self.membership_changed()
         self.logger.info(self)
 
     def stabilize(self, from_id, addr):
@@ -192,132 +546,1036 @@ class DHTNode(threading.Thread):
             Updates all successor pointers.
 
         Parameters:
-            from_id: id of the predecessor of node with address addr
-            addr: address of the node sending stabilize message
+            from_id: id of the predecessor of our successor
+            addr: address of that predecessor (address of the node sending stabilize message if not given)
         """
 
         self.logger.debug("Stabilize: %s %s", from_id, addr)
-        if from_id is not None and contains(
+        self.successor_seen = time.monotonic()
+        if from_id is not None and from_id != self.successor_id and from_id not in self.suspected and contains(
             self.identification, self.successor_id, from_id
         ):
             # Update our successor
+            self.membership_changed()
             self.successor_id = from_id
             self.successor_addr = addr
-            #TODO update finger table
             self.finger_table.fill(self.successor_id , self.successor_addr)
 
         # notify successor of our existence, so it can update its predecessor record
         args = {"predecessor_id": self.identification, "predecessor_addr": self.addr}
         self.send(self.successor_addr, {"method": "NOTIFY", "args": args})
+        if self.replicas > 1:
+            args = {"predecessors": [(self.identification, self.addr)] + self.predecessor_list[:self.replicas - 1]}
+            self.send(self.successor_addr, {"method": "SUCCESSOR_LIST", "args": args})
+
+        self.fix_finger()
+
+    def fix_finger(self):
+        """Query the successor of the next stale finger, one finger per stabilize round."""
+        fgtrefresh = self.finger_table.stale(self.successor_id, self.successor_addr)
+        if not fgtrefresh:  # every finger is our successor
+            self.fingers_settled = True
+            return
+        node = next((entry for entry in fgtrefresh if entry[0] > self.next_finger), fgtrefresh[0])
+        if node[0] <= self.next_finger:  # starting a new pass
+            self.fingers_settled = not self.finger_pass_changed
+            self.finger_pass_changed = False
+        self.next_finger = node[0]
+        args =  {"id": node[1], "from": self.addr}
+        self.send(node[2], {"method": "SUCCESSOR", "args": args})
+
+    def probe(self):
+        """PING the next finger candidate, one per stabilize round.
+
+        The PONG gives its round trip time, and its successor: the next
+        candidate of its interval (see FingerTable). Candidates that do not
+        answer are forgotten.
+        """
+        if self.finger_table.candidates <= 1:
+            return
+        now = time.monotonic()
+        for token, (addr, sent) in list(self.pings.items()):
+            if now - sent > 2 * self.timeout:
+                del self.pings[token]
+                self.finger_table.forget(addr)
+        if not self.probe_queue:
+            self.probe_queue = [addr for addr, _ in self.finger_table.probe_targets()]
+        if self.probe_queue:
+            addr = self.probe_queue.pop()
+            token = next(self.tokens)
+            self.pings[token] = (addr, now)
+            self.send(addr, {"method": "PING", "args": {"token": token}})
+
+    def on_ping(self, output, addr):
+        args = {"token": output["args"]["token"], "id": self.identification, "successor_id": self.successor_id,
+                "successor_addr": self.successor_addr}
+        self.send(addr, {"method": "PONG", "args": args})
+
+    def on_pong(self, output, addr):
+        args = output["args"]
+        ping = self.pings.pop(args["token"], None)
+        if ping is None:
+            return
+        self.finger_table.observe(ping[0], time.monotonic() - ping[1])
+        if args["successor_addr"] is not None and self.finger_table.add_candidate(args["successor_id"],
+                                                                                  tuple(args["successor_addr"])):
+            self.probe_queue.append(tuple(args["successor_addr"]))
+
+    def membership_changed(self):
+        """Our neighbours or fingers changed: stabilize fast again until the ring settles."""
+        self.ring_changed = True
+        self.fingers_settled = False
+        if self.unsettled_since is None:
+            self.unsettled_since = self.stabilize_rounds
+        self.interval = self.min_interval
+        self.next_stabilize = min(self.next_stabilize, time.monotonic() + self.min_interval)
 
-        # TODO refresh finger_table
-        fgtrefresh = self.finger_table.refresh()
-        for node in  fgtrefresh:
-            args =  {"id": node[1], "from": self.addr}
-            self.send(node[2], {"method": "SUCCESSOR", "args": args})
+    def stabilize_round(self):
+        """Periodic maintenance, run by the stabilize timer."""
+        now = time.monotonic()
+        self.stabilize_rounds += 1
+        if now - self.successor_seen > 4 * self.timeout:
+            self.successor_failed()
+        self.expire_pending()
+        self.expire_leases()
+        self.expire_exports()
+        for node_id in [i for i, since in self.suspected.items() if now - since > 10 * self.timeout]:
+            del self.suspected[node_id]
+        if self.receiving_from is not None and now - self.receiving_since > 10 * self.timeout:
+            self.logger.warning("No handoff from %s, serving our range without it", self.receiving_from)
+            self.receiving_from = None
+        # Ask successor for predecessor, to start the stabilize process
+        self.send(self.successor_addr, {"method": "PREDECESSOR"})
+        self.probe()
 
-    def put(self, key, value, address):
+        # Back off while nothing changes and a whole pass over the fingers confirmed them
+        if not self.ring_changed and self.fingers_settled:
+            self.interval = min(self.interval * 2, self.max_interval)
+            if self.unsettled_since is not None:
+                self.metrics.convergence.observe(self.stabilize_rounds - self.unsettled_since)
+                self.unsettled_since = None
+        self.ring_changed = False
+        self.next_stabilize = now + self.interval
+
+    def put(self, key, value, address, msg_id=None, direct=False, hops=0, ttl=None):
         """Store value in DHT.
 
         Parameters:
         key: key of the data
         value: data to be stored
         address: address where to send ack/nack
+        msg_id: client request id, forwarded and echoed in the ACK
+        direct: client sent the request straight to the node it believes responsible
+        hops: times the request was forwarded so far
+        ttl: seconds after which the owner drops the key, None keeps it until overwritten
         """
-        key_hash = dht_hash(key)
+        key_hash = key_id(key)
         self.logger.debug("Put: %s %s", key, key_hash)
 
-        #TODO Replace next code:
-        if contains (self.predecessor_id, self.identification, key_hash): #if key is between predecessor and node
-            self.keystore[key] = value
-            self.send(address, {"method": "ACK"})
+        if direct and self.next_hop(key_hash) is not None:
+            self.redirect(address, msg_id)
+            return
+
+        # (no predecessor yet: just joined, our successor still serves our range)
+        if self.predecessor_id is not None and contains (self.predecessor_id, self.identification, key_hash): #if key is between predecessor and node
+            self.metrics.hops.observe(hops)
+            self.store(key, value, address, msg_id, ttl)
         elif contains (self.identification, self.successor_id, key_hash): #if key is between node and successor
-            self.send(self.successor_addr, {"method": "PUT", "args": {"key": key, "value": value, "from": address,"succ":1}})
+            args = {"key": key, "value": value, "from": address, "msg_id": msg_id, "succ":1, "hops": hops + 1}
+            if ttl is not None:
+                args["ttl"] = ttl
+            self.forward(self.successor_addr, {"method": "PUT", "args": args})
         else:
-            self.send(self.finger_table.find(key_hash), {"method": "PUT", "args": {"key": key, "value": value, "from": address,"finger":1}})
+            args = {"key": key, "value": value, "from": address, "msg_id": msg_id, "finger":1, "hops": hops + 1}
+            if ttl is not None:
+                args["ttl"] = ttl
+            self.forward(self.finger_table.find(key_hash), {"method": "PUT", "args": args})
         
 
-    def get(self, key, address):
+    def get(self, key, address, msg_id=None, direct=False, handoff=False, cache=None, hops=0):
         """Retrieve value from DHT.
 
         Parameters:
         key: key of the data
         address: address where to send ack/nack
+        msg_id: client request id, forwarded and echoed in the ACK
+        direct: client sent the request straight to the node it believes responsible
+        handoff: the new owner of key asks us, its previous owner, while keys are still being handed over
+        cache: address of a node on the way that wants a copy of the value (hot key, see cache.ReadCache)
+        hops: times the request was forwarded so far
         """
-        key_hash = dht_hash(key)
+        key_hash = key_id(key)
         self.logger.debug("Get: %s %s", key, key_hash)
 
-        #TODO Replace next code:
-        if contains (self.predecessor_id, self.identification, key_hash): #if key is between predecessor and node
+        if handoff:
+            if self.expired(key):
+                self.expire_keys([key])
+            if key in self.keystore:
+                self.send(address, {"method": "ACK", "args": self.keystore[key], "msg_id": msg_id})
+            else:
+                self.send(address, {"method": "NOT_FOUND", "args": {"key": key}, "msg_id": msg_id})
+            return
+
+        if self.consistency == "one" and key in self.replica_store and not self.replica_expired(key) \
+                and self.replica_holder(key_hash):
+            # Any replica may answer a read-one, spreading hot keys over the replica set
+            self.metrics.hops.observe(hops)
+            self.send(address, {"method": "ACK", "args": self.replica_store[key][1], "msg_id": msg_id,
+                                "node": self.route_info()})
+            return
+
+        if direct and self.next_hop(key_hash) is not None:
+            self.redirect(address, msg_id)
+            return
+
+        # (no predecessor yet: just joined, our successor still serves our range)
+        if self.predecessor_id is not None and contains (self.predecessor_id, self.identification, key_hash): #if key is between predecessor and node
+            if self.expired(key):
+                # due, the wheel drops it at its next tick
+                self.expire_keys([key])
+            if key not in self.keystore:
+                if self.receiving_from is not None:
+                    # Not handed over yet: the previous owner still holds it
+                    args = {"key": key, "from": address, "msg_id": msg_id, "handoff": True}
+                    self.send(self.receiving_from, {"method": "GET", "args": args})
+                    return
+                self.metrics.hops.observe(hops)
+                self.metrics.counters["not_found"] += 1
+                reply = {"method": "NOT_FOUND", "args": {"key": key}, "msg_id": msg_id, "node": self.route_info()}
+                if self.consistency == "quorum" and self.replica_addrs():
+                    # a replica may hold a version we missed
+                    self.quorum_read(key, reply, address)
+                else:
+                    self.send(address, reply)
+                return
             value = self.keystore[key]
-            self.send(address, {"method": "ACK", "args": value})
-        elif contains (self.identification, self.successor_id, key_hash): #if key is between node and successor
-            self.send(self.successor_addr, {"method": "GET", "args": {"key": key, "from": address}})
+            self.metrics.hops.observe(hops)
+            reply = {"method": "ACK", "args": value, "msg_id": msg_id, "node": self.route_info()}
+            if self.consistency == "quorum" and self.replica_addrs():
+                self.quorum_read(key, reply, address)
+            else:
+                self.send(address, reply)
+                if cache is not None:
+                    self.grant_lease(key, value, cache)
+            return
+
+        if self.read_cache is not None:
+            hit, value = self.read_cache.lookup(key)
+            if hit:
+                # no route info: the key is not in our range
+                self.metrics.hops.observe(hops)
+                self.send(address, {"method": "ACK", "args": value, "msg_id": msg_id})
+                return
+            if cache is None and self.read_cache.record(key):
+                cache = self.addr  # the node closest to the client caches it
+        args = {"key": key, "from": address, "msg_id": msg_id, "hops": hops + 1}
+        if cache is not None:
+            args["cache"] = cache
+        if contains (self.identification, self.successor_id, key_hash): #if key is between node and successor
+            self.forward(self.successor_addr, {"method": "GET", "args": args})
         else:
-            self.send(self.finger_table.find(key_hash), {"method": "GET", "args": {"key": key, "from": address}})
+            self.forward(self.finger_table.find(key_hash), {"method": "GET", "args": args})
 
+    def forward(self, address, msg):
+        """Send a lookup on towards the node responsible for it, counting hops to our successor vs farther fingers.
 
-    def run(self):
-        self.socket.bind(self.addr)
+        PUT and GET requests are coalesced per next hop (write-behind): they
+        wait in the outbox until batch_size of them or batch_bytes are
+        queued, the transport has no more messages to handle (it calls
+        flush_batches), or batch_window elapsed while it kept busy, then go
+        as one BATCH message.
+        """
+        self.metrics.counters["forwarded_to_successor" if address == self.successor_addr else "forwarded_to_finger"] += 1
+        if not self.batch_window or msg["method"] not in ("PUT", "GET"):
+            self.send(address, msg)
+            return
+        try:
+            body = self.codec.encode(msg)
+        except CodecError as e:
+            self.logger.error("Cannot forward %s to %s: %s", msg["method"], address, e)
+            return
+        if len(body) >= self.batch_bytes:
+            self.send_body(address, body)
+            return
+        entry = self.outbox.get(address)
+        if entry is not None and entry[2] + len(body) > self.batch_bytes:
+            self.flush_batch(address)
+            entry = None
+        if entry is None:
+            entry = self.outbox[address] = [time.monotonic() + self.batch_window, [], 0]
+        entry[1].append(body)
+        entry[2] += len(body)
+        if len(entry[1]) >= self.batch_size:
+            self.flush_batch(address)
 
-        # Loop untiln joining the DHT
-        while not self.inside_dht:
-            join_msg = {
-                "method": "JOIN_REQ",
-                "args": {"addr": self.addr, "id": self.identification},
-            }
-            self.send(self.dht_address, join_msg)
-            payload, addr = self.recv()
-            if payload is not None:
-                output = pickle.loads(payload)
-                self.logger.debug("O: %s", output)
-                if output["method"] == "JOIN_REP":
-                    args = output["args"]
-                    self.successor_id = args["successor_id"]
-                    self.successor_addr = args["successor_addr"]
-                    #TODO fill finger table
-                    self.finger_table.fill(self.successor_id, self.successor_addr)
-                    self.inside_dht = True
-                    self.logger.info(self)
-
-        while not self.done:
-            payload, addr = self.recv()
-            if payload is not None:
-                output = pickle.loads(payload)
-                self.logger.info("O: %s", output)
-                if output["method"] == "JOIN_REQ":
-                    self.node_join(output["args"])
-                elif output["method"] == "NOTIFY":
-                    self.notify(output["args"])
-                elif output["method"] == "PUT":
-                    self.put(
-                        output["args"]["key"],
-                        output["args"]["value"],
-                        output["args"].get("from", addr),
-                    )
-                elif output["method"] == "GET":
-                    self.get(output["args"]["key"], output["args"].get("from", addr))
-                elif output["method"] == "PREDECESSOR":
-                    # Reply with predecessor id
-                    self.send(
-                        addr, {"method": "STABILIZE", "args": self.predecessor_id}
-                    )
-                elif output["method"] == "SUCCESSOR":
-                    # Reply with successor of id
-                    self.get_successor(output["args"])
-                elif output["method"] == "STABILIZE":
-                    # Initiate stabilize protocol
-                    self.stabilize(output["args"], addr)
-                elif output["method"] == "SUCCESSOR_REP":
-                    #TODO Implement processing of SUCCESSOR_REP
-                    idx = self.finger_table.getIdxFromId(output["args"]["req_id"])
-                    node_id = output["args"]["successor_id"]
-                    node_addr = output["args"]["successor_addr"]
-
-                    self.finger_table.update(idx, node_id, node_addr) #update finger table
-            else:  # timeout occurred, lets run the stabilize algorithm
-                # Ask successor for predecessor, to start the stabilize process
-                self.send(self.successor_addr, {"method": "PREDECESSOR"})
+    def flush_batch(self, address):
+        """Send the requests waiting in the outbox for address."""
+        _, bodies, _ = self.outbox.pop(address)
+        if len(bodies) == 1:
+            self.send_body(address, bodies[0])
+            return
+        self.metrics.counters["batches"] += 1
+        self.metrics.counters["batched"] += len(bodies)
+        self.send(address, {"method": "BATCH", "args": {"bodies": bodies}})
+
+    def flush_batches(self, now=None):
+        """Send the batches whose window ended by now (every batch if now is None)."""
+        for address in [a for a, entry in self.outbox.items() if now is None or entry[0] <= now]:
+            self.flush_batch(address)
+
+    def on_batch(self, output, addr):
+        for body in output["args"]["bodies"]:
+            try:
+                msg = decode(body)
+            except CodecError as e:
+                self.logger.warning("Dropping batched message from %s: %s", addr, e)
+                continue
+            self.dispatch(msg, addr)
+
+    def grant_lease(self, key, value, address):
+        """Send a copy of key to a node caching it, which may serve it for cache_lease seconds.
+
+        Writes to key before the lease ends are sent to it (revoke_leases).
+        The lease is kept one timeout longer than granted, for the time the
+        copy takes to arrive.
+        """
+        self.leases.setdefault(key, {})[address] = time.monotonic() + self.cache_lease + self.timeout
+        args = {"key": key, "value": value, "version": self.versions.get(key, 0), "lease": self.cache_lease}
+        self.send(address, {"method": "CACHE", "args": args})
+
+    def revoke_leases(self, key, version=None):
+        """Key was written (or dropped, as of version): invalidate the copies cached by other nodes."""
+        holders = self.leases.pop(key, None)
+        if not holders:
+            return
+        now = time.monotonic()
+        args = {"key": key, "version": self.versions.get(key, 0) if version is None else version}
+        for address, expires in holders.items():
+            if expires > now:
+                self.send(address, {"method": "INVALIDATE", "args": args})
+
+    def expire_leases(self):
+        now = time.monotonic()
+        for key in [k for k, holders in self.leases.items() if max(holders.values()) < now]:
+            del self.leases[key]
+
+
+    def route_info(self):
+        """Key range this node is responsible for: (predecessor_id, id], attached to replies for client routing caches."""
+        info = {"id": self.identification, "addr": self.addr, "predecessor_id": self.predecessor_id}
+        if self.replicas > 1:
+            info["replicas"] = self.replica_addrs()
+        return info
+
+    def replica_addrs(self):
+        """Addresses of the successors holding replicas of our keys."""
+        return [addr for _, addr in self.successor_list[:self.replicas - 1]]
+
+    def store(self, key, value, address, msg_id, ttl=None):
+        """Store a key we own, replicate it and acknowledge the client.
+
+        With quorum consistency the ACK is held until a majority of the
+        replicas (this node included) stored the new version.
+        """
+        version = self.versions.get(key, 0) + 1
+        self.keep(key, value, version)
+        expires = self.set_ttl(key, ttl)
+        self.revoke_leases(key)
+        if self.leaving:
+            self.handoff.setdefault(self.successor_addr, []).append(key)
+        reply = {"method": "ACK", "msg_id": msg_id, "node": self.route_info()}
+        targets = self.replica_addrs()
+        token = None
+        if self.consistency == "quorum" and len(targets) >= self.quorum - 1 > 0:
+            token = self.wait_replicas(reply, address, self.quorum - 1)
+        else:
+            self.send(address, reply)
+        args = {"items": {key: (version, value)}, "token": token}
+        if expires is not None:
+            args["expires"] = {key: expires}
+        for target in targets:
+            self.send(target, {"method": "REPLICATE", "args": args})
+
+    def keep(self, key, value, version):
+        """Write a version of key to the keystore, adding the key to key_order if new."""
+        if key not in self.keystore:
+            insort(self.key_order, scan_order(key))
+        self.keystore.put(key, value, version)
+
+    def discard(self, key):
+        """Delete key from the keystore and key_order."""
+        del self.keystore[key]
+        del self.key_order[bisect_left(self.key_order, scan_order(key))]
+
+    def set_ttl(self, key, ttl):
+        """Schedule the expiry of key ttl seconds from now, or keep it forever if ttl is None.
+
+        Returns the expiry time (time.time()), None without ttl.
+        """
+        if ttl is None:
+            self.ttl.cancel(key)
+            return None
+        expires = time.time() + ttl
+        self.ttl.schedule(key, expires)
+        return expires
+
+    def expiries(self, keys):
+        """Expiry times of those of keys written with a TTL, sent along with their values."""
+        return {key: self.ttl.deadline(key) for key in keys if key in self.ttl}
+
+    def expired(self, key):
+        """Whether key has a TTL that ran out, even if the wheel did not drop it yet (its tick is coarser)."""
+        expires = self.ttl.deadline(key)
+        return expires is not None and expires <= time.time()
+
+    def replica_expired(self, key):
+        expires = self.replica_expires.get(key)
+        return expires is not None and expires <= time.time()
+
+    def expire_keys(self, keys=None):
+        """Drop the keys whose TTL ran out (the keys due on the timing wheel if None), and their replicas."""
+        if keys is None:
+            keys = self.ttl.advance(time.time())
+        else:
+            for key in keys:
+                self.ttl.cancel(key)
+        expired = {}
+        for key in keys:
+            if key in self.keystore:
+                expired[key] = self.versions.get(key, 0)
+                self.discard(key)
+                # copies of the last version are older than its expiry
+                self.revoke_leases(key, expired[key] + 1)
+        if not expired:
+            return
+        self.metrics.counters["expired"] += len(expired)
+        for target in self.replica_addrs():
+            self.send(target, {"method": "EXPIRE", "args": {"keys": expired}})
+
+    def expire_replicas(self, keys):
+        """Process EXPIRE message: drop the replicas of the keys expired by their owner, unless written since."""
+        for key, version in keys.items():
+            entry = self.replica_store.get(key)
+            if entry is not None and entry[0] <= version:
+                del self.replica_store[key]
+                self.replica_expires.pop(key, None)
+                self.metrics.counters["replicas_expired"] += 1
+
+    def wait_replicas(self, reply, address, needed, **state):
+        """Park reply until `needed` replicas answered; returns the token they must echo."""
+        token = next(self.tokens)
+        self.pending[token] = dict(state, reply=reply, address=address, needed=needed,
+                                   deadline=time.monotonic() + self.timeout)
+        return token
+
+    def quorum_read(self, key, reply, address):
+        """Answer a read with the newest version among a majority of the replicas."""
+        targets = self.replica_addrs()
+        needed = min(self.quorum - 1, len(targets))
+        token = self.wait_replicas(reply, address, needed, best=self.versions.get(key, 0))
+        for target in targets:
+            self.send(target, {"method": "REPLICA_GET", "args": {"key": key, "token": token}})
+
+    def replicate(self, args, addr):
+        """Process REPLICATE message: keep the newest version of each replicated key."""
+        expires = args.get("expires") or {}
+        for key, (version, value) in args["items"].items():
+            # an expired copy is older than any new write, whose version count started over
+            if key not in self.replica_store or self.replica_store[key][0] <= version or self.replica_expired(key):
+                self.replica_store[key] = (version, value)
+                if key in expires:
+                    self.replica_expires[key] = expires[key]
+                else:
+                    self.replica_expires.pop(key, None)
+        if args.get("token") is not None:
+            self.send(addr, {"method": "REPLICA_ACK", "args": {"token": args["token"]}})
+
+    def replica_answer(self, args):
+        """Process REPLICA_ACK/REPLICA_VALUE messages for a pending quorum operation."""
+        entry = self.pending.get(args["token"])
+        if entry is None:
+            return
+        if "version" in args and args["version"] > entry["best"]:
+            entry["best"] = args["version"]
+            entry["reply"]["method"] = "ACK"
+            entry["reply"]["args"] = args["value"]
+        entry["needed"] -= 1
+        if entry["needed"] <= 0:
+            del self.pending[args["token"]]
+            self.send(entry["address"], entry["reply"])
+
+    def expire_pending(self):
+        """Give up on quorum operations whose replicas did not answer in time."""
+        now = time.monotonic()
+        for token in [t for t, entry in self.pending.items() if entry["deadline"] < now]:
+            entry = self.pending.pop(token)
+            if "best" in entry:
+                # reads: the owner's copy is the newest we know of
+                self.send(entry["address"], entry["reply"])
+            else:
+                self.send(entry["address"], {"method": "NACK", "msg_id": entry["reply"]["msg_id"]})
+
+    def update_successor_list(self, nodes):
+        """Process SUCCESSOR_LIST_REP message: our successor followed by its successor list."""
+        successors = [(self.successor_id, self.successor_addr)]
+        for node_id, addr in nodes:
+            if node_id != self.identification and node_id not in [i for i, _ in successors]:
+                successors.append((node_id, tuple(addr)))
+        self.successor_list = successors[:max(self.replicas - 1, 2)]
+        self.repair_replicas()
+
+    def update_predecessor_list(self, nodes):
+        """Process the predecessor list our predecessor sends along with SUCCESSOR_LIST: itself, then its own list.
+
+        Our replicas are those of the keys owned by our `replicas` - 1
+        nearest predecessors, (replica_start, predecessor_id]. Replicas of
+        other keys are left over from an earlier ring (a node joined between
+        their owner and us, or we took over the range of a node): they are
+        dropped, and no longer served to reads.
+        """
+        if not nodes or nodes[0][0] != self.predecessor_id:
+            return
+        predecessors = []
+        start = None
+        for node_id, addr in nodes:
+            if node_id == self.identification:
+                start = node_id  # fewer nodes than replicas: we hold the replicas of every other node
+                break
+            predecessors.append((node_id, tuple(addr)))
+            if len(predecessors) == self.replicas:
+                start = node_id
+                break
+        self.predecessor_list = predecessors
+        if start != self.replica_start:
+            self.replica_start = start
+            self.drop_replicas()
+
+    def replica_holder(self, key_hash):
+        """Whether we are in the replica set of the owner of key_hash (False while predecessor_list is unknown)."""
+        return self.replica_start is not None and self.predecessor_id is not None \
+            and contains(self.replica_start, self.predecessor_id, key_hash)
+
+    def drop_replicas(self):
+        """Drop the replicas of keys whose owner no longer has us in its replica set."""
+        if self.replica_start is None:
+            return
+        keys = list(self.replica_store)
+        for key, key_hash in zip(keys, key_ids(keys)):
+            if not self.replica_holder(key_hash) and not contains(self.predecessor_id, self.identification, key_hash):
+                del self.replica_store[key]
+                self.replica_expires.pop(key, None)
+                self.metrics.counters["replicas_dropped"] += 1
+
+    def repair_replicas(self, batch_size=100):
+        """Push the whole keystore to successors that joined the replica set."""
+        targets = self.replica_addrs()
+        for target in [t for t in targets if t not in self.replicated_to]:
+            keys = list(self.keystore)
+            for i in range(0, len(keys), batch_size):
+                items = {key: (self.versions.get(key, 0), self.keystore[key]) for key in keys[i:i + batch_size]}
+                args = {"items": items, "token": None, "expires": self.expiries(items)}
+                self.send(target, {"method": "REPLICATE", "args": args})
+        self.replicated_to = targets
+
+    def promote_replicas(self):
+        """Take ownership of replicated keys that fall in our (grown) range, e.g. after our predecessor failed."""
+        for key in [k for k in self.replica_store if contains(self.predecessor_id, self.identification, key_id(k))]:
+            version, value = self.replica_store.pop(key)
+            expires = self.replica_expires.pop(key, None)
+            if self.versions.get(key, 0) < version:
+                self.keep(key, value, version)
+                if expires is None:
+                    self.ttl.cancel(key)
+                else:
+                    self.ttl.schedule(key, expires)
+
+    def successor_failed(self):
+        """Skip a successor that stopped answering, using the successor list."""
+        if len(self.successor_list) < 2:
+            return
+        self.logger.warning("Successor %s not answering, moving to %s", self.successor_id, self.successor_list[1][0])
+        # Our new successor still names it as its predecessor until it notices the failure too
+        self.suspected[self.successor_id] = time.monotonic()
+        self.successor_list.pop(0)
+        self.successor_id, self.successor_addr = self.successor_list[0]
+        self.finger_table.fill(self.successor_id, self.successor_addr)
+        self.successor_seen = time.monotonic()
+        self.membership_changed()
+
+    def start_handoff(self):
+        """Queue the keys outside our range, (predecessor_id, id], for our new predecessor.
+
+        Called when a node joined between our old predecessor and us. The keys
+        stay in our keystore (and are served to the new owner on request) until
+        the new owner acknowledges them.
+        """
+        moving = [key for key in self.keystore
+                  if not contains(self.predecessor_id, self.identification, key_id(key))]
+        self.logger.info("Handing %d keys over to %s", len(moving), self.predecessor_addr)
+        if moving:
+            self.handoff.setdefault(self.predecessor_addr, []).extend(moving)
+        else:
+            self.send(self.predecessor_addr, {"method": "MIGRATE_DONE"})
+
+    def migrate_step(self):
+        """Send the next MIGRATE batch, at most one batch in flight every migrate_interval seconds."""
+        now = time.monotonic()
+        if now - self.last_migrate < self.migrate_interval:
+            return
+        for token, (addr, keys, sent) in self.inflight.items():
+            if now - sent > self.timeout:
+                self.logger.debug("Resending MIGRATE %d to %s", token, addr)
+                self.send_migrate(token, addr, keys)
+                return
+        if self.inflight or not self.handoff:
+            return
+        addr, keys = next(iter(self.handoff.items()))
+        batch = [key for key in keys[:self.migrate_batch] if key in self.keystore]
+        del keys[:self.migrate_batch]
+        if not keys:
+            del self.handoff[addr]
+        if batch:
+            self.send_migrate(next(self.tokens), addr, batch)
+        elif addr not in self.handoff:
+            self.send(addr, {"method": "MIGRATE_DONE"})
+
+    def send_migrate(self, token, addr, keys):
+        items = {key: (self.versions.get(key, 0), self.keystore[key]) for key in keys if key in self.keystore}
+        self.send(addr, {"method": "MIGRATE", "args": {"items": items, "token": token, "expires": self.expiries(items)}})
+        self.inflight[token] = (addr, keys, time.monotonic())
+        self.last_migrate = time.monotonic()
+
+    def migrate(self, args, addr):
+        """Process MIGRATE message: take over keys from their previous owner.
+
+        A key written here since the handoff started is newer than the
+        migrated copy and is kept.
+        """
+        received = {}
+        expires = args.get("expires") or {}
+        for key, (version, value) in args["items"].items():
+            if key not in self.keystore:
+                self.keep(key, value, version)
+                if key in expires:
+                    self.ttl.schedule(key, expires[key])
+                received[key] = (version, value)
+        replicated = {"items": received, "token": None, "expires": {k: expires[k] for k in received if k in expires}}
+        for target in self.replica_addrs():
+            self.send(target, {"method": "REPLICATE", "args": replicated})
+        self.send(addr, {"method": "MIGRATE_ACK", "args": {"token": args["token"]}})
+
+    def migrate_ack(self, args):
+        """Process MIGRATE_ACK message: the new owner stored the batch, drop our copies."""
+        entry = self.inflight.pop(args["token"], None)
+        if entry is None:
+            return
+        addr, keys, _ = entry
+        for key in keys:
+            if key in self.keystore and (self.leaving
+                                         or not contains(self.predecessor_id, self.identification, key_id(key))):
+                self.discard(key)
+                self.ttl.cancel(key)
+        if addr not in self.handoff and addr not in [a for a, _, _ in self.inflight.values()]:
+            self.send(addr, {"method": "MIGRATE_DONE"})
+
+    def leave(self):
+        """Leave the DHT gracefully: hand every key to our successor, then unlink from the ring."""
+        self.leave_requested = True
+
+    def unlink(self):
+        """Tell our neighbours to point at each other and stop."""
+        args = {"predecessor_id": self.predecessor_id, "predecessor_addr": self.predecessor_addr,
+                "successor_id": self.successor_id, "successor_addr": self.successor_addr, "id": self.identification}
+        if self.successor_addr is not None:  # None: asked to leave before it even joined
+            self.send(self.successor_addr, {"method": "LEAVE", "args": args})
+        if self.predecessor_addr is not None:
+            self.send(self.predecessor_addr, {"method": "LEAVE", "args": args})
+        self.logger.info("Left the DHT")
+        self.done = True
+
+    def neighbour_left(self, args):
+        """Process LEAVE message from our successor or predecessor."""
+        self.membership_changed()
+        if args["id"] == self.predecessor_id:
+            self.predecessor_id = args["predecessor_id"]
+            self.predecessor_addr = args["predecessor_addr"]
+            self.predecessor_list, self.replica_start = [], None
+            self.predecessor_seen = time.monotonic()
+        if args["id"] == self.successor_id:
+            if args["successor_id"] == args["id"]:  # it was alone with us
+                self.successor_id, self.successor_addr = self.identification, self.addr
+            else:
+                self.successor_id, self.successor_addr = args["successor_id"], args["successor_addr"]
+            self.finger_table.fill(self.successor_id, self.successor_addr)
+            self.successor_list = [n for n in self.successor_list if n[0] != args["id"]]
+        self.logger.info(self)
+
+    def redirect(self, address, msg_id):
+        """Tell a client that sent a direct request that its cached route is stale."""
+        self.logger.debug("Redirect: %s", address)
+        self.send(address, {"method": "REDIRECT", "msg_id": msg_id, "node": self.route_info()})
+
+    def next_hop(self, key_hash):
+        """Address to forward key_hash to, or None if this node is responsible for it."""
+        if self.predecessor_id is not None and contains(self.predecessor_id, self.identification, key_hash):
+            return None
+        if contains(self.identification, self.successor_id, key_hash):
+            return self.successor_addr
+        return self.finger_table.find(key_hash)
+
+    def lookup(self, key_hash, count, address, msg_id):
+        """Answer one step of an iterative lookup (see DHTClient.IterativeLookup).
+
+        Replies with the owner of key_hash if it is us or our successor, else
+        with the count fingers closest to key_hash, for the client to ask next.
+        The first finger past key_hash is added too: when the node preceding
+        the key has failed, its successor is the one left to ask.
+        """
+        args = {"owner": None, "nodes": []}
+        if self.predecessor_id is not None and contains(self.predecessor_id, self.identification, key_hash):
+            args["owner"] = (self.identification, self.addr)
+        elif self.successor_id is not None and contains(self.identification, self.successor_id, key_hash):
+            args["owner"] = (self.successor_id, self.successor_addr)
+        elif self.successor_id is not None:
+            args["nodes"] = self.finger_table.closest(key_hash, count)
+        self.send(address, {"method": "LOOKUP_REP", "args": args, "msg_id": msg_id, "node": self.route_info()})
+
+    def put_many(self, items, address, msg_id, ttl=None, expires=None):
+        """Store a batch of values in the DHT.
+
+        Keys this node owns are stored and acknowledged straight to address,
+        the rest are split into one sub-batch per next hop. Replicas are
+        updated asynchronously, whatever the consistency level.
+
+        Parameters:
+        items: dict of key -> value
+        address: address where to send the ACK_MANY replies
+        msg_id: request id echoed in every reply
+        ttl: seconds after which every key of the batch expires, None keeps them
+        expires: dict of key -> expiry time (time.time()) of keys expiring at their own time, e.g. imported
+            from a snapshot (see snapshot.py)
+        """
+        self.logger.debug("Put many: %d keys", len(items))
+        expires = expires or {}
+        stored = []
+        batches = {}
+        for (key, value), key_hash in zip(items.items(), key_ids(items)):
+            hop = self.next_hop(key_hash)
+            if hop is None:
+                self.keep(key, value, self.versions.get(key, 0) + 1)
+                if key in expires:
+                    self.ttl.schedule(key, expires[key])
+                else:
+                    self.set_ttl(key, ttl)
+                self.revoke_leases(key)
+                stored.append(key)
+            else:
+                batches.setdefault(hop, {})[key] = value
+
+        for hop, batch in batches.items():
+            args = {"items": batch, "from": address, "msg_id": msg_id}
+            if ttl is not None:
+                args["ttl"] = ttl
+            if expires:
+                args["expires"] = {key: expires[key] for key in batch if key in expires}
+            self.send(hop, {"method": "PUT_MANY", "args": args})
+        if stored:
+            replicated = {key: (self.versions[key], self.keystore[key]) for key in stored}
+            args = {"items": replicated, "token": None, "expires": self.expiries(stored)}
+            for target in self.replica_addrs():
+                self.send(target, {"method": "REPLICATE", "args": args})
+            args = {"keys": stored, "node_id": self.identification, "node_addr": self.addr}
+            self.send(address, {"method": "ACK_MANY", "args": args, "msg_id": msg_id})
+
+    def get_many(self, keys, address, msg_id, handoff=False):
+        """Retrieve a batch of values from the DHT.
+
+        Parameters:
+        keys: list of keys
+        address: address where to send the ACK_MANY replies
+        msg_id: request id echoed in every reply
+        handoff: the new owner of keys asks us, its previous owner, while keys are still being handed over
+        """
+        self.logger.debug("Get many: %d keys", len(keys))
+        found = []
+        values = {}
+        batches = {}
+        not_handed_over = []
+        self.expire_keys([key for key in keys if self.expired(key)])
+        for key, key_hash in zip(keys, key_ids(keys)):
+            hop = self.next_hop(key_hash)
+            if hop is not None and not handoff:
+                batches.setdefault(hop, []).append(key)
+                continue
+            present = key in self.keystore
+            if hop is None and not present and self.receiving_from is not None:
+                not_handed_over.append(key)
+            else:
+                found.append(key)
+                if present:
+                    values[key] = self.keystore[key]
+
+        for hop, batch in batches.items():
+            self.send(hop, {"method": "GET_MANY", "args": {"keys": batch, "from": address, "msg_id": msg_id}})
+        if not_handed_over:
+            args = {"keys": not_handed_over, "from": address, "msg_id": msg_id, "handoff": True}
+            self.send(self.receiving_from, {"method": "GET_MANY", "args": args})
+        if found:
+            args = {"keys": found, "values": values, "node_id": self.identification, "node_addr": self.addr}
+            self.send(address, {"method": "ACK_MANY", "args": args, "msg_id": msg_id})
+
+    def scan(self, start, end, after, limit, address, msg_id):
+        """Answer one page of a range scan: the keys we store in [start, end) after `after`, in key order.
+
+        Parameters:
+        start, end: key range, None for unbounded
+        after: last key of the previous page, None for the first page
+        limit: largest number of items in the page
+        address: address where to send the SCAN_REP reply
+        msg_id: request id echoed in the reply
+        """
+        self.logger.debug("Scan: [%s, %s) after %s", start, end, after)
+        first = 0 if start is None else bisect_left(self.key_order, scan_order(start))
+        if after is not None:
+            first = max(first, bisect_right(self.key_order, scan_order(after)))
+        last = len(self.key_order) if end is None else bisect_left(self.key_order, scan_order(end))
+        page = []
+        while first < last and len(page) <= limit:
+            key = self.key_order[first][1]
+            if not self.expired(key):
+                page.append(key)
+            first += 1
+        args = {"items": [[key, self.keystore[key]] for key in page[:limit]], "more": len(page) > limit,
+                "node_id": self.identification, "node_addr": self.addr}
+        self.send(address, {"method": "SCAN_REP", "args": args, "msg_id": msg_id})
+
+    def export(self, token, offset, limit, address, msg_id):
+        """Answer one page of a snapshot of our keys, taken when the first page is asked for (token None).
+
+        The snapshot is a view of the keystore at that moment (see
+        storage.LogStorage.view: the keys are copied, the values are read a
+        page at a time), so the pages are consistent with each other
+        whatever is written meanwhile. It is dropped after its last page, or
+        once not paged through for 10 * timeout (expire_exports).
+
+        Parameters:
+        token: snapshot being paged through, None to take a new one
+        offset: items of the snapshot already received
+        limit: largest number of items in the page
+        address: address where to send the EXPORT_REP reply
+        msg_id: request id echoed in the reply
+        """
+        if token is None:
+            token = next(self.tokens)
+            view = self.keystore.view()
+            deadlines = self.expiries(view)
+            now = time.time()
+            keys = [key for key in view if deadlines.get(key, now + 1) > now]
+            self.exports[token] = [view, keys, deadlines, time.monotonic()]
+        entry = self.exports.get(token)
+        if entry is None:
+            self.send(address, {"method": "NACK", "msg_id": msg_id})
+            return
+        view, keys, deadlines, _ = entry
+        entry[3] = time.monotonic()
+        items = [[key, view[key], deadlines.get(key)] for key in keys[offset:offset + limit]]
+        more = offset + limit < len(keys)
+        args = {"token": token, "items": items, "more": more, "total": len(keys),
+                "node_id": self.identification, "node_addr": self.addr}
+        if not more:
+            del self.exports[token]
+            view.close()
+        self.send(address, {"method": "EXPORT_REP", "args": args, "msg_id": msg_id})
+
+    def expire_exports(self):
+        now = time.monotonic()
+        for token in [t for t, entry in self.exports.items() if now - entry[3] > 10 * self.timeout]:
+            self.exports.pop(token)[0].close()
+
+    def info(self):
+        """Ring pointers of this node, used by clients to build a view of the ring."""
+        return {
+            "id": self.identification,
+            "addr": self.addr,
+            "successor_id": self.successor_id,
+            "successor_addr": self.successor_addr,
+            "predecessor_id": self.predecessor_id,
+            "predecessor_addr": self.predecessor_addr,
+        }
+
+    def stats(self):
+        """Metrics of this node (see metrics.NodeMetrics) and the current state of its ring maintenance and storage."""
+        stats = self.metrics.snapshot()
+        stats.update(self.info())
+        stats.update({
+            "uptime": time.monotonic() - self.started,
+            "keys": len(self.keystore),
+            "replica_keys": len(self.replica_store),
+            "ttl_keys": len(self.ttl),
+            "handoff_keys": sum(len(keys) for keys in self.handoff.values()),
+            "pending": len(self.pending),
+            "stabilize_rounds": self.stabilize_rounds,
+            "stabilize_interval": self.interval,
+            "fingers_settled": self.fingers_settled,
+            # entries not confirmed by a SUCCESSOR_REP since the successor last changed
+            "stale_fingers": self.finger_table.confirmed.count(False),
+            "distinct_fingers": len(self.finger_table.distances),
+            "proximity_fingers": sum(1 for route, entry in zip(self.finger_table.routes, self.finger_table.finger_table)
+                                     if route != entry),
+        })
+        if self.read_cache is not None:
+            stats["cache"] = {"keys": len(self.read_cache), "hits": self.read_cache.hits,
+                              "misses": self.read_cache.misses, "leases": len(self.leases)}
+        return stats
+
+    def join_request(self):
+        """ JOIN_REQ message, sent to dht_address until JOIN_REP arrives."""
+        return {"method": "JOIN_REQ", "args": {"addr": self.addr, "id": self.identification}}
+
+    def joined(self, args):
+        """Process JOIN_REP message."""
+        self.successor_id = args["successor_id"]
+        self.successor_addr = args["successor_addr"]
+        self.finger_table.fill(self.successor_id, self.successor_addr)
+        # Our successor hands us the keys of our range once we NOTIFY it
+        self.receiving_from = self.successor_addr
+        self.receiving_since = time.monotonic()
+        self.inside_dht = True
+        self.membership_changed()
+        self.logger.info(self)
+
+    def dispatch(self, output, addr):
+        """ Handle a decoded message received from addr.
+
+        The codec only checks the encoding: a message missing arguments, or
+        with arguments of the wrong type, is logged and dropped instead of
+        stopping the node.
+        """
+        self.logger.debug("O: %s", output)
+        method = output["method"]
+        handler = self.handlers.get(method) if isinstance(method, str) else None
+        if handler is None:
+            self.logger.warning("Unknown method from %s: %s", addr, method)
+            return
+        start = time.perf_counter()
+        try:
+            handler(output, addr)
+        except MALFORMED as e:
+            self.logger.warning("Dropping malformed %s from %s: %r", method, addr, e)
+            self.metrics.counters["malformed"] += 1
+            return
+        self.metrics.handled(method, time.perf_counter() - start)
+
+    def on_join_rep(self, output):
+        """ Process JOIN_REP while joining; False if it is malformed."""
+        try:
+            self.joined(output["args"])
+        except MALFORMED as e:
+            self.logger.warning("Dropping malformed JOIN_REP: %r", e)
+            return False
+        return True
+
+    def on_put(self, output, addr):
+        args = output["args"]
+        self.put(args["key"], args["value"], args.get("from", addr), args.get("msg_id"), args.get("direct", False),
+                 args.get("hops", 0), args.get("ttl"))
+
+    def on_get(self, output, addr):
+        args = output["args"]
+        self.get(args["key"], args.get("from", addr), args.get("msg_id"), args.get("direct", False),
+                 args.get("handoff", False), args.get("cache"), args.get("hops", 0))
+
+    def on_put_many(self, output, addr):
+        args = output["args"]
+        self.put_many(args["items"], args.get("from", addr), args.get("msg_id"), args.get("ttl"), args.get("expires"))
+
+    def on_get_many(self, output, addr):
+        args = output["args"]
+        self.get_many(args["keys"], args.get("from", addr), args.get("msg_id"), args.get("handoff", False))
+
+    def on_scan(self, output, addr):
+        args = output["args"]
+        self.scan(args.get("start"), args.get("end"), args.get("after"), args["limit"], args.get("from", addr),
+                  args.get("msg_id"))
+
+    def on_export(self, output, addr):
+        args = output["args"]
+        self.export(args.get("token"), args.get("offset", 0), args["limit"], args.get("from", addr), args.get("msg_id"))
+
+    def on_cache(self, output, addr):
+        if self.read_cache is not None:
+            args = output["args"]
+            self.read_cache.fill(args["key"], args["version"], args["value"], args["lease"])
+
+    def on_invalidate(self, output, addr):
+        if self.read_cache is not None:
+            self.read_cache.invalidate(output["args"]["key"], output["args"]["version"])
+
+    def on_stats(self, output, addr):
+        self.send(addr, {"method": "STATS_REP", "args": self.stats(), "msg_id": output.get("args", {}).get("msg_id")})
+
+    def on_lookup(self, output, addr):
+        args = output["args"]
+        self.lookup(args["id"], args.get("count", 3), addr, args.get("msg_id"))
+
+    def on_migrate_done(self, output, addr):
+        self.receiving_from = None
+
+    def on_successor_list(self, output, addr):
+        self.update_predecessor_list((output.get("args") or {}).get("predecessors"))
+        self.send(addr, {"method": "SUCCESSOR_LIST_REP", "args": {"nodes": self.successor_list}})
+
+    def on_replica_get(self, output, addr):
+        key = output["args"]["key"]
+        version, value = (0, None) if self.replica_expired(key) else self.replica_store.get(key, (0, None))
+        args = {"token": output["args"]["token"], "version": version, "value": value}
+        self.send(addr, {"method": "REPLICA_VALUE", "args": args})
+
+    def on_info(self, output, addr):
+        self.send(addr, {"method": "INFO_REP", "args": self.info(), "msg_id": output.get("args", {}).get("msg_id")})
+
+    def on_predecessor(self, output, addr):
+        # Reply with predecessor id (and its address, the one it advertised)
+        self.send(addr, {"method": "STABILIZE", "args": self.predecessor_id, "addr": self.predecessor_addr})
+
+    def on_successor_rep(self, output, addr):
+        idx = self.finger_table.getIdxFromId(output["args"]["req_id"])
+        node_id = output["args"]["successor_id"]
+        node_addr = output["args"]["successor_addr"]
+
+        if self.finger_table.update_run(idx, node_id, node_addr): #update finger table
+            self.ring_changed = True
+            self.finger_pass_changed = True
+
+    def tick(self):
+        """ Housekeeping after every message and on wakeup(): leaving, key handoff, key expiry, stabilize timer."""
+        if self.leave_requested and not self.leaving:
+            self.leaving = True
+            if self.keystore and self.successor_id not in (self.identification, None):
+                self.handoff.setdefault(self.successor_addr, []).extend(self.keystore)
+        if self.outbox:
+            self.flush_batches(None if self.leaving else time.monotonic())
+        self.expire_keys()
+        if self.handoff or self.inflight:
+            self.migrate_step()
+        elif self.leaving:
+            self.unlink()
+            return
+
+        # stabilize timer, independent of how busy the node is
+        if time.monotonic() >= self.next_stabilize:
+            self.stabilize_round()
+
+    def wakeup(self):
+        """ Time (time.monotonic) tick() must run at, at the latest."""
+        # not the outbox: transports flush it as soon as they are idle
+        at = self.next_stabilize
+        due = self.ttl.next_due()
+        if due is not None:
+            at = min(at, time.monotonic() + max(due - time.time(), 0))
+        if self.handoff or self.inflight or self.leaving:
+            return min(at, time.monotonic() + self.migrate_interval)
+        return at
 
     def __str__(self):
         return "Node ID: {}; DHT: {}; Successor: {}; Predecessor: {}; FingerTable: {}".format(
@@ -329,4 +1587,145 @@ class DHTNode(threading.Thread):
         )
 
     def __repr__(self):
-        return self.__str__()
\ No newline at end of file
+        return self.__str__()
+
+
+class DHTNode(ChordNode, threading.Thread):
+    """ DHT Node Agent, running in its own thread with a blocking socket. """
+
+    def __init__(self, address, dht_address=None, timeout=3, **kwargs):
+        """Constructor, see ChordNode for the parameters."""
+        threading.Thread.__init__(self)
+        ChordNode.__init__(self, address, dht_address, timeout, **kwargs)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # Large messages go over TCP connections, accepted on the same port
+        self.streams = Streams(address[1], self.codec.max_message, logger=self.logger, fallback=self.send_datagrams,
+                               host=address[0])
+
+    def sendto(self, payload, address):
+        self.socket.sendto(payload, address)
+
+    def stream(self, address, body):
+        return self.streams.send(address, body)
+
+    def recv(self, timeout=None):
+        """ Retrieve the messages received within timeout seconds (default self.timeout), as (msg, addr) pairs."""
+        messages, readable = self.streams.poll(self.timeout if timeout is None else max(timeout, 0))
+        if readable:
+            payload, addr = self.socket.recvfrom(MAX_DATAGRAM)
+            output = self.decode(payload, addr) if payload else None
+            if output is not None:
+                messages.append((output, addr))
+        return messages
+
+    def run(self):
+        try:
+            self.socket.bind(self.addr)
+            self.streams.listen(self.addr)
+            self.streams.watch(self.socket)
+
+            # Loop untiln joining the DHT
+            while not self.inside_dht:
+                self.send(self.dht_address, self.join_request())
+                for output, addr in self.recv(self.timeout):
+                    self.logger.debug("O: %s", output)
+                    if output["method"] == "JOIN_REP":
+                        self.on_join_rep(output)
+
+            while not self.done:
+                # Wake up for the next stabilize round, or sooner to keep a key handoff going
+                messages = self.recv(0 if self.outbox else self.wakeup() - time.monotonic())
+                if not messages and self.outbox:
+                    # nothing else to handle: the forwarded requests waiting to be batched go now
+                    self.flush_batches()
+                    continue
+                for output, addr in messages:
+                    self.dispatch(output, addr)
+                self.tick()
+        finally:
+            # free the address, so a node can be started on it again (e.g. restarted on its LogStorage)
+            self.keystore.close()
+            self.streams.close()
+            self.socket.close()
+
+
+def vnode_count(vnodes, capacity=1.0):
+    """Ring positions of a physical node: vnodes per unit of capacity, at least one."""
+    return max(1, round(vnodes * capacity))
+
+
+def vnode_ids(address, count):
+    """Distinct ring positions of the count virtual nodes of the physical node at address.
+
+    The first one is the usual dht_hash(address), so a single virtual node is
+    placed exactly like a plain DHTNode.
+    """
+    ids = [dht_hash(address.__str__())]
+    i = 1
+    while len(ids) < count:
+        identification = dht_hash("{}#{}".format(address, i))
+        if identification not in ids:
+            ids.append(identification)
+        i += 1
+    return ids
+
+
+class DHTHost:
+    """Physical node owning several ring positions.
+
+    Each virtual node is a DHTNode thread with its own finger table, stabilize
+    rounds and keystore, listening on consecutive ports from address. The
+    number of virtual nodes is vnodes weighted by capacity, so stronger
+    machines take a larger share of the keys.
+    """
+
+    def __init__(self, address, dht_address=None, vnodes=1, capacity=1.0, data_dir=None, **kwargs):
+        """Constructor
+
+        Parameters:
+            address: (host, port) of the first virtual node, the others use port + 1, port + 2, ...
+            dht_address: address of a node in the DHT (None starts a new DHT)
+            vnodes: virtual nodes per unit of capacity
+            capacity: relative capacity of this machine
+            data_dir: keep the keys of every virtual node on disk, in a directory per node under data_dir
+            kwargs: passed on to every DHTNode
+        """
+        host, port = address
+        self.addr = address
+        self.vnodes = []
+        for i, identification in enumerate(vnode_ids(address, vnode_count(vnodes, capacity))):
+            # Without a DHT to join, the first virtual node starts one and the others join it
+            entry = dht_address if dht_address is not None or i == 0 else address
+            self.vnodes.append(DHTNode((host, port + i), entry, identification=identification,
+                                       storage=open_storage(data_dir, (host, port + i)), **kwargs))
+
+    @property
+    def keystore(self):
+        """Keys stored by all the virtual nodes."""
+        keys = {}
+        for node in self.vnodes:
+            keys.update(node.keystore)
+        return keys
+
+    def start(self, delay=0.2):
+        for i, node in enumerate(self.vnodes):
+            if i > 0:
+                # Concurrent joins settle through stabilize, but spacing them (like DHT.py) is faster
+                time.sleep(delay)
+            node.start()
+
+    def leave(self):
+        """Gracefully remove every virtual node from the DHT."""
+        for node in self.vnodes:
+            node.leave()
+
+    def stop(self):
+        for node in self.vnodes:
+            node.done = True
+
+    def join(self, timeout=None):
+        for node in self.vnodes:
+            node.join(timeout)
+
+    def __str__(self):
+        return "Host {}: {}".format(self.addr, [node.identification for node in self.vnodes])
\ No newline at end of file
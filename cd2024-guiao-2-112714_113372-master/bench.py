@@ -0,0 +1,367 @@
+""" Benchmarks for the DHT.
+
+    balance     key distribution without and with virtual nodes
+    ring        join convergence, PUT/GET throughput and latency, and lookup
+                hops (optionally under churn) of an N node ring on localhost
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import time
+from collections import Counter
+from DHTAsyncClient import AsyncDHTClient
+from DHTAsyncNode import AsyncDHTNode, start_ring
+from DHTClient import RingView
+from DHTNode import vnode_count, vnode_ids
+from metrics import HOP_BUCKETS
+import utils
+from utils import key_ids
+
+
+def key_distribution(hosts, vnodes=1, capacities=(1.0,), keys=10000):
+    """ Number of keys (out of `keys` synthetic ones) owned by each physical host.
+
+    Hosts are placed the way DHT.py starts them: from port 5000, each taking a
+    block of consecutive ports, one per virtual node.
+    """
+    nodes = []
+    port = 5000
+    for host in range(hosts):
+        address = ("localhost", port)
+        count = vnode_count(vnodes, capacities[host % len(capacities)])
+        nodes += [(node_id, host) for node_id in vnode_ids(address, count)]
+        port += count
+    ring = RingView(nodes)
+    counts = [0] * hosts
+    for key_hash in key_ids("key-{}".format(i) for i in range(keys)):
+        counts[ring.owner(key_hash)] += 1
+    return counts
+
+
+def distribution_report(counts, capacities=(1.0,)):
+    """ Spread of counts, also relative to each host's capacity (1.0 is a perfect balance)."""
+    weights = [capacities[i % len(capacities)] for i in range(len(counts))]
+    share = [count / sum(counts) * sum(weights) / weight for count, weight in zip(counts, weights)]
+    return {
+        "keys_per_host": counts,
+        "mean": statistics.mean(counts),
+        "variance": statistics.pvariance(counts),
+        "stddev": statistics.pstdev(counts),
+        "min": min(counts),
+        "max": max(counts),
+        "max_load_vs_capacity": max(share),
+    }
+
+
+def balance(args):
+    utils.configure(args.bits, args.hash)
+    capacities = [float(c) for c in args.capacity.split(",")]
+    before = key_distribution(args.nodes, 1, capacities=(1.0,), keys=args.keys)
+    after = key_distribution(args.nodes, args.vnodes, capacities, args.keys)
+    return {
+        "nodes": args.nodes,
+        "keys": args.keys,
+        "vnodes": args.vnodes,
+        "capacities": capacities,
+        "ring_bits": args.bits,
+        "hash": args.hash,
+        "before": distribution_report(before),
+        "after": distribution_report(after, capacities),
+    }
+
+
+def converged(infos, count=None):
+    """ Whether the successor and predecessor pointers of the nodes (INFO dicts) form the sorted ring of their ids.
+
+    False without infos, or with fewer than the count nodes the ring should have.
+    """
+    if not infos or count is not None and len(infos) != count:
+        return False
+    ids = sorted(info["id"] for info in infos)
+    position = {node_id: i for i, node_id in enumerate(ids)}
+    return len(position) == len(infos) and all(
+        info["successor_id"] == ids[(position[info["id"]] + 1) % len(ids)]
+        and info["predecessor_id"] == ids[position[info["id"]] - 1] for info in infos)
+
+
+def latency_report(latencies, errors, seconds):
+    """ Throughput and latency percentiles (in ms) of the operations that succeeded."""
+    latencies = sorted(latencies)
+
+    def percentile(p):
+        return 1000 * latencies[min(len(latencies) - 1, int(p / 100 * len(latencies)))] if latencies else None
+
+    return {
+        "ops": len(latencies) + errors,
+        "errors": errors,
+        "seconds": seconds,
+        "ops_per_s": len(latencies) / seconds if seconds else None,
+        "latency_ms": {
+            "mean": 1000 * statistics.mean(latencies) if latencies else None,
+            "p50": percentile(50),
+            "p90": percentile(90),
+            "p99": percentile(99),
+            "max": 1000 * latencies[-1] if latencies else None,
+        },
+    }
+
+
+def hops_report(before, after):
+    """ Distribution of the lookup hops counted by the nodes between two ring_counters() snapshots."""
+    hops = after["hops"] - before["hops"]
+    samples = sorted(hops.elements())
+
+    def percentile(p):
+        return samples[min(len(samples) - 1, int(p / 100 * len(samples)))] if samples else None
+
+    return {
+        "lookups": len(samples),
+        "mean": statistics.mean(samples) if samples else None,
+        "p50": percentile(50),
+        "p90": percentile(90),
+        "p99": percentile(99),
+        "max": samples[-1] if samples else None,
+        "histogram": {str(h): count for h, count in sorted(hops.items())},
+        "forwarded_to_successor": after["forwarded_to_successor"] - before["forwarded_to_successor"],
+        "forwarded_to_finger": after["forwarded_to_finger"] - before["forwarded_to_finger"],
+    }
+
+
+class LocalRing:
+    """ AsyncDHTNode ring running on the benchmark's own event loop. """
+
+    def __init__(self, host, port, timeout, **options):
+        self.host = host
+        self.next_port = port
+        self.timeout = timeout
+        self.options = options  # AsyncDHTNode parameters
+        self.nodes = []  # running nodes
+        self.stopped = []  # nodes that left, still counted in ring_counters
+        self.joined = 0
+
+    async def start(self, count):
+        ports = list(range(self.next_port, self.next_port + count))
+        self.next_port += count
+        self.nodes = await start_ring(self.host, ports, self.timeout, **self.options)
+
+    async def infos(self):
+        return [node.info() for node in self.nodes]
+
+    def addresses(self):
+        return [node.addr for node in self.nodes]
+
+    async def counters(self):
+        return ring_counters([node.metrics.snapshot() for node in self.nodes + self.stopped])
+
+    async def churn(self, rate):
+        """ Replace a random node (not the entry node) by a new one, rate times a second from now, until cancelled."""
+        while True:
+            if len(self.nodes) > 2:
+                node = random.choice(self.nodes[1:])
+                self.nodes.remove(node)
+                self.stopped.append(node)
+                node.leave()
+            node = AsyncDHTNode((self.host, self.next_port), self.nodes[0].addr, self.timeout, **self.options)
+            self.next_port += 1
+            # counted (and stopped by close) even if cancelled while starting
+            self.nodes.append(node)
+            self.joined += 1
+            await node.start()
+            await asyncio.sleep(1 / rate)
+
+    def close(self):
+        for node in self.nodes:
+            node.stop()
+
+
+class ProcessRing:
+    """ Ring run by `DHT.py --asyncio` in a child process, observed through INFO and STATS queries. """
+
+    def __init__(self, client, timeout, bits, algorithm, batch_window=None):
+        self.client = client
+        self.timeout = timeout
+        self.bits = bits
+        self.algorithm = algorithm  # dht_hash function, the client's and the nodes' must match
+        self.batch_window = batch_window
+        self.process = None
+        self.ports = []
+
+    async def start(self, count):
+        self.ports = list(range(5000, 5000 + count))
+        self.process = subprocess.Popen(
+            [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "DHT.py"), "--asyncio", "--nodes", str(count), "--timeout", str(self.timeout),
+             "--bits", str(self.bits), "--hash", self.algorithm, "--log-level", "WARNING"]
+            + ([] if self.batch_window is None else ["--batch-window", str(self.batch_window)]),
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def addresses(self):
+        return [("localhost", port) for port in self.ports]
+
+    async def query(self, method):
+        replies = await asyncio.gather(
+            *(self.client.request({"method": method}, address, timeout=0.5, retries=2) for address in self.addresses()),
+            return_exceptions=True)
+        return [reply["args"] for reply in replies if isinstance(reply, dict)]
+
+    async def infos(self):
+        infos = await self.query("INFO")
+        return infos if len(infos) == len(self.ports) else []
+
+    async def counters(self):
+        return ring_counters(await self.query("STATS"))
+
+    def close(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.wait()
+
+
+def ring_counters(snapshots):
+    """ Lookup hops and forwarding counters summed over the metrics (NodeMetrics.snapshot or STATS) of nodes."""
+    totals = {"hops": Counter(), "forwarded_to_successor": 0, "forwarded_to_finger": 0}
+    for snapshot in snapshots:
+        for bound, count in snapshot["hops"]["buckets"]:
+            totals["hops"][bound if bound is not None else HOP_BUCKETS[-1] + 1] += count
+        for counter in ("forwarded_to_successor", "forwarded_to_finger"):
+            totals[counter] += snapshot["counters"].get(counter, 0)
+    return totals
+
+
+async def run_ops(ops, concurrency):
+    """ Run the coroutine functions in ops, concurrency at a time; returns (latencies, errors, seconds)."""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = 0
+
+    async def run(op):
+        nonlocal errors
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                ok = await op()
+            except asyncio.TimeoutError:
+                ok = False
+            if ok:
+                latencies.append(time.perf_counter() - start)
+            else:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(run(op) for op in ops))
+    return latencies, errors, time.perf_counter() - start
+
+
+async def ring_benchmark(nodes=5, keys=1000, concurrency=50, timeout=1, in_process=True, port=7000, churn=0,
+                         direct=False, settle=120, lookup="recursive", alpha=3, batch_window=None):
+    """ Start a ring of `nodes` nodes, wait for it to converge, then PUT and GET `keys` keys.
+
+    Requests go to a random node (routed through the ring, so the nodes
+    count their hops) unless direct, where the client caches routes and
+    sends them straight to the owners. With lookup="iterative" the client
+    looks up every owner itself (alpha queries in parallel) from a random
+    node instead, and the owners count the lookup steps as hops. With churn,
+    a random node leaves and a new one joins `churn` times a second during
+    the GETs. batch_window sets the nodes' batching of forwarded requests
+    (None: their default).
+    """
+    loop = asyncio.get_running_loop()
+    client = await AsyncDHTClient.connect(("localhost", port), timeout=max(timeout, 1), alpha=alpha)
+    options = {} if batch_window is None else {"batch_window": batch_window}
+    ring = LocalRing("localhost", port, timeout, **options) if in_process \
+        else ProcessRing(client, timeout, utils.ring_bits(), utils.hash_algorithm(), **options)
+    report = {"nodes": nodes, "in_process": in_process, "ring_bits": utils.ring_bits(), "timeout": timeout,
+              "keys": keys, "concurrency": concurrency, "direct": direct, "lookup": lookup, "batch_window": batch_window}
+    try:
+        start = loop.time()
+        await ring.start(nodes)
+        while not converged(await ring.infos(), nodes) and loop.time() - start < settle:
+            await asyncio.sleep(0.1)
+        report["join"] = {"converged": converged(await ring.infos(), nodes), "seconds": loop.time() - start}
+        client.dht_addr = ring.addresses()[0]
+
+        def request(method, args, check):
+            async def op():
+                if direct:
+                    return check(await client.routed_request(args["key"], {"method": method, "args": args},
+                                                             read=method == "GET"))
+                address = random.choice(ring.addresses())
+                if lookup == "iterative":
+                    out = await client.iterative_request(args["key"], {"method": method, "args": args}, address)
+                    if out is not None:
+                        return check(out)
+                return check(await client.request({"method": method, "args": args}, address))
+            return op
+
+        items = {"bench-{}".format(i): i for i in range(keys)}
+        before = await ring.counters()
+        report["put"] = latency_report(*await run_ops(
+            [request("PUT", {"key": key, "value": value}, lambda out: out["method"] == "ACK")
+             for key, value in items.items()], concurrency))
+        after = await ring.counters()
+        report["put"]["hops"] = hops_report(before, after)
+
+        churning = asyncio.ensure_future(ring.churn(churn)) if churn and in_process else None
+        report["get"] = latency_report(*await run_ops(
+            [request("GET", {"key": key}, lambda out, value=value: out["args"] == value)
+             for key, value in items.items()], concurrency))
+        if churning is not None:
+            churning.cancel()
+            report["churn"] = {"rate": churn, "left": len(ring.stopped), "joined": ring.joined}
+        report["get"]["hops"] = hops_report(after, await ring.counters())
+    finally:
+        client.close()
+        ring.close()
+    return report
+
+
+def ring(args):
+    utils.configure(args.bits, args.hash)
+    if args.churn and not args.in_process:
+        raise SystemExit("--churn needs --in-process")
+    return asyncio.run(ring_benchmark(args.nodes, args.keys, args.concurrency, args.timeout, args.in_process,
+                                      args.port, args.churn, args.direct, args.settle, args.lookup, args.alpha,
+                                      args.batch_window))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="DHT benchmarks")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+    parser_balance = subparsers.add_parser("balance", help="key distribution without and with virtual nodes")
+    parser_balance.add_argument("--nodes", type=int, default=5)
+    parser_balance.add_argument("--vnodes", type=int, default=16)
+    parser_balance.add_argument("--capacity", type=str, default="1", help="comma separated capacities, cycled over the nodes")
+    parser_balance.add_argument("--keys", type=int, default=10000)
+    parser_balance.add_argument("--bits", type=int, default=10)
+    parser_balance.add_argument("--hash", choices=["fnv", "blake2b"], default="fnv")
+    parser_balance.set_defaults(run=balance)
+    parser_ring = subparsers.add_parser("ring", help="convergence, throughput, latency and hops of a ring")
+    parser_ring.add_argument("--nodes", type=int, default=5)
+    parser_ring.add_argument("--keys", type=int, default=1000)
+    parser_ring.add_argument("--concurrency", type=int, default=50, help="requests in flight")
+    parser_ring.add_argument("--timeout", type=int, default=1, help="node timeout (stabilize interval)")
+    parser_ring.add_argument("--in-process", default=False, action="store_true",
+                             help="run the nodes on this process' event loop instead of DHT.py --asyncio")
+    parser_ring.add_argument("--port", type=int, default=7000, help="first port of an --in-process ring")
+    parser_ring.add_argument("--churn", type=float, default=0, help="nodes replaced per second during the GETs")
+    parser_ring.add_argument("--direct", default=False, action="store_true",
+                             help="send requests straight to the owners (client routing cache)")
+    parser_ring.add_argument("--lookup", choices=["recursive", "iterative"], default="recursive",
+                             help="routing of the requests (ignored with --direct)")
+    parser_ring.add_argument("--alpha", type=int, default=3, help="parallel queries of iterative lookups")
+    parser_ring.add_argument("--batch-window", type=float, default=None,
+                             help="seconds forwarded requests may wait to be batched (0 disables, default: the nodes')")
+    parser_ring.add_argument("--settle", type=float, default=120, help="longest wait for the ring to converge")
+    parser_ring.add_argument("--bits", type=int, default=32)
+    parser_ring.add_argument("--hash", choices=["fnv", "blake2b"], default="fnv")
+    parser_ring.set_defaults(run=ring)
+    args = parser.parse_args()
+    print(json.dumps(args.run(args), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+""" Read cache for hot keys on the nodes routing GET requests. """
+import time
+from collections import OrderedDict
+
+
+class ReadCache:
+    """ LRU cache of values leased by their owner, with TinyLFU style admission.
+
+    A node forwarding GETs counts them per key (counts are halved every
+    `10 * size` requests, so only recent popularity counts). Once a key was
+    forwarded `admit` times, the node asks the owner for a copy (see
+    ChordNode.get). The owner sends it with its version and a lease, and
+    sends an INVALIDATE with the new version when the key is written before
+    the lease ends. An invalidated key is remembered until the lease ends,
+    so that a copy of an older version arriving late is not cached.
+    """
+
+    def __init__(self, size=256, lease=3, admit=2):
+        """Constructor
+
+        Parameters:
+            size: largest number of cached keys
+            lease: seconds a cached value may be served without hearing from its owner
+            admit: forwarded GETs of a key before asking its owner for a copy
+        """
+        self.size = size
+        self.lease = lease
+        self.admit = admit
+        self.entries = OrderedDict()  # key -> [version, value, expires, valid], least recently used first
+        self.counts = {}  # key -> recent number of forwarded GETs
+        self.seen = 0
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, key):
+        """ (True, value) if key is cached and its lease is still running, else (False, None)."""
+        entry = self.entries.get(key)
+        if entry is None or not entry[3] or entry[2] < time.monotonic():
+            self.misses += 1
+            return False, None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return True, entry[1]
+
+    def record(self, key):
+        """ Count a forwarded GET of key; returns whether key is hot enough to be cached."""
+        self.counts[key] = self.counts.get(key, 0) + 1
+        self.seen += 1
+        if self.seen >= 10 * self.size:
+            # age the counts: halve them and forget the keys that were not requested lately
+            self.counts = {k: c // 2 for k, c in self.counts.items() if c > 1}
+            self.seen = 0
+        return self.counts.get(key, 0) >= self.admit
+
+    def fill(self, key, version, value, lease=None):
+        """ Cache value of key at version, unless a newer version was seen."""
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] > version:
+            return
+        expires = time.monotonic() + (self.lease if lease is None else min(lease, self.lease))
+        self.entries[key] = [version, value, expires, True]
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, key, version):
+        """ Version of key was written: drop older copies (and refuse them until the lease ends)."""
+        entry = self.entries.get(key)
+        if entry is None:
+            self.entries[key] = [version, None, time.monotonic() + self.lease, False]
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        elif entry[0] < version:
+            entry[:] = [version, None, max(entry[2], time.monotonic() + self.lease), False]
+
+    def __len__(self):
+        return sum(1 for entry in self.entries.values() if entry[3])
@@ -0,0 +1,482 @@
+""" Binary wire format for DHT messages.
+
+Replaces pickle on the wire: decoding only ever builds None, bool, int, float,
+str, bytes, list, tuple and dict objects, so a malicious datagram cannot run
+code, and every length is checked against the data actually received.
+
+Datagram layout (big endian):
+
+    version:u8 flags:u8 length:u32 body            (flags == 0, whole message)
+    version:u8 flags:u8 length:u32 transfer:u64 index:u16 count:u16 part
+                                                   (flags == CHUNK, `length` is the full body size)
+
+Over TCP (see stream.py) messages are sent back to back as whole message
+frames (flags == 0), the length prefix delimiting them.
+
+Body: method:u8 (index in METHODS, 0 followed by a str value for unknown
+methods), then the remaining message fields encoded as a dict value.
+
+Ring maintenance messages (JOIN_REQ, SUCCESSOR, NOTIFY, ...) have a fixed
+shape and make up most of the traffic; they use a compact layout instead,
+flagged by the COMPACT bit of the method byte: the ids as u64, then the port
+(u16) and host length (u8) of their address in one struct, followed by the
+utf-8 host name. Messages that do not match their method's schema (e.g. an
+id that does not fit in 64 bits) fall back to the generic layout.
+
+Values are a one byte tag followed by:
+    N/T/F       nothing (None, True, False)
+    i           int64
+    I           u16 length + signed big endian bytes (ints outside int64)
+    f           float64
+    s/b         u32 length + utf-8/raw bytes
+    l/t         u32 count + items (list/tuple)
+    d           u32 count + key, value pairs
+"""
+import itertools
+import os
+import struct
+import time
+
+VERSION = 1
+CHUNK = 1
+
+# Largest UDP payload
+MAX_DATAGRAM = 65507
+# Largest message accepted, whole or reassembled from chunks
+MAX_MESSAGE = 16 * 1024 * 1024
+
+METHODS = (
+    None,
+    "JOIN_REQ",
+    "JOIN_REP",
+    "SUCCESSOR",
+    "SUCCESSOR_REP",
+    "PREDECESSOR",
+    "STABILIZE",
+    "NOTIFY",
+    "PUT",
+    "GET",
+    "ACK",
+    "PUT_MANY",
+    "GET_MANY",
+    "ACK_MANY",
+    "INFO",
+    "INFO_REP",
+    "REDIRECT",
+    "SUCCESSOR_LIST",
+    "SUCCESSOR_LIST_REP",
+    "REPLICATE",
+    "REPLICA_ACK",
+    "REPLICA_GET",
+    "REPLICA_VALUE",
+    "NACK",
+    "MIGRATE",
+    "MIGRATE_ACK",
+    "MIGRATE_DONE",
+    "LEAVE",
+    "SCAN",
+    "SCAN_REP",
+    "CACHE",
+    "INVALIDATE",
+    "STATS",
+    "STATS_REP",
+    "STREAM",
+    "LOOKUP",
+    "LOOKUP_REP",
+    "PING",
+    "PONG",
+    "BATCH",
+    "EXPIRE",
+    "NOT_FOUND",
+    "EXPORT",
+    "EXPORT_REP",
+)
+METHOD_CODES = {method: code for code, method in enumerate(METHODS) if method is not None}
+COMPACT = 0x80
+
+# Fixed shape of the args of ring maintenance messages: ids and one (host, port) address (*_addr, addr or from)
+SCHEMAS = {
+    "JOIN_REQ": ("addr", "id"),
+    "JOIN_REP": ("successor_id", "successor_addr"),
+    "SUCCESSOR": ("id", "from"),
+    "SUCCESSOR_REP": ("req_id", "successor_id", "successor_addr"),
+    "NOTIFY": ("predecessor_id", "predecessor_addr"),
+}
+
+HEADER = struct.Struct(">BBI")
+CHUNK_HEADER = struct.Struct(">BBIQHH")
+U8 = struct.Struct(">B")
+U16 = struct.Struct(">H")
+U32 = struct.Struct(">I")
+I64 = struct.Struct(">q")
+F64 = struct.Struct(">d")
+
+U64_MAX = 2 ** 64 - 1
+MAX_DEPTH = 32
+INT64_MIN = -(2 ** 63)
+INT64_MAX = 2 ** 63 - 1
+
+
+class CodecError(ValueError):
+    """ Raised for malformed, oversized or unsupported data."""
+
+
+def _encode_value(value, out, depth=0):
+    if depth > MAX_DEPTH:
+        raise CodecError("value nested too deeply")
+    kind = type(value)
+    if value is None:
+        out += b"N"
+    elif kind is bool:
+        out += b"T" if value else b"F"
+    elif kind is int:
+        if INT64_MIN <= value <= INT64_MAX:
+            out += b"i"
+            out += I64.pack(value)
+        else:
+            raw = value.to_bytes((value.bit_length() + 8) // 8, "big", signed=True)
+            out += b"I"
+            out += U16.pack(len(raw))
+            out += raw
+    elif kind is float:
+        out += b"f"
+        out += F64.pack(value)
+    elif kind is str:
+        raw = value.encode("utf-8")
+        out += b"s"
+        out += U32.pack(len(raw))
+        out += raw
+    elif kind is bytes or kind is bytearray or kind is memoryview:
+        out += b"b"
+        out += U32.pack(len(value))
+        out += value
+    elif kind is list or kind is tuple:
+        out += b"l" if kind is list else b"t"
+        out += U32.pack(len(value))
+        for item in value:
+            _encode_value(item, out, depth + 1)
+    elif kind is dict:
+        out += b"d"
+        out += U32.pack(len(value))
+        for key, item in value.items():
+            _encode_value(key, out, depth + 1)
+            _encode_value(item, out, depth + 1)
+    else:
+        raise CodecError("cannot encode {}".format(kind.__name__))
+
+
+def _decode_value(data, pos, depth=0):
+    """ Decode the value starting at data[pos]; returns (value, next position)."""
+    if depth > MAX_DEPTH:
+        raise CodecError("value nested too deeply")
+    try:
+        tag = data[pos]
+        pos += 1
+        if tag == 0x4E:  # N
+            return None, pos
+        if tag == 0x54:  # T
+            return True, pos
+        if tag == 0x46:  # F
+            return False, pos
+        if tag == 0x69:  # i
+            return I64.unpack_from(data, pos)[0], pos + 8
+        if tag == 0x66:  # f
+            return F64.unpack_from(data, pos)[0], pos + 8
+        if tag == 0x73 or tag == 0x62:  # s, b
+            size = U32.unpack_from(data, pos)[0]
+            pos += 4
+            end = pos + size
+            if end > len(data):
+                raise CodecError("truncated data")
+            raw = bytes(data[pos:end])
+            return (raw.decode("utf-8") if tag == 0x73 else raw), end
+        if tag == 0x6C or tag == 0x74:  # l, t
+            count = U32.unpack_from(data, pos)[0]
+            pos += 4
+            if count > len(data) - pos:  # every item takes at least one byte
+                raise CodecError("truncated data")
+            items = []
+            for _ in range(count):
+                item, pos = _decode_value(data, pos, depth + 1)
+                items.append(item)
+            return (items if tag == 0x6C else tuple(items)), pos
+        if tag == 0x64:  # d
+            count = U32.unpack_from(data, pos)[0]
+            pos += 4
+            if 2 * count > len(data) - pos:
+                raise CodecError("truncated data")
+            result = {}
+            for _ in range(count):
+                key, pos = _decode_value(data, pos, depth + 1)
+                item, pos = _decode_value(data, pos, depth + 1)
+                try:
+                    result[key] = item
+                except TypeError:
+                    raise CodecError("unhashable dict key")
+            return result, pos
+        if tag == 0x49:  # I
+            size = U16.unpack_from(data, pos)[0]
+            pos += 2
+            if pos + size > len(data):
+                raise CodecError("truncated data")
+            return int.from_bytes(data[pos:pos + size], "big", signed=True), pos + size
+    except (IndexError, struct.error, UnicodeDecodeError) as e:
+        raise CodecError("malformed data: {}".format(e))
+    raise CodecError("unknown tag {!r}".format(tag))
+
+
+def encode_value(value):
+    """ Encode a single value (same format as message fields, e.g. to store it on disk)."""
+    out = bytearray()
+    _encode_value(value, out)
+    return bytes(out)
+
+
+def decode_value(data):
+    """ Decode a value produced by encode_value."""
+    value, pos = _decode_value(memoryview(data), 0)
+    if pos != len(data):
+        raise CodecError("trailing data after value")
+    return value
+
+
+class _Schema:
+    """ Compact layout of one method: its ids and the port of its single address in one struct."""
+
+    def __init__(self, code, fields):
+        self.code = code
+        self.tag = code | COMPACT
+        self.keys = frozenset(fields)
+        self.ids = tuple(f for f in fields if not (f == "addr" or f == "from" or f.endswith("_addr")))
+        (self.addr,) = [f for f in fields if f not in self.ids]
+        self.struct = struct.Struct(">B" + "Q" * len(self.ids) + "HB")
+
+    def encode(self, msg):
+        """ Compact body of msg, or None if msg does not fit the schema."""
+        args = msg.get("args")
+        if len(msg) != 2 or type(args) is not dict or args.keys() != self.keys:
+            return None
+        addr = args[self.addr]
+        if type(addr) is not tuple or len(addr) != 2 or type(addr[0]) is not str:
+            return None
+        host = addr[0].encode("utf-8")
+        try:
+            return self.struct.pack(self.tag, *[args[f] for f in self.ids], addr[1], len(host)) + host
+        except struct.error:  # id not an int or out of range, bad port, host longer than 255 bytes
+            return None
+
+    def decode(self, data, method):
+        try:
+            values = self.struct.unpack_from(data)
+            host = bytes(data[self.struct.size:]).decode("utf-8")
+        except (struct.error, UnicodeDecodeError) as e:
+            raise CodecError("malformed data: {}".format(e))
+        if len(data) - self.struct.size != values[-1]:
+            raise CodecError("malformed message")
+        args = dict(zip(self.ids, values[1:-2]))
+        args[self.addr] = (host, values[-2])
+        return {"method": method, "args": args}
+
+
+COMPACT_SCHEMAS = {METHOD_CODES[method]: _Schema(METHOD_CODES[method], fields) for method, fields in SCHEMAS.items()}
+SCHEMA_BY_METHOD = {METHODS[code]: schema for code, schema in COMPACT_SCHEMAS.items()}
+
+
+def encode(msg):
+    """ Encode a message dict ({"method": ..., ...}) to its body bytes."""
+    method = msg.get("method")
+    schema = SCHEMA_BY_METHOD.get(method)
+    if schema is not None:
+        body = schema.encode(msg)
+        if body is not None:
+            return body
+    out = bytearray()
+    fields = dict(msg)
+    fields.pop("method", None)
+    code = METHOD_CODES.get(method, 0)
+    out += U8.pack(code)
+    if code == 0:
+        _encode_value(method, out)
+    _encode_value(fields, out)
+    return bytes(out)
+
+
+def decode(body):
+    """ Decode body bytes back into a message dict."""
+    data = memoryview(body)
+    if len(data) == 0:
+        raise CodecError("empty message")
+    code = data[0]
+    pos = 1
+    if code & COMPACT:
+        schema = COMPACT_SCHEMAS.get(code & ~COMPACT)
+        if schema is None:
+            raise CodecError("no compact layout for method {}".format(code & ~COMPACT))
+        return schema.decode(data, METHODS[schema.code])
+    if code == 0:
+        method, pos = _decode_value(data, pos)
+    elif code < len(METHODS):
+        method = METHODS[code]
+    else:
+        raise CodecError("unknown method {}".format(code))
+    fields, pos = _decode_value(data, pos)
+    if not isinstance(fields, dict) or pos != len(data):
+        raise CodecError("malformed message")
+    fields["method"] = method
+    return fields
+
+
+class Codec:
+    """ Frames messages into datagrams and reassembles chunked transfers.
+
+    Messages whose body exceeds one datagram are split in chunks sharing a
+    transfer id; Codec.feed returns the message once every chunk arrived.
+    Incomplete transfers are dropped after `transfer_timeout` seconds and at
+    most `max_transfers` are buffered at once.
+    """
+
+    def __init__(self, max_message=MAX_MESSAGE, max_datagram=MAX_DATAGRAM, transfer_timeout=10, max_transfers=64):
+        self.max_message = max_message
+        self.max_datagram = max_datagram
+        self.transfer_timeout = transfer_timeout
+        self.max_transfers = max_transfers
+        self.transfer_ids = itertools.count(int.from_bytes(os.urandom(6), "big") << 16)
+        self.transfers = {}  # (addr, transfer id) -> [deadline, count, parts, bytes received]
+
+    def encode(self, msg):
+        """ Encode msg into its body bytes, checking it does not exceed max_message."""
+        body = encode(msg)
+        if len(body) > self.max_message:
+            raise CodecError("message of {} bytes exceeds maximum {}".format(len(body), self.max_message))
+        return body
+
+    def frames(self, msg):
+        """ Encode msg into a list of datagrams."""
+        return self.datagrams(self.encode(msg))
+
+    def datagrams(self, body):
+        """ Split an encoded body into datagrams."""
+        if HEADER.size + len(body) <= self.max_datagram:
+            return [HEADER.pack(VERSION, 0, len(body)) + body]
+
+        part_size = self.max_datagram - CHUNK_HEADER.size
+        count = -(-len(body) // part_size)
+        if count > 0xFFFF:
+            raise CodecError("message needs too many chunks")
+        transfer = next(self.transfer_ids) & 0xFFFFFFFFFFFFFFFF
+        view = memoryview(body)
+        return [
+            CHUNK_HEADER.pack(VERSION, CHUNK, len(body), transfer, i, count) + view[i * part_size:(i + 1) * part_size]
+            for i in range(count)
+        ]
+
+    def feed(self, datagram, addr=None):
+        """ Process a received datagram.
+
+        Returns the decoded message, or None while a chunked transfer is incomplete.
+        Raises CodecError for malformed datagrams.
+        """
+        if len(datagram) < HEADER.size:
+            raise CodecError("datagram too short")
+        version, flags, length = HEADER.unpack_from(datagram)
+        if version != VERSION:
+            raise CodecError("unsupported version {}".format(version))
+        if length > self.max_message:
+            raise CodecError("message of {} bytes exceeds maximum {}".format(length, self.max_message))
+        if flags == 0:
+            if len(datagram) - HEADER.size != length:
+                raise CodecError("length mismatch")
+            return decode(memoryview(datagram)[HEADER.size:])
+        if flags != CHUNK or len(datagram) < CHUNK_HEADER.size:
+            raise CodecError("malformed chunk")
+        _, _, _, transfer, index, count = CHUNK_HEADER.unpack_from(datagram)
+        if index >= count:
+            raise CodecError("malformed chunk")
+
+        now = time.monotonic()
+        self._expire(now)
+        key = (addr, transfer)
+        entry = self.transfers.get(key)
+        if entry is None:
+            if len(self.transfers) >= self.max_transfers:
+                raise CodecError("too many concurrent transfers")
+            entry = self.transfers[key] = [now + self.transfer_timeout, count, {}, 0]
+        if entry[1] != count or index in entry[2]:
+            raise CodecError("inconsistent chunk")
+        part = bytes(datagram[CHUNK_HEADER.size:])
+        entry[3] += len(part)
+        if entry[3] > length:
+            del self.transfers[key]
+            raise CodecError("chunks exceed announced length")
+        entry[2][index] = part
+        if len(entry[2]) < count:
+            return None
+        del self.transfers[key]
+        body = b"".join(entry[2][i] for i in range(count))
+        if len(body) != length:
+            raise CodecError("length mismatch")
+        return decode(body)
+
+    def _expire(self, now):
+        for key in [key for key, entry in self.transfers.items() if entry[0] < now]:
+            del self.transfers[key]
+
+
+class StreamDecoder:
+    """ Splits a byte stream of whole message frames back into messages.
+
+    Data is received straight into the frame being read: buffer() is the
+    free part of the current header or body, to be filled with
+    socket.recv_into, and received() is told how many bytes were written.
+    Bodies get a buffer of the announced length, so large values are not
+    copied while being reassembled.
+    """
+
+    def __init__(self, max_message=MAX_MESSAGE):
+        self.max_message = max_message
+        self.header = bytearray(HEADER.size)
+        self.body = None  # body being received, None while reading a header
+        self.filled = 0
+
+    def buffer(self):
+        """ Writable view of the bytes still missing from the current header or body."""
+        return memoryview(self.header if self.body is None else self.body)[self.filled:]
+
+    def received(self, size):
+        """ size bytes were written to buffer(); returns the decoded message once complete, else None.
+
+        Raises CodecError for malformed frames, after which the stream cannot be resynchronized.
+        """
+        self.filled += size
+        if self.body is None:
+            if self.filled < HEADER.size:
+                return None
+            version, flags, length = HEADER.unpack(self.header)
+            if version != VERSION:
+                raise CodecError("unsupported version {}".format(version))
+            if flags != 0:
+                raise CodecError("chunk in stream")
+            if length > self.max_message:
+                raise CodecError("message of {} bytes exceeds maximum {}".format(length, self.max_message))
+            self.body = bytearray(length)
+            self.filled = 0
+            if length:
+                return None
+        if self.filled < len(self.body):
+            return None
+        body, self.body, self.filled = self.body, None, 0
+        return decode(body)
+
+    def feed(self, data):
+        """ Process received bytes; returns the list of messages they completed."""
+        data = memoryview(data)
+        messages = []
+        while data:
+            target = self.buffer()
+            size = min(len(target), len(data))
+            target[:size] = data[:size]
+            data = data[size:]
+            msg = self.received(size)
+            if msg is not None:
+                messages.append(msg)
+        return messages
@@ -0,0 +1,108 @@
+""" Counters and histograms kept by every DHT node, queried with STATS messages.
+
+Usage (prints the metrics of the node on port 5000 as JSON):
+    $ python3 metrics.py --port 5000
+"""
+import argparse
+import json
+from bisect import bisect_left
+from collections import Counter
+
+# Upper bounds of the histogram buckets (the last bucket is unbounded)
+HOP_BUCKETS = tuple(range(33))
+LATENCY_BUCKETS = tuple(1e-6 * 2 ** i for i in range(23))  # 1us to 4s
+ROUND_BUCKETS = tuple(range(1, 65))
+
+
+class Histogram:
+    """ Counts of observed values per bucket, plus their count, sum and maximum. """
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        """ Upper bound of the bucket holding the p-th percentile (the maximum for the last bucket)."""
+        if not self.count:
+            return None
+        rank = p / 100 * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return min(self.bounds[i], self.max) if i < len(self.bounds) else self.max
+        return self.max
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "mean": self.sum / self.count if self.count else None,
+            "max": self.max,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+            # non empty buckets, as [upper bound (None: unbounded), count]
+            "buckets": [[self.bounds[i] if i < len(self.bounds) else None, count]
+                        for i, count in enumerate(self.counts) if count],
+        }
+
+
+class NodeMetrics:
+    """ What a node measures about the requests it serves and its ring maintenance.
+
+    counters: messages received per method, requests forwarded to our
+        successor vs a farther finger (routing degraded into successor walks
+        when most go to the successor on a large ring), ...
+    hops: hops taken by the PUT/GET requests this node owned, from the node
+        the client sent them to
+    latency: seconds spent handling each method
+    convergence: stabilize rounds from a membership change until the
+        fingers were confirmed again
+    """
+
+    def __init__(self):
+        self.counters = Counter()
+        self.hops = Histogram(HOP_BUCKETS)
+        self.latency = {}  # method -> Histogram
+        self.convergence = Histogram(ROUND_BUCKETS)
+
+    def handled(self, method, seconds):
+        self.counters[method] += 1
+        histogram = self.latency.get(method)
+        if histogram is None:
+            histogram = self.latency[method] = Histogram(LATENCY_BUCKETS)
+        histogram.observe(seconds)
+
+    def snapshot(self):
+        return {
+            "counters": dict(self.counters),
+            "hops": self.hops.snapshot(),
+            "latency": {method: histogram.snapshot() for method, histogram in self.latency.items()},
+            "convergence_rounds": self.convergence.snapshot(),
+        }
+
+
+def main():
+    from DHTClient import DHTClient
+
+    parser = argparse.ArgumentParser(description="Print the metrics of a DHT node")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--timeout", type=float, default=2)
+    args = parser.parse_args()
+    stats = DHTClient((args.host, args.port), timeout=args.timeout).stats()
+    print(json.dumps(stats, indent=2))
+
+
+if __name__ == "__main__":
+    main()
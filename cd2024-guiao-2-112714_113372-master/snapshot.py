@@ -0,0 +1,307 @@
+""" Bulk import and export of DHT snapshots.
+
+A snapshot file holds key/value records:
+
+    header      MAGIC
+    records     key_length:u32 value_length:u32 crc32:u32 expires:f64 key value
+                (key and value in the codec value format, the crc covers key
+                and value, expires is the time.time() a key written with a TTL
+                expires at, 0 for the others)
+
+Export writes one file per node: the node takes a view of its keystore when
+asked for the first page and reads its values a page at a time
+(ChordNode.export), so each file is a consistent snapshot of that node.
+Files of different nodes are taken one after the other, not at a single
+point in time.
+
+Import reads the keys of any number of snapshot files (not their values),
+sorts them by ring id, splits them by owner according to the current ring
+and sends every owner its keys in large PUT_MANY batches, the owners'
+batches interleaved and `window` of them in flight at once. Values are read
+from the files as their batch is sent, so the values of a whole snapshot are
+never in memory at once. Owners store and replicate the keys as for
+DHTClient.put_many, forwarding those they do not own if the ring changed.
+
+Usage:
+    $ python3 snapshot.py export --port 5000 --dir snapshots
+    $ python3 snapshot.py import snapshots/*.snap --port 5000
+
+(with the --bits, --hash and --placement the nodes were started with)
+"""
+import argparse
+import json
+import logging
+import os
+import socket
+import struct
+import time
+import zlib
+from collections import deque
+from codec import CodecError, encode_value, decode_value
+from DHTClient import DHTClient
+import utils
+from utils import key_ids
+
+MAGIC = b"DHTSNAP1"
+RECORD = struct.Struct(">IIId")
+
+logger = logging.getLogger("snapshot")
+
+
+class SnapshotWriter:
+    """ Writes a snapshot file.
+
+    Usage:
+        with SnapshotWriter("node.snap") as snapshot:
+            snapshot.write("key", "value")
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "wb")
+        self.file.write(MAGIC)
+        self.count = 0
+
+    def write(self, key, value, expires=None):
+        raw_key = encode_value(key)
+        raw_value = encode_value(value)
+        crc = zlib.crc32(raw_value, zlib.crc32(raw_key))
+        self.file.write(RECORD.pack(len(raw_key), len(raw_value), crc, expires or 0) + raw_key + raw_value)
+        self.count += 1
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def index_snapshot(path):
+    """ (key, value offset, value length, crc, expires) of every record of a snapshot file, reading keys only."""
+    records = []
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise CodecError("{} is not a snapshot file".format(path))
+        while True:
+            header = f.read(RECORD.size)
+            if not header:
+                break
+            if len(header) < RECORD.size:
+                raise CodecError("truncated record in {}".format(path))
+            key_length, value_length, crc, expires = RECORD.unpack(header)
+            raw_key = f.read(key_length)
+            if len(raw_key) < key_length:
+                raise CodecError("truncated record in {}".format(path))
+            records.append((decode_value(raw_key), f.tell(), value_length, zlib.crc32(raw_key), crc, expires or None))
+            f.seek(value_length, os.SEEK_CUR)
+    return records
+
+
+def read_snapshot(path):
+    """ Iterate over the (key, value, expires) records of a snapshot file."""
+    with open(path, "rb") as f:
+        fd = f.fileno()
+        for key, offset, length, key_crc, crc, expires in index_snapshot(path):
+            yield key, _read_value(fd, offset, length, key_crc, crc, key), expires
+
+
+def _read_value(fd, offset, length, key_crc, crc, key):
+    raw_value = os.pread(fd, length, offset)
+    if len(raw_value) < length or zlib.crc32(raw_value, key_crc) != crc:
+        raise CodecError("corrupted record for key {!r}".format(key))
+    return decode_value(raw_value)
+
+
+def bulk_import(client, paths, batch_bytes=512 * 1024, batch_size=5000, window=16):
+    """ Store the records of the snapshot files in the DHT; returns a report of the load.
+
+    A key found in several files takes the value of the last one. Keys whose
+    expiry time passed are skipped. Batches that are not acknowledged are
+    resent (client.retries times); the keys still missing after that are
+    partitioned again over a refreshed view of the ring, client.retries
+    times as well.
+
+    Parameters:
+        client: a DHTClient of the ring (its timeout bounds the wait for each acknowledgement)
+        paths: snapshot files
+        batch_bytes: encoded keys and values per PUT_MANY at most (large ones go over TCP)
+        batch_size: keys per PUT_MANY at most
+        window: batches in flight at once
+    """
+    start = time.monotonic()
+    files = [open(path, "rb") for path in paths]
+    try:
+        latest = {}
+        now = time.time()
+        for i, path in enumerate(paths):
+            for key, offset, length, key_crc, crc, expires in index_snapshot(path):
+                latest[key] = (i, offset, length, key_crc, crc, expires)
+        keys = [key for key, record in latest.items() if record[5] is None or record[5] > now]
+        report = {"files": len(paths), "records": len(latest), "expired": len(latest) - len(keys)}
+        # sorted by ring id, every owner's keys are a run (two for the node owning the wrap around)
+        records = sorted(zip(key_ids(keys), keys), key=lambda record: record[0])
+        report["sorted_seconds"] = time.monotonic() - start
+        batches = 0
+        partitions = {}
+        for _ in range(client.retries + 1):
+            ring = client.refresh_ring()
+            if ring is None:
+                missing = {key for _, key in records}
+                continue
+            partitions = {}
+            for key_hash, key in records:
+                partitions.setdefault(ring.owner(key_hash), []).append(key)
+            sent, missing = _send_partitions(client, files, latest, partitions, batch_bytes, batch_size, window)
+            batches += sent
+            if not missing:
+                break
+            logger.warning("%d keys not acknowledged, partitioning them again", len(missing))
+            records = [record for record in records if record[1] in missing]
+        else:
+            logger.error("No ACK for %d keys", len(missing))
+        seconds = time.monotonic() - start
+        report.update({"keys": len(keys) - len(missing), "missing": len(missing), "owners": len(partitions),
+                       "batches": batches, "seconds": seconds,
+                       "keys_per_s": (len(keys) - len(missing)) / seconds if seconds else None})
+        return report
+    finally:
+        for f in files:
+            f.close()
+
+
+def _send_partitions(client, files, records, partitions, batch_bytes, batch_size, window):
+    """ Send the batches of every partition, interleaved, `window` at a time; returns (batches, keys missing)."""
+
+    def batches(keys):
+        batch, size = [], 0
+        for key in keys:
+            length = records[key][2]
+            if batch and (len(batch) >= batch_size or size + length > batch_bytes):
+                yield batch
+                batch, size = [], 0
+            batch.append(key)
+            size += length
+        if batch:
+            yield batch
+
+    def send(addr, batch, msg_id):
+        items = {}
+        expires = {}
+        for key in batch:
+            i, offset, length, key_crc, crc, expiry = records[key]
+            items[key] = _read_value(files[i].fileno(), offset, length, key_crc, crc, key)
+            if expiry is not None:
+                expires[key] = expiry
+        args = {"items": items, "msg_id": msg_id}
+        if expires:
+            args["expires"] = expires
+        client.send(addr, {"method": "PUT_MANY", "args": args})
+
+    queue = deque((addr, batches(keys)) for addr, keys in partitions.items())
+    pending = {}  # msg_id -> [owner, keys not acknowledged, batch, resends]
+    missing = set()
+    sent = 0
+    while queue or pending:
+        while queue and len(pending) < window:
+            # round robin over the owners, so they all store keys at once
+            addr, owner_batches = queue.popleft()
+            batch = next(owner_batches, None)
+            if batch is None:
+                continue
+            queue.append((addr, owner_batches))
+            msg_id = next(client.msg_ids)
+            pending[msg_id] = [addr, set(batch), batch, 0]
+            send(addr, batch, msg_id)
+            sent += 1
+        try:
+            out, _ = client.recv()
+        except socket.timeout:
+            for msg_id, entry in list(pending.items()):
+                addr, left, batch, resends = entry
+                if resends >= client.retries:
+                    missing.update(left)
+                    del pending[msg_id]
+                    continue
+                entry[3] += 1
+                send(addr, [key for key in batch if key in left], msg_id)
+            continue
+        entry = pending.get(out.get("msg_id"))
+        if out["method"] != "ACK_MANY" or entry is None:
+            logger.debug("Ignoring msg: %s", out)
+            continue
+        entry[1].difference_update(out["args"]["keys"])
+        if not entry[1]:
+            del pending[out["msg_id"]]
+    return sent, missing
+
+
+def export_node(client, address, path, page_size=1000):
+    """ Write a consistent snapshot of the keys of the node at address to path; returns the number of keys."""
+    tmp_path = path + ".tmp"
+    while True:
+        token, offset = None, 0
+        with SnapshotWriter(tmp_path) as snapshot:
+            while True:
+                args = {"token": token, "offset": offset, "limit": page_size}
+                out = client.request(address, {"method": "EXPORT", "args": args})
+                if out is None:
+                    raise TimeoutError("no EXPORT_REP from {}".format(address))
+                if out["method"] != "EXPORT_REP":
+                    break  # the node dropped the snapshot (a lost last page, or too slow): start over
+                token = out["args"]["token"]
+                for key, value, expires in out["args"]["items"]:
+                    snapshot.write(key, value, expires)
+                offset += len(out["args"]["items"])
+                if not out["args"]["more"]:
+                    os.replace(tmp_path, path)
+                    return offset
+        logger.warning("Snapshot of %s dropped, exporting it again", address)
+
+
+def export(client, directory, page_size=1000):
+    """ Export every node of the ring to directory, a snapshot file per node; returns {file: keys}."""
+    os.makedirs(directory, exist_ok=True)
+    ring = client.refresh_ring()
+    if ring is None:
+        raise TimeoutError("no INFO_REP from {}".format(client.dht_addr))
+    exported = {}
+    for addr in ring.addrs:
+        path = os.path.join(directory, "{}_{}.snap".format(*addr))
+        exported[path] = export_node(client, tuple(addr), path, page_size)
+    return exported
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk import and export of DHT snapshots")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--timeout", type=float, default=2)
+    parser.add_argument("--bits", type=int, default=10, help="ring ids bits, as given to DHT.py")
+    parser.add_argument("--hash", choices=["fnv", "blake2b"], default="fnv")
+    parser.add_argument("--placement", choices=["hash", "order"], default="hash")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    parser_import = subparsers.add_parser("import", help="store the records of snapshot files in the DHT")
+    parser_import.add_argument("paths", nargs="+")
+    parser_import.add_argument("--batch-bytes", type=int, default=512 * 1024)
+    parser_import.add_argument("--batch-size", type=int, default=5000)
+    parser_import.add_argument("--window", type=int, default=16, help="batches in flight")
+    parser_export = subparsers.add_parser("export", help="write a snapshot file per node")
+    parser_export.add_argument("--dir", default="snapshots")
+    parser_export.add_argument("--page-size", type=int, default=1000)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    utils.configure(args.bits, args.hash, args.placement)
+
+    client = DHTClient((args.host, args.port), timeout=args.timeout)
+    if args.command == "import":
+        report = bulk_import(client, args.paths, args.batch_bytes, args.batch_size, args.window)
+    else:
+        report = export(client, args.dir, args.page_size)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
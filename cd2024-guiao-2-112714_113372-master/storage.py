@@ -0,0 +1,290 @@
+""" Storage engines for the keys owned by a DHT node (ChordNode.keystore).
+
+Both engines are mutable mappings of key -> value with a close() method,
+and keep the version of every key (`versions`, written with put(key, value,
+version)) along with its value. view() returns a read-only mapping of the
+keys as they are at that moment, whatever is written afterwards:
+
+    MemoryStorage   a plain dict, lost when the node stops (the default)
+    LogStorage      an append-only log on disk with an in-memory hash index
+
+LogStorage directory layout:
+
+    data.log    records appended on every write or delete:
+                flags:u8 key_length:u32 value_length:u32 crc32:u32 version:u64 key value
+                (key and value in the codec value format, flags == DELETED for
+                tombstones, the crc covers key and value)
+    index       snapshot of the index (key -> offset and length of its value),
+                of the versions and of the log size it covers, written on close
+                and compaction
+
+Only the index is kept in memory, values are read from the log on access.
+On open the index snapshot is loaded and only the records appended after it
+are scanned (reading their headers and keys, not their values), so recovery
+takes time proportional to the index, not to the data. A torn record at the
+end of the log (a crash in the middle of a write) is truncated away.
+"""
+import os
+import struct
+import zlib
+from collections.abc import Mapping, MutableMapping
+from codec import CodecError, encode_value, decode_value
+
+RECORD = struct.Struct(">BIIIQ")
+DELETED = 1
+
+
+class MemoryStorage(dict):
+    """ Keys kept in memory only. """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__()
+        self.versions = {}  # key -> version
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def __setitem__(self, key, value):
+        """ Store value, keeping the version of key (see put)."""
+        self.put(key, value, self.versions.get(key, 0))
+
+    def put(self, key, value, version):
+        """ Store value and its version."""
+        super().__setitem__(key, value)
+        self.versions[key] = version
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.versions.pop(key, None)
+
+    def view(self):
+        """ The keys as they are now: a shallow copy (values are replaced on write, not modified)."""
+        view = MemoryStorage()
+        dict.update(view, self)
+        view.versions = dict(self.versions)
+        return view
+
+    def close(self):
+        pass
+
+
+class LogStorage(MutableMapping):
+    """ Append-only log with an in-memory hash index and compaction.
+
+    Usage:
+        keystore = LogStorage("data/node-5000")
+        keystore.put("key", "value", 1)
+        keystore.versions["key"]  # 1, also after the store is opened again
+        keystore.close()
+    """
+
+    def __init__(self, path, sync=False, compact_ratio=0.5, compact_min=1024 * 1024):
+        """Open (or create) the store in directory path.
+
+        Parameters:
+            path: directory holding the log and its index snapshot
+            sync: fsync the log after every write (survives power loss, not only process crashes)
+            compact_ratio: rewrite the log once this fraction of it is overwritten or deleted data
+            compact_min: ... and the overwritten or deleted data is at least this many bytes
+        """
+        self.path = path
+        self.sync = sync
+        self.compact_ratio = compact_ratio
+        self.compact_min = compact_min
+        self.index = {}  # key -> (offset of the value in the log, value length)
+        self.versions = {}  # key -> version, stored in its record
+        self.garbage = 0  # bytes of the log taken by overwritten values and tombstones
+        self.compactions = 0
+        self.views = 0  # open LogViews, reading values overwritten since: no compaction meanwhile
+        os.makedirs(path, exist_ok=True)
+        self.log_path = os.path.join(path, "data.log")
+        self.index_path = os.path.join(path, "index")
+        self.fd = os.open(self.log_path, os.O_RDWR | os.O_CREAT, 0o644)
+        self.size = self._recover()
+
+    def _recover(self):
+        """Rebuild the index: load the snapshot, then scan the records appended after it."""
+        log_size = os.fstat(self.fd).st_size
+        position = 0
+        try:
+            with open(self.index_path, "rb") as f:
+                snapshot = decode_value(f.read())
+            if snapshot["log_size"] <= log_size:
+                self.index = {key: tuple(entry) for key, entry in snapshot["index"].items()}
+                self.versions = dict(snapshot["versions"])
+                self.garbage = snapshot["garbage"]
+                position = snapshot["log_size"]
+        except (OSError, CodecError, KeyError, TypeError, AttributeError):
+            pass  # no usable snapshot: scan the whole log
+        while position < log_size:
+            header = os.pread(self.fd, RECORD.size, position)
+            if len(header) < RECORD.size:
+                break
+            flags, key_length, value_length, crc, version = RECORD.unpack(header)
+            start = position + RECORD.size
+            end = start + key_length + value_length
+            if end > log_size:
+                break
+            raw_key = os.pread(self.fd, key_length, start)
+            try:
+                key = decode_value(raw_key)
+            except CodecError:
+                break
+            if key in self.index:
+                self.garbage += RECORD.size + key_length + self.index[key][1]
+            if flags & DELETED:
+                self.index.pop(key, None)
+                self.versions.pop(key, None)
+                self.garbage += end - position
+            else:
+                self.index[key] = (start + key_length, value_length)
+                self.versions[key] = version
+            position = end
+        if position < log_size:
+            # torn write at the end of the log (the crc of the other records is checked on read)
+            os.ftruncate(self.fd, position)
+        return position
+
+    def _append(self, key, value, flags=0, version=0):
+        raw_key = encode_value(key)
+        raw_value = b"" if flags & DELETED else encode_value(value)
+        header = RECORD.pack(flags, len(raw_key), len(raw_value), zlib.crc32(raw_value, zlib.crc32(raw_key)), version)
+        offset = self.size
+        os.pwrite(self.fd, header + raw_key + raw_value, offset)
+        if self.sync:
+            os.fsync(self.fd)
+        self.size += RECORD.size + len(raw_key) + len(raw_value)
+        return offset + RECORD.size + len(raw_key), len(raw_value), len(raw_key)
+
+    def _read(self, key, offset, length):
+        """Read back the value of key, checking the record crc."""
+        raw_key = encode_value(key)
+        start = offset - len(raw_key) - RECORD.size
+        record = os.pread(self.fd, RECORD.size + len(raw_key) + length, start)
+        crc = RECORD.unpack_from(record)[3]
+        if zlib.crc32(record[RECORD.size:]) != crc:
+            raise CodecError("corrupted record for key {!r} in {}".format(key, self.log_path))
+        return decode_value(record[RECORD.size + len(raw_key):])
+
+    def __getitem__(self, key):
+        offset, length = self.index[key]
+        return self._read(key, offset, length)
+
+    def __setitem__(self, key, value):
+        """Store value, keeping the version of key (see put)."""
+        self.put(key, value, self.versions.get(key, 0))
+
+    def put(self, key, value, version):
+        """Store value and its version."""
+        offset, length, key_length = self._append(key, value, version=version)
+        old = self.index.get(key)
+        if old is not None:
+            self.garbage += RECORD.size + key_length + old[1]
+        self.index[key] = (offset, length)
+        self.versions[key] = version
+        self._maybe_compact()
+
+    def __delitem__(self, key):
+        old = self.index.pop(key)
+        self.versions.pop(key, None)
+        _, _, key_length = self._append(key, None, DELETED)
+        self.garbage += 2 * (RECORD.size + key_length) + old[1]
+        self._maybe_compact()
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+    def view(self):
+        """A read-only LogView of the keys as they are now; close it once done."""
+        return LogView(self)
+
+    def _maybe_compact(self):
+        if self.views:
+            return
+        if self.garbage >= self.compact_min and self.garbage >= self.compact_ratio * self.size:
+            self.compact()
+
+    def compact(self):
+        """Rewrite the log with only the live values, then snapshot the index."""
+        tmp_path = self.log_path + ".compact"
+        fd = os.open(tmp_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        index = {}
+        position = 0
+        for key, (offset, length) in self.index.items():
+            raw_key = encode_value(key)
+            start = offset - len(raw_key) - RECORD.size
+            record = os.pread(self.fd, RECORD.size + len(raw_key) + length, start)
+            os.pwrite(fd, record, position)
+            index[key] = (position + RECORD.size + len(raw_key), length)
+            position += len(record)
+        os.fsync(fd)
+        if os.path.exists(self.index_path):
+            os.remove(self.index_path)  # it describes the old log
+        os.replace(tmp_path, self.log_path)
+        os.close(self.fd)
+        self.fd = fd
+        self.index, self.size, self.garbage = index, position, 0
+        self.compactions += 1
+        self.snapshot()
+
+    def snapshot(self):
+        """Write the index to disk, so the next open only scans the log appended after this point."""
+        os.fsync(self.fd)
+        snapshot = {"log_size": self.size, "garbage": self.garbage,
+                    "index": {key: list(entry) for key, entry in self.index.items()}, "versions": self.versions}
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(encode_value(snapshot))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.index_path)
+
+    def close(self):
+        if self.fd is None:
+            return
+        self.snapshot()
+        os.close(self.fd)
+        self.fd = None
+
+
+class LogView(Mapping):
+    """ Keys and values of a LogStorage as of the creation of the view.
+
+    Only the index is copied: values are read from the log on access, the
+    records of values overwritten or deleted since staying in the log as the
+    store does not compact it while views are open.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.index = dict(store.index)
+        store.views += 1
+
+    def __getitem__(self, key):
+        offset, length = self.index[key]
+        return self.store._read(key, offset, length)
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+    def close(self):
+        if self.store is None:
+            return
+        self.store.views -= 1
+        self.store._maybe_compact()
+        self.store = None
+
+
+def open_storage(data_dir, address):
+    """ Storage for the node at address: on disk under data_dir (one directory per node), in memory if None."""
+    if data_dir is None:
+        return MemoryStorage()
+    return LogStorage(os.path.join(data_dir, "{}_{}".format(*address)))
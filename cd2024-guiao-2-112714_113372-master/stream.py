@@ -0,0 +1,306 @@
+""" Persistent TCP connections carrying the messages too large for one datagram.
+
+Small messages stay on UDP. Larger ones (a PUT of a multi-megabyte value,
+its REPLICATE, a MIGRATE batch, the GET answer, ...) are sent over a TCP
+connection to the destination, kept open and reused for the next large
+message: one message over TCP instead of hundreds of chunks, each of which
+could be lost and fail the whole transfer.
+
+Every connection starts with a STREAM message carrying the UDP port of the
+side that opened it, and the host it is known by if it has one (a node's
+address), so messages received on it are attributed to the same (host, port)
+address the protocol uses for that side: replies go back to where they would
+have gone over UDP, and reuse the connection when large too. Connections are
+pooled by resolved address, so ("localhost", port) and ("127.0.0.1", port)
+share one.
+
+Frames are the unchunked datagram layout of codec.py. They are sent with
+socket.sendmsg, the header and the encoded body as separate buffers, and
+received straight into a buffer of the announced size (codec.StreamDecoder),
+so large bodies are not copied on the way.
+"""
+import errno
+import itertools
+import logging
+import selectors
+import socket
+import time
+from collections import OrderedDict, deque
+from codec import HEADER, VERSION, CodecError, MAX_MESSAGE, StreamDecoder, encode
+
+# Buffers passed to one sendmsg call
+MAX_IOV = 64
+
+
+class _Connection:
+    """ One TCP connection: what is left to send, and the frame being received."""
+
+    def __init__(self, sock, peer, max_message):
+        self.sock = sock
+        self.peer = peer  # (host, UDP port) of the other side, None until its STREAM message arrived
+        self.key = None  # resolved peer address, the key of the connection in the pool
+        self.decoder = StreamDecoder(max_message)
+        self.out = deque()  # memoryviews still to be sent
+        self.connecting = False
+        self.pending = []  # bodies queued while connecting, handed to the fallback if the connection fails
+        self.events = selectors.EVENT_READ
+
+
+class Streams:
+    """ Pool of TCP connections to/from the peers large messages are exchanged with.
+
+    Not thread safe: send and poll are called from the thread owning the
+    node (or client). Messages queued while connecting to a peer that does
+    not accept connections (e.g. an AsyncDHTNode, which only has UDP) are
+    handed to `fallback` to be sent as datagrams, and the peer is not tried
+    again for `retry_after` seconds. Messages queued on an established
+    connection that fails are lost, like datagrams: requests are retried
+    and handoff batches resent by the protocol as usual.
+    """
+
+    def __init__(self, port, max_message=MAX_MESSAGE, max_connections=64, logger=None, fallback=None,
+                 retry_after=10, host=None):
+        """Constructor
+
+        Parameters:
+            port: our UDP port, announced on the connections we open
+            host: our host as the peers address us, announced too (None: they take the connection's address)
+            max_message: largest message (in bytes) accepted
+            max_connections: connections kept open, the least recently used idle ones are closed beyond
+            logger: where connection failures are reported
+            fallback: fallback(address, body) sends a message that could not be streamed
+            retry_after: seconds before connecting again to a peer that refused a connection
+        """
+        self.port = port
+        self.host = host
+        self.fallback = fallback
+        self.retry_after = retry_after
+        self.unreachable = {}  # resolved address -> time.monotonic() until which no connection is attempted
+        self.max_message = max_message
+        self.max_connections = max_connections
+        self.logger = logger or logging.getLogger("Streams")
+        self.selector = selectors.DefaultSelector()
+        self.connections = OrderedDict()  # resolved peer address -> _Connection, least recently used first
+        self.hosts = {}  # host name -> IP address
+        self.listener = None
+        self.datagrams = None
+        self.sent = 0  # messages sent over TCP
+        self.received = 0  # messages received over TCP
+
+    def listen(self, address):
+        """ Accept connections on the TCP port of address."""
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            listener.bind(address)
+            listener.listen(64)
+        except OSError:
+            listener.close()
+            raise
+        listener.setblocking(False)
+        self.listener = listener
+        self.selector.register(listener, selectors.EVENT_READ)
+
+    def watch(self, datagram_socket):
+        """ Also wait for datagram_socket in poll()."""
+        self.datagrams = datagram_socket
+        self.selector.register(datagram_socket, selectors.EVENT_READ)
+
+    def send(self, address, body):
+        """ Queue an encoded message body to address, connecting first if needed.
+
+        Returns False if no connection could be opened (the caller falls back to datagrams).
+        """
+        address = tuple(address)
+        key = self._resolve(address)
+        conn = self.connections.get(key)
+        if conn is None:
+            if self.unreachable.get(key, 0) > time.monotonic():
+                return False
+            conn = self._connect(address, key)
+            if conn is None:
+                return False
+        self.connections.move_to_end(key)
+        conn.out.append(memoryview(HEADER.pack(VERSION, 0, len(body))))
+        conn.out.append(memoryview(body))
+        self.sent += 1
+        if conn.connecting:
+            conn.pending.append(body)
+        else:
+            self._flush(conn)
+        return True
+
+    def poll(self, timeout):
+        """ Wait at most timeout seconds (None: forever) for data.
+
+        Returns (messages received over TCP as (msg, addr) pairs, whether the watched datagram socket is readable).
+        """
+        messages = []
+        readable = False
+        for key, events in self.selector.select(timeout):
+            if key.fileobj is self.datagrams:
+                readable = True
+            elif key.fileobj is self.listener:
+                self._accept()
+            else:
+                conn = key.data
+                if events & selectors.EVENT_WRITE:
+                    self._writable(conn)
+                if events & selectors.EVENT_READ and conn.sock.fileno() != -1:
+                    self._read(conn, messages)
+        return messages, readable
+
+    def close(self):
+        for conn in list(self.connections.values()):
+            self._drop(conn)
+        for key in list(self.selector.get_map().values()):
+            if key.data is not None:
+                self._drop(key.data)
+        if self.listener is not None:
+            self.listener.close()
+        self.selector.close()
+
+    def _resolve(self, address):
+        """ address with its host name replaced by its IP address, to pool connections by peer."""
+        host, port = address
+        if host not in self.hosts:
+            try:
+                self.hosts[host] = socket.gethostbyname(host)
+            except (OSError, TypeError, UnicodeError):
+                self.hosts[host] = host
+        return self.hosts[host], port
+
+    def _connect(self, address, key):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setblocking(False)
+        error = sock.connect_ex(address)
+        if error not in (0, *_IN_PROGRESS):
+            self.logger.warning("Cannot connect to %s: %s", address, errno.errorcode.get(error, error))
+            self.unreachable[key] = time.monotonic() + self.retry_after
+            sock.close()
+            return None
+        conn = _Connection(sock, address, self.max_message)
+        conn.connecting = error != 0
+        args = {"port": self.port} if self.host is None else {"port": self.port, "host": self.host}
+        hello = encode({"method": "STREAM", "args": args})
+        conn.out.append(memoryview(HEADER.pack(VERSION, 0, len(hello)) + hello))
+        conn.events = selectors.EVENT_READ | (selectors.EVENT_WRITE if conn.connecting else 0)
+        self.selector.register(sock, conn.events, conn)
+        self._add(key, conn)
+        return conn
+
+    def _add(self, key, conn):
+        conn.key = key
+        old = self.connections.pop(key, None)
+        if old is not None and old is not conn and not old.out:
+            self._drop(old)
+        self.connections[key] = conn
+        if len(self.connections) > self.max_connections:
+            for idle in [c for c in self.connections.values() if not c.out][:len(self.connections) - self.max_connections]:
+                self._drop(idle)
+
+    def _accept(self):
+        try:
+            sock, _ = self.listener.accept()
+        except BlockingIOError:
+            return
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setblocking(False)
+        conn = _Connection(sock, None, self.max_message)
+        self.selector.register(sock, conn.events, conn)
+
+    def _writable(self, conn):
+        if conn.connecting:
+            error = conn.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if error:
+                self.logger.warning("Cannot connect to %s: %s", conn.peer, errno.errorcode.get(error, error))
+                self.unreachable[conn.key] = time.monotonic() + self.retry_after
+                pending, conn.pending = conn.pending, []
+                conn.out.clear()
+                self._drop(conn)
+                self.sent -= len(pending)
+                if self.fallback is not None:
+                    for body in pending:
+                        self.fallback(conn.peer, body)
+                return
+            conn.connecting = False
+            conn.pending = []
+        self._flush(conn)
+
+    def _flush(self, conn):
+        """ Send as much of conn.out as the socket takes, then wait for it to be writable if anything is left."""
+        while conn.out:
+            try:
+                sent = conn.sock.sendmsg(list(itertools.islice(conn.out, MAX_IOV)))
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as e:
+                self.logger.warning("Connection to %s failed: %s", conn.peer, e)
+                self._drop(conn)
+                return
+            while sent:
+                head = conn.out[0]
+                if sent < len(head):
+                    conn.out[0] = head[sent:]
+                    break
+                sent -= len(head)
+                conn.out.popleft()
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if conn.out else 0)
+        if events != conn.events:
+            conn.events = events
+            self.selector.modify(conn.sock, events, conn)
+
+    def _read(self, conn, messages):
+        while True:
+            try:
+                size = conn.sock.recv_into(conn.decoder.buffer())
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                self.logger.warning("Connection from %s failed: %s", conn.peer, e)
+                self._drop(conn)
+                return
+            if size == 0:
+                self._drop(conn)
+                return
+            try:
+                msg = conn.decoder.received(size)
+            except CodecError as e:
+                self.logger.warning("Closing connection from %s: %s", conn.peer, e)
+                self._drop(conn)
+                return
+            if msg is None:
+                continue
+            if msg.get("method") == "STREAM":
+                try:
+                    host = msg["args"].get("host") or conn.sock.getpeername()[0]
+                    if not isinstance(host, str):
+                        raise TypeError(host)
+                    conn.peer = (host, int(msg["args"]["port"]))
+                except (KeyError, TypeError, ValueError, AttributeError, OSError):
+                    self.logger.warning("Closing connection with an invalid STREAM message: %s", msg)
+                    self._drop(conn)
+                    return
+                # answers to the peer reuse this connection
+                self._add(self._resolve(conn.peer), conn)
+            elif conn.peer is None:
+                self.logger.warning("Closing connection that did not start with STREAM")
+                self._drop(conn)
+                return
+            else:
+                self.received += 1
+                messages.append((msg, conn.peer))
+
+    def _drop(self, conn):
+        if conn.out:
+            self.logger.warning("Dropping unsent data to %s", conn.peer)
+            conn.out.clear()
+        if conn.key is not None and self.connections.get(conn.key) is conn:
+            del self.connections[conn.key]
+        if conn.sock.fileno() != -1:
+            self.selector.unregister(conn.sock)
+            conn.sock.close()
+
+
+_IN_PROGRESS = (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN)
@@ -0,0 +1,47 @@
+"""Tests a large DHT of asyncio nodes in this process."""
+import asyncio
+import pytest
+import utils
+from DHTAsyncClient import AsyncDHTClient
+from DHTAsyncNode import start_ring
+from utils import dht_hash, contains
+
+PORTS = list(range(5700, 5800))
+
+
+async def converged(nodes, timeout):
+    ids = sorted(node.identification for node in nodes)
+    successor = {node_id: ids[(i + 1) % len(ids)] for i, node_id in enumerate(ids)}
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while loop.time() < deadline:
+        if all(node.successor_id == successor[node.identification] and node.predecessor_id is not None
+               for node in nodes):
+            return True
+        await asyncio.sleep(0.1)
+    return False
+
+
+def test_hundred_nodes():
+    async def run():
+        nodes = await start_ring("localhost", PORTS, timeout=1)
+        try:
+            assert await converged(nodes, 30)
+            client = await AsyncDHTClient.connect(("localhost", PORTS[0]), timeout=1)
+            keys = ["async-{}".format(i) for i in range(200)]
+            assert all(await asyncio.gather(*(client.put(key, key) for key in keys)))
+            assert await asyncio.gather(*(client.get(key) for key in keys)) == keys
+            client.close()
+            for key in keys:
+                (owner,) = [n for n in nodes if contains(n.predecessor_id, n.identification, dht_hash(key))]
+                assert key in owner.keystore
+        finally:
+            for node in nodes:
+                node.stop()
+
+    # 100 node ids would likely collide in the default 2^10 ring
+    utils.configure(32)
+    try:
+        asyncio.run(run())
+    finally:
+        utils.configure(10)
@@ -0,0 +1,63 @@
+"""Tests batching of forwarded requests."""
+import time
+import pytest
+from codec import decode
+from DHTClient import DHTClient
+from DHTNode import ChordNode, DHTNode
+
+
+class Recorder(ChordNode):
+    """ A node sending nothing, keeping the messages it would have sent."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.sent = []
+
+    def send_body(self, address, body):
+        self.sent.append((address, decode(body)))
+
+
+def test_flush_on_size():
+    node = Recorder(("localhost", 6600), batch_window=10, batch_size=3)
+    hop = ("localhost", 6601)
+    for i in range(4):
+        node.forward(hop, {"method": "PUT", "args": {"key": str(i), "value": i, "from": ("localhost", 1)}})
+    assert len(node.sent) == 1
+    address, msg = node.sent[0]
+    assert address == hop and msg["method"] == "BATCH"
+    assert [decode(body)["args"]["key"] for body in msg["args"]["bodies"]] == ["0", "1", "2"]
+
+    node.forward(hop, {"method": "STATS", "args": {}})  # not batched
+    assert node.sent[-1][1]["method"] == "STATS" and hop in node.outbox
+    node.flush_batches()
+    assert node.sent[-1][1]["method"] == "PUT" and not node.outbox  # a single request goes as is
+
+
+@pytest.fixture(scope="module")
+def ring():
+    nodes = []
+    for port in (6610, 6611, 6612, 6613):
+        node = DHTNode(("localhost", port), ("localhost", 6610) if nodes else None, timeout=1, batch_window=0.05)
+        node.start()
+        nodes.append(node)
+        time.sleep(0.1)
+    start = time.monotonic()
+    while not all(node.predecessor_id is not None and node.unsettled_since is None for node in nodes) \
+            and time.monotonic() - start < 10:
+        time.sleep(0.1)
+    yield nodes
+    for node in nodes:
+        node.done = True
+        node.join()
+
+
+def test_batched_requests(ring):
+    client = DHTClient(("localhost", 6610), timeout=2)
+    keys = ["batch-{}".format(i) for i in range(100)]
+    # many requests in flight at once through the same entry node
+    for key in keys:
+        client.send(("localhost", 6610), {"method": "PUT", "args": {"key": key, "value": key}})
+    acks = [client.recv(2)[0]["method"] for _ in keys]
+    assert acks == ["ACK"] * len(keys)
+    assert sum(node.metrics.counters["batched"] for node in ring) > 0
+    assert client.get_many(keys) == {key: key for key in keys}
@@ -0,0 +1,36 @@
+"""Tests the ring benchmark harness."""
+import asyncio
+import utils
+from bench import converged, latency_report, ring_benchmark
+
+
+def test_converged():
+    ring = [{"id": 1, "successor_id": 5, "predecessor_id": 9},
+            {"id": 5, "successor_id": 9, "predecessor_id": 1},
+            {"id": 9, "successor_id": 1, "predecessor_id": 5}]
+    assert converged(ring)
+    assert not converged(ring[:2])
+    assert not converged([]) and not converged(ring, 4)
+    assert not converged([ring[0], dict(ring[1], successor_id=1), ring[2]])
+
+
+def test_latency_report():
+    report = latency_report([0.001 * i for i in range(1, 101)], 2, 0.5)
+    assert report["ops"] == 102 and report["ops_per_s"] == 200
+    assert round(report["latency_ms"]["p50"]) == 51 and round(report["latency_ms"]["max"]) == 100
+
+
+def test_ring_benchmark():
+    utils.configure(32)
+    try:
+        report = asyncio.run(ring_benchmark(nodes=6, keys=100, port=6200, churn=20))
+    finally:
+        utils.configure(10)
+    assert report["join"]["converged"]
+    assert report["put"]["ops"] == report["get"]["ops"] == 100
+    assert report["put"]["errors"] == 0
+    # every PUT was routed from the node it was sent to and counted once by its owner
+    assert report["put"]["hops"]["lookups"] == 100
+    assert report["put"]["hops"]["max"] <= 6
+    # the first node is replaced as the GETs start, every replacement is one node leaving and one joining
+    assert report["churn"]["joined"] == report["churn"]["left"] >= 1
@@ -0,0 +1,81 @@
+"""Tests the hot key read cache."""
+import time
+import pytest
+from cache import ReadCache
+from DHTClient import DHTClient
+from DHTNode import DHTNode
+from utils import contains, dht_hash
+
+
+def wait_for(condition, timeout=5):
+    start = time.monotonic()
+    while time.monotonic() - start < timeout:
+        if condition():
+            return True
+        time.sleep(0.02)
+    return False
+
+
+def test_read_cache():
+    cache = ReadCache(size=2, lease=0.2, admit=2)
+    assert not cache.record("a")
+    assert cache.record("a")
+    assert cache.lookup("a") == (False, None)
+
+    cache.fill("a", 1, "one")
+    cache.fill("b", 1, "bee")
+    assert cache.lookup("a") == (True, "one")
+    cache.fill("c", 1, "sea")  # evicts b, the least recently used
+    assert cache.lookup("b") == (False, None)
+    assert len(cache) == 2
+
+    cache.invalidate("a", 2)
+    assert cache.lookup("a") == (False, None)
+    cache.fill("a", 1, "late copy of the old version")
+    assert cache.lookup("a") == (False, None)
+    cache.fill("a", 2, "two")
+    assert cache.lookup("a") == (True, "two")
+
+    time.sleep(0.25)
+    assert cache.lookup("a") == (False, None)  # lease over
+    assert cache.hits == 2
+
+
+@pytest.fixture(scope="module")
+def ring():
+    nodes = []
+    for port in (5600, 5601, 5602):
+        node = DHTNode(("localhost", port), ("localhost", 5600) if nodes else None, timeout=1)
+        node.start()
+        nodes.append(node)
+        time.sleep(0.1)
+    assert wait_for(lambda: all(node.predecessor_id is not None for node in nodes), 10)
+    time.sleep(0.5)
+    yield nodes
+    for node in nodes:
+        node.done = True
+        node.join()
+
+
+def test_hot_key(ring):
+    entry = ring[0]
+    # a key the entry node forwards
+    key = next(k for k in ("hot-{}".format(i) for i in range(100))
+               if not contains(entry.predecessor_id, entry.identification, dht_hash(k)))
+    client = DHTClient(entry.addr, timeout=2)
+    assert client.put(key, "cold")
+
+    def get():
+        return client.request(entry.addr, {"method": "GET", "args": {"key": key}})
+
+    assert get()["args"] == "cold"
+    assert get()["args"] == "cold"  # hot now: the owner sends the entry node a copy
+    assert wait_for(lambda: entry.read_cache.lookup(key)[0])
+    hits = entry.read_cache.hits
+    reply = get()
+    assert reply["args"] == "cold" and "node" not in reply  # answered by the entry node
+    assert entry.read_cache.hits == hits + 1
+
+    assert client.put(key, "warm")
+    assert wait_for(lambda: not entry.read_cache.lookup(key)[0])
+    assert get()["args"] == "warm"
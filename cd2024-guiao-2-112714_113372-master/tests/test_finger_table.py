@@ -40,3 +40,41 @@ def test_finger_table():
         (3, 14, ("localhost", 5003)),
         (4, 2, ("localhost", 5004)),
     ]
+
+
+def test_finger_table_64_bits():
+    node_id = 2**63 + 5
+    f = FingerTable(node_id, ("localhost", 5000), 64)
+    assert f.getIdxFromId((node_id + 2**63) % 2**64) == 64
+    assert f.getIdxFromId(node_id + 1) == 1
+    assert f.getIdxFromId(node_id) is None
+
+    f.fill(node_id + 10, ("localhost", 5001))
+    f.update(64, 2**20, ("localhost", 5002))
+    assert f.find(2**21) == ("localhost", 5002)
+    assert f.find(node_id + 5) == ("localhost", 5001)
+    assert len(f.refresh()) == 64
+
+
+def test_finger_table_stale():
+    f = FingerTable(10, ("localhost", 5000), 4)  # starts 11, 12, 14, 2
+    f.fill(12, ("localhost", 5001))
+
+    # 11 and 12 are in (10, successor], nothing is confirmed yet for 14 and 2
+    assert f.stale(12, ("localhost", 5001)) == [
+        (3, 14, ("localhost", 5001)),
+        (4, 2, ("localhost", 5001)),
+    ]
+
+    # successor(14) = 5 also covers start 2
+    f.update_run(3, 5, ("localhost", 5002))
+    assert f.as_list == [
+        (12, ("localhost", 5001)),
+        (12, ("localhost", 5001)),
+        (5, ("localhost", 5002)),
+        (5, ("localhost", 5002)),
+    ]
+    assert f.stale(12, ("localhost", 5001)) == [(3, 14, ("localhost", 5002))]
+    assert f.find(4) == ("localhost", 5001)
+    assert f.find(8) == ("localhost", 5002)
+    f.update_run(None, 5, ("localhost", 5002))  # reply for an unknown start
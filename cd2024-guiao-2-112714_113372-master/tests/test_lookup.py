@@ -0,0 +1,87 @@
+"""Tests iterative lookups."""
+import time
+import pytest
+import utils
+from DHTClient import DHTClient, IterativeLookup
+from DHTNode import DHTNode, FingerTable
+from utils import contains, key_id
+
+
+def test_closest_fingers():
+    f = FingerTable(10, ("localhost", 5000), 4)
+    f.fill(11, ("localhost", 5001))
+    f.update(2, 12, ("localhost", 5002))
+    f.update(3, 15, ("localhost", 5003))
+    f.update(4, 3, ("localhost", 5004))
+    # closest preceding fingers, then the first one past the id
+    assert f.closest(14, 2) == [(12, ("localhost", 5002)), (11, ("localhost", 5001)), (15, ("localhost", 5003))]
+    assert f.closest(5, 3) == [(3, ("localhost", 5004)), (15, ("localhost", 5003)), (12, ("localhost", 5002))]
+    assert f.closest(11, 3) == [(11, ("localhost", 5001))]
+
+
+def test_iterative_lookup():
+    utils.configure(4)
+    try:
+        lookup = IterativeLookup(14, ("localhost", 5000), alpha=2)
+        assert lookup.next() == [("localhost", 5000)]
+        assert lookup.next() == []
+        lookup.answered(("localhost", 5000), {"nodes": [(12, ("localhost", 5002)), (3, ("localhost", 5004)),
+                                                        (11, ("localhost", 5001))]})
+        # the two closest preceding the key
+        assert lookup.next() == [("localhost", 5002), ("localhost", 5001)]
+        lookup.failed(("localhost", 5002))
+        assert lookup.next() == [("localhost", 5004)]
+        lookup.answered(("localhost", 5001), {"owner": (15, ("localhost", 5003))})
+        assert lookup.done and lookup.owner == (("localhost", 5003), 2)
+    finally:
+        utils.configure(10)
+
+
+@pytest.fixture(scope="module")
+def ring():
+    nodes = []
+    for port in (6400, 6401, 6402, 6403, 6404):
+        node = DHTNode(("localhost", port), ("localhost", 6400) if nodes else None, timeout=1)
+        node.start()
+        nodes.append(node)
+        time.sleep(0.1)
+    start = time.monotonic()
+    while not all(node.predecessor_id is not None and node.unsettled_since is None for node in nodes) \
+            and time.monotonic() - start < 10:
+        time.sleep(0.1)
+    yield nodes
+    for node in nodes:
+        if node.is_alive():
+            node.done = True
+            node.join()
+
+
+def test_lookup_modes(ring):
+    client = DHTClient(("localhost", 6400), timeout=2)
+    owners = {}
+    for i in range(30):
+        key = "lookup-{}".format(i)
+        # the routing cache would skip the lookup
+        client.routes.ids.clear()
+        assert client.put(key, i, lookup="iterative" if i % 2 else "recursive")
+        owners[key] = client.find_owner(key_id(key))[0]
+    for key, owner in owners.items():
+        node = next(node for node in ring if node.addr == owner)
+        assert contains(node.predecessor_id, node.identification, key_id(key)) and key in node.keystore
+    iterative = DHTClient(("localhost", 6400), timeout=2, lookup="iterative")
+    assert all(iterative.get(key) == int(key.split("-")[1]) for key in owners)
+
+
+def test_lookup_around_failed_node(ring):
+    entry, dead = ring[0], ring[2]
+    dead.done = True
+    dead.join()
+    keys = [k for k in ("around-{}".format(i) for i in range(200))
+            if not contains(dead.predecessor_id, dead.identification, key_id(k))]
+    client = DHTClient(entry.addr, timeout=2, lookup_timeout=0.2)
+    start = time.monotonic()
+    for key in keys[:20]:
+        owner = client.find_owner(key_id(key))
+        assert owner is not None and owner[0] != dead.addr
+    # lookups through the dead node's fingers time out and go on with other nodes
+    assert time.monotonic() - start < 20 * 0.2 * 2
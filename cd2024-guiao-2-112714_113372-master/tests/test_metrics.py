@@ -0,0 +1,58 @@
+"""Tests node metrics and the STATS query."""
+import time
+import pytest
+from DHTClient import DHTClient
+from DHTNode import DHTNode
+from metrics import Histogram, HOP_BUCKETS, LATENCY_BUCKETS
+
+
+def test_histogram():
+    hops = Histogram(HOP_BUCKETS)
+    assert hops.snapshot()["p50"] is None
+    for value in [0, 1, 1, 2, 2, 2, 3, 40]:
+        hops.observe(value)
+    snapshot = hops.snapshot()
+    assert snapshot["count"] == 8 and snapshot["max"] == 40
+    assert snapshot["p50"] == 2 and snapshot["p99"] == 40
+    assert snapshot["buckets"] == [[0, 1], [1, 2], [2, 3], [3, 1], [None, 1]]
+
+    latency = Histogram(LATENCY_BUCKETS)
+    latency.observe(0.0003)
+    assert 0.0003 <= latency.percentile(50) < 0.0006
+
+
+@pytest.fixture(scope="module")
+def ring():
+    nodes = []
+    for port in (6100, 6101, 6102, 6103):
+        node = DHTNode(("localhost", port), ("localhost", 6100) if nodes else None, timeout=1, min_interval=0.05)
+        node.start()
+        nodes.append(node)
+        time.sleep(0.1)
+    start = time.monotonic()
+    while not all(node.predecessor_id is not None and node.unsettled_since is None for node in nodes) \
+            and time.monotonic() - start < 10:
+        time.sleep(0.1)
+    yield nodes
+    for node in nodes:
+        node.done = True
+        node.join()
+
+
+def test_stats(ring):
+    client = DHTClient(("localhost", 6100), timeout=2)
+    for i in range(20):
+        # through the entry node, not to the owners straight away
+        assert client.request(("localhost", 6100), {"method": "PUT", "args": {"key": str(i), "value": i}})
+
+    stats = [client.stats(node.addr) for node in ring]
+    assert [s["id"] for s in stats] == [node.identification for node in ring]
+    assert sum(s["keys"] for s in stats) == 20
+    assert sum(s["hops"]["count"] for s in stats) == 20
+    assert any(s["hops"]["max"] for s in stats if s["hops"]["count"])
+    entry = stats[0]
+    assert entry["counters"]["PUT"] == 20
+    assert entry["latency"]["PUT"]["count"] == 20
+    assert entry["counters"].get("forwarded_to_successor", 0) + entry["counters"].get("forwarded_to_finger", 0) > 0
+    assert all(s["convergence_rounds"]["count"] >= 1 for s in stats)
+    assert all(0 <= s["stale_fingers"] <= 10 for s in stats)
@@ -0,0 +1,79 @@
+"""Tests key handoff when nodes join and leave a separate DHT."""
+import time
+import pytest
+from DHTClient import DHTClient
+from DHTNode import DHTNode
+from utils import dht_hash, contains
+
+PORTS = [5300, 5301, 5302]
+KEYS = {"migrate-{}".format(i): i for i in range(200)}
+
+
+def wait_for(condition, timeout=15):
+    start = time.monotonic()
+    while time.monotonic() - start < timeout:
+        if condition():
+            return True
+        time.sleep(0.1)
+    return False
+
+
+def start_node(port, dht_address):
+    node = DHTNode(("localhost", port), dht_address, timeout=0.5, migrate_batch=10, migrate_interval=0.05)
+    node.start()
+    return node
+
+
+def stable(nodes):
+    return all(n.predecessor_id is not None and not n.handoff and not n.inflight for n in nodes)
+
+
+def misplaced(nodes):
+    return [key for n in nodes for key in n.keystore
+            if not contains(n.predecessor_id, n.identification, dht_hash(key))]
+
+
+@pytest.fixture(scope="module")
+def ring():
+    nodes = []
+    for port in PORTS:
+        nodes.append(start_node(port, ("localhost", PORTS[0]) if nodes else None))
+        time.sleep(0.2)
+    assert wait_for(lambda: stable(nodes))
+    client = DHTClient(("localhost", PORTS[0]), timeout=2)
+    assert client.put_many(KEYS)
+    yield nodes
+    for node in nodes:
+        node.done = True
+        node.join()
+
+
+def test_join_handoff(ring):
+    client = DHTClient(("localhost", PORTS[0]), timeout=2)
+    node = start_node(5310, ("localhost", PORTS[0]))
+    ring.append(node)
+
+    # lookups keep working while the keys are being handed over
+    deadline = time.monotonic() + 3
+    while time.monotonic() < deadline:
+        assert client.get_many(list(KEYS)) == KEYS
+        client.ring = None
+
+    assert wait_for(lambda: stable(ring) and not misplaced(ring))
+    assert node.keystore
+    assert sum(len(n.keystore) for n in ring) == len(KEYS)
+
+
+def test_graceful_leave(ring):
+    node = next(n for n in ring if n.addr[1] != PORTS[0] and n.keystore)
+    successor = next(n for n in ring if n.identification == node.successor_id)
+    moved = dict(node.keystore)
+    node.leave()
+    node.join()
+    ring.remove(node)
+
+    assert node.keystore == {}
+    assert all(successor.keystore[key] == value for key, value in moved.items())
+    assert wait_for(lambda: stable(ring) and not misplaced(ring))
+    client = DHTClient(("localhost", PORTS[0]), timeout=2)
+    assert client.get_many(list(KEYS)) == KEYS
@@ -0,0 +1,67 @@
+"""Tests batched requests involving a running DHT."""
+import time
+import pytest
+from DHTClient import DHTClient
+from DHTNode import DHTNode
+
+
+@pytest.fixture()
+def client():
+    return DHTClient(("localhost", 5000), timeout=5)
+
+
+def test_ring_view(client):
+    ring = client.refresh_ring()
+    assert len(ring) >= 5
+    assert ring.ids == sorted(ring.ids)
+
+
+def test_put_many(client):
+    items = {"batch-{}".format(i): i for i in range(500)}
+    assert client.put_many(items, batch_size=50)
+
+
+def test_get_many(client):
+    keys = ["batch-{}".format(i) for i in range(500)]
+    values = client.get_many(keys + ["batch-missing"], batch_size=50)
+    assert values == {**{key: i for i, key in enumerate(keys)}, "batch-missing": None}
+
+
+def test_get_after_put_many(client):
+    assert client.get("batch-7") == 7
+
+
+def test_unreachable_node():
+    client = DHTClient(("localhost", 6890), timeout=0.2, retries=1)
+    assert client.refresh_ring() is None
+    assert not client.put_many({"batch-0": 0})
+    assert client.get_many(["batch-0"]) == {"batch-0": None}
+    assert list(client.scan()) == []
+
+
+def test_lost_request():
+    node = DHTNode(("localhost", 6891), timeout=1)
+    dropped = []
+
+    def drop_first(handler):
+        def handle(output, addr):
+            if output["method"] not in dropped:
+                dropped.append(output["method"])
+                return
+            handler(output, addr)
+        return handle
+
+    for method in ("PUT", "GET", "PUT_MANY", "GET_MANY", "INFO"):
+        node.handlers[method] = drop_first(node.handlers[method])
+    node.start()
+    time.sleep(0.2)
+    try:
+        client = DHTClient(("localhost", 6891))  # resends after its default timeout
+        assert client.refresh_ring() is not None
+        assert client.put("lost-0", 0) and client.get("lost-0") == 0
+        assert client.put_many({"lost-1": 1, "lost-2": 2})
+        assert client.get_many(["lost-1", "lost-2"]) == {"lost-1": 1, "lost-2": 2}
+        assert sorted(dropped) == ["GET", "GET_MANY", "INFO", "PUT", "PUT_MANY"]
+    finally:
+        node.done = True
+        node.join()
@@ -0,0 +1,47 @@
+"""Tests answering GETs of missing keys."""
+import time
+import pytest
+from DHTClient import DHTClient
+from DHTNode import DHTNode
+
+
+@pytest.fixture(scope="module")
+def ring():
+    nodes = []
+    for port in (6800, 6801, 6802):
+        node = DHTNode(("localhost", port), ("localhost", 6800) if nodes else None, timeout=1)
+        node.start()
+        nodes.append(node)
+        time.sleep(0.1)
+    start = time.monotonic()
+    while not all(node.predecessor_id is not None and node.unsettled_since is None for node in nodes) \
+            and time.monotonic() - start < 10:
+        time.sleep(0.1)
+    yield nodes
+    for node in nodes:
+        if node.is_alive():
+            node.done = True
+            node.join()
+
+
+def test_missing_keys(ring):
+    client = DHTClient(("localhost", 6800), timeout=2)
+    assert client.put_many({"present-{}".format(i): i for i in range(100)})
+    assert all(client.get("missing-{}".format(i)) is None for i in range(100))
+    out = client.request(("localhost", 6800), {"method": "GET", "args": {"key": "missing-0"}})
+    assert out["method"] == "NOT_FOUND"
+    assert all(node.is_alive() for node in ring)
+    assert sum(node.metrics.counters["not_found"] for node in ring) > 90
+    assert all(client.get("present-{}".format(i)) == i for i in range(100))
+
+
+def test_missing_keys_after_migration(ring):
+    client = DHTClient(("localhost", 6800), timeout=2)
+    node = DHTNode(("localhost", 6810), ("localhost", 6800), timeout=1)
+    node.start()
+    ring.append(node)
+    start = time.monotonic()
+    while not (node.keystore and not any(n.handoff or n.inflight for n in ring)) and time.monotonic() - start < 10:
+        time.sleep(0.1)
+    assert all(client.get("present-{}".format(i)) == i for i in range(100))
+    assert client.get("missing-0") is None
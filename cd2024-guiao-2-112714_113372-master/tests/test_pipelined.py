@@ -0,0 +1,33 @@
+"""Tests the pipelined asyncio client involving a running DHT."""
+import asyncio
+import pytest
+from DHTAsyncClient import AsyncDHTClient
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_pipelined_put_get():
+    async def scenario():
+        client = await AsyncDHTClient.connect(("localhost", 5000))
+        keys = ["pipe-{}".format(i) for i in range(300)]
+        assert all(await asyncio.gather(*(client.put(key, key.upper()) for key in keys)))
+        values = await asyncio.gather(*(client.get(key) for key in keys))
+        client.close()
+        return keys, values
+
+    keys, values = run(scenario())
+    assert values == [key.upper() for key in keys]
+
+
+def test_request_timeout():
+    async def scenario():
+        # nothing listens on this port, every retry times out
+        client = await AsyncDHTClient.connect(("localhost", 5999), timeout=0.05, retries=2)
+        with pytest.raises(asyncio.TimeoutError):
+            await client.get("A")
+        assert client.pending == {}
+        client.close()
+
+    run(scenario())
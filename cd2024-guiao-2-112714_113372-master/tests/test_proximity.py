@@ -0,0 +1,80 @@
+"""Tests proximity neighbour selection of fingers."""
+import time
+import pytest
+from DHTClient import DHTClient
+from DHTNode import DHTNode, FingerTable
+
+
+def test_finger_candidates():
+    f = FingerTable(0, ("localhost", 5000), 5, candidates=3)  # intervals [1], [2, 3], [4, 7], [8, 15], [16, 31]
+    f.fill(9, ("localhost", 5009))
+    f.update(5, 17, ("localhost", 5017))
+    assert f.find(30) == ("localhost", 5017)
+
+    assert f.add_candidate(20, ("localhost", 5020))
+    assert f.add_candidate(25, ("localhost", 5025))
+    assert not f.add_candidate(28, ("localhost", 5028))  # interval full
+    assert not f.add_candidate(8, ("localhost", 5008))  # precedes the entry of [8, 15]: a node that left
+    assert f.find(30) == ("localhost", 5017)  # nothing measured yet
+
+    f.observe(("localhost", 5017), 0.050)
+    f.observe(("localhost", 5025), 0.002)
+    assert f.find(30) == ("localhost", 5025)
+    assert f.find(22) == ("localhost", 5009)  # 25 is past 22: the closest preceding finger of a lower interval
+    assert f.closest(30, 1) == [(25, ("localhost", 5025))]
+    assert f.as_list[4] == (17, ("localhost", 5017))  # entries are still the exact successors
+
+    f.forget(("localhost", 5025))
+    assert f.find(30) == ("localhost", 5017)
+    assert f.probe_targets() == [(("localhost", 5009), 9), (("localhost", 5017), 17), (("localhost", 5020), 20)]
+
+
+class SlowNode(DHTNode):
+    """ A node behind a slow link: every message takes `lag` seconds more to be handled."""
+
+    lag = 0.03
+
+    def dispatch(self, output, addr):
+        time.sleep(self.lag)
+        super().dispatch(output, addr)
+
+
+@pytest.fixture(scope="module")
+def ring():
+    nodes = []
+    for i, port in enumerate(range(6500, 6510)):
+        cls = SlowNode if i % 3 == 1 else DHTNode
+        node = cls(("localhost", port), ("localhost", 6500) if nodes else None, timeout=0.5)
+        node.start()
+        nodes.append(node)
+        time.sleep(0.1)
+    start = time.monotonic()
+    while not all(node.predecessor_id is not None and node.unsettled_since is None for node in nodes) \
+            and time.monotonic() - start < 15:
+        time.sleep(0.1)
+    time.sleep(5)  # a few passes of PINGs
+    yield nodes
+    for node in nodes:
+        node.done = True
+        node.join()
+
+
+def test_routes_avoid_slow_nodes(ring):
+    slow = {node.addr for node in ring if isinstance(node, SlowNode)}
+    avoided = 0
+    for node in ring:
+        table = node.finger_table
+        for i, (entry, route) in enumerate(zip(table.finger_table, table.routes)):
+            fast = [addr for addr in table.alternates[i] if addr not in slow and addr in table.rtt]
+            if entry[1] in slow and fast and table._interval(entry[0]) == i:
+                # a measured node of the same interval, behind a fast link, is used instead
+                # (an entry outside its interval, e.g. the node itself, has no alternates to use)
+                assert route[1] not in slow
+                avoided += 1
+    assert avoided > 0
+    assert sum(DHTClient(node.addr, timeout=2).stats()["proximity_fingers"] for node in ring) > 0
+
+    client = DHTClient(("localhost", 6500), timeout=2)
+    for i in range(20):
+        assert client.request(("localhost", 6500), {"method": "PUT", "args": {"key": str(i), "value": i}})
+    assert all(client.get(str(i)) == i for i in range(20))
@@ -0,0 +1,117 @@
+"""Tests successor-list replication on a separate, replicated DHT."""
+import time
+import pytest
+from DHTClient import DHTClient
+from DHTNode import DHTNode
+from utils import dht_hash, contains
+
+PORTS = [5200, 5201, 5202, 5203, 5204]
+
+
+def wait_for(condition, timeout=15):
+    start = time.monotonic()
+    while time.monotonic() - start < timeout:
+        if condition():
+            return True
+        time.sleep(0.2)
+    return False
+
+
+@pytest.fixture(scope="module")
+def ring():
+    nodes = []
+    for port in PORTS:
+        dht_address = ("localhost", PORTS[0]) if nodes else None
+        node = DHTNode(("localhost", port), dht_address, timeout=0.5, replicas=3, consistency="quorum")
+        node.start()
+        nodes.append(node)
+        time.sleep(0.2)
+    assert wait_for(lambda: all(len(node.successor_list) == 2 for node in nodes))
+    yield nodes
+    for node in nodes:
+        node.done = True
+        node.join()
+
+
+def owner(nodes, key):
+    return next((n for n in nodes if n.predecessor_id is not None
+                 and contains(n.predecessor_id, n.identification, dht_hash(key))), None)
+
+
+def copies(nodes, key):
+    return sum(key in node.keystore or key in node.replica_store for node in nodes)
+
+
+def test_replicated_put(ring):
+    client = DHTClient(("localhost", PORTS[0]), timeout=2)
+    for i in range(30):
+        assert client.put("replica-{}".format(i), i)
+    assert wait_for(lambda: all(copies(ring, "replica-{}".format(i)) == 3 for i in range(30)), 5)
+    for i in range(30):
+        assert client.get("replica-{}".format(i)) == i
+
+
+def test_read_from_replica(ring):
+    client = DHTClient(("localhost", PORTS[0]), timeout=2)
+    assert client.put("replica-read", "v1")
+    node = owner(ring, "replica-read")
+    replica = next(n for n in ring if n.addr == node.replica_addrs()[0])
+    assert wait_for(lambda: replica.replica_store.get("replica-read", (0, None))[1] == "v1", 5)
+
+    replica.consistency = "one"
+    try:
+        out = client.request(replica.addr, {"method": "GET", "args": {"key": "replica-read", "direct": True}})
+    finally:
+        replica.consistency = "quorum"
+    assert out["method"] == "ACK"
+    assert out["args"] == "v1"
+
+
+def test_owner_failure(ring):
+    key = "replica-failover"
+    victim = owner(ring, key)
+    entry = next(n for n in ring if n is not victim)
+    client = DHTClient(("localhost", entry.addr[1]), timeout=2)
+    assert client.put(key, "survives")
+    assert wait_for(lambda: copies(ring, key) == 3, 5)
+
+    victim.done = True
+    victim.join()
+    ring.remove(victim)
+    assert wait_for(lambda: owner(ring, key) is not None and key in owner(ring, key).keystore)
+    assert client.request(owner(ring, key).addr, {"method": "GET", "args": {"key": key}})["args"] == "survives"
+
+
+def test_join_then_overwrite():
+    # replicas=2, read-one: a node joining between a key's owner and its replica takes the replica over
+    first = DHTNode(("localhost", 5250), timeout=0.5, replicas=2)
+    second = DHTNode(("localhost", 5251), ("localhost", 5250), timeout=0.5, replicas=2)
+    nodes = [first, second]
+    for node in nodes:
+        node.start()
+        time.sleep(0.2)
+    try:
+        assert wait_for(lambda: first.replica_addrs() == [second.addr] and second.replica_addrs() == [first.addr])
+        owner_node = max(nodes, key=lambda n: (n.identification - n.predecessor_id) % 1024)
+        replica = second if owner_node is first else first
+        port = next(p for p in range(5252, 5300)
+                    if contains(owner_node.identification, replica.identification, dht_hash(str(("localhost", p)))))
+        key = next(k for k in ("stale-{}".format(i) for i in range(1000))
+                   if contains(replica.identification, owner_node.identification, dht_hash(k)))
+        client = DHTClient(owner_node.addr, timeout=2)
+        assert client.put(key, "old")
+        assert wait_for(lambda: replica.replica_store.get(key, (0, None))[1] == "old", 5)
+
+        joined = DHTNode(("localhost", port), owner_node.addr, timeout=0.5, replicas=2)
+        joined.start()
+        nodes.append(joined)
+        assert wait_for(lambda: owner_node.replica_addrs() == [joined.addr] and replica.predecessor_id == joined.identification)
+        assert client.put(key, "new")
+        assert wait_for(lambda: joined.replica_store.get(key, (0, None))[1] == "new", 5)
+        assert wait_for(lambda: key not in replica.replica_store, 5)
+        out = client.request(replica.addr, {"method": "GET", "args": {"key": key}})
+        assert out["method"] == "ACK" and out["args"] == "new"
+    finally:
+        for node in nodes:
+            node.done = True
+            node.join()
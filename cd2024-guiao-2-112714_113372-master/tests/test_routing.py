@@ -0,0 +1,60 @@
+"""Tests the client routing cache."""
+import pytest
+from DHTClient import DHTClient, RoutingCache
+from utils import dht_hash
+
+
+def test_routing_cache():
+    routes = RoutingCache()
+    assert routes.lookup(100) is None
+
+    routes.learn({"id": 300, "addr": ("localhost", 5001), "predecessor_id": 100})
+    routes.learn({"id": 100, "addr": ("localhost", 5002), "predecessor_id": 800})
+    routes.learn({"id": 500, "addr": ("localhost", 5003), "predecessor_id": None})  # unknown range
+
+    assert routes.lookup(200) == ("localhost", 5001)
+    assert routes.lookup(300) == ("localhost", 5001)
+    assert routes.lookup(900) == ("localhost", 5002)
+    assert routes.lookup(50) == ("localhost", 5002)
+    assert routes.lookup(400) is None
+    assert len(routes) == 2
+
+    # a node joined in (100, 300], then left again
+    routes.learn({"id": 200, "addr": ("localhost", 5004), "predecessor_id": 100})
+    assert routes.lookup(150) == ("localhost", 5004)
+    routes.learn({"id": 300, "addr": ("localhost", 5001), "predecessor_id": 100})
+    assert routes.lookup(150) == ("localhost", 5001)
+    assert len(routes) == 2
+
+    routes.forget(("localhost", 5001))
+    assert routes.lookup(200) is None
+
+
+@pytest.fixture()
+def client():
+    return DHTClient(("localhost", 5000), timeout=2)
+
+
+def test_cached_route(client):
+    assert client.put("route", "one hop")
+    owner = client.routes.lookup(dht_hash("route"))
+    assert owner is not None
+
+    sent = []
+    request = client.request
+    client.request = lambda address, msg: sent.append(address) or request(address, msg)
+    assert client.get("route") == "one hop"
+    assert sent == [owner]
+
+
+def test_stale_route_redirect(client):
+    assert client.put("route", "one hop")
+    key_hash = dht_hash("route")
+    owner = client.routes.lookup(key_hash)
+    wrong = ("localhost", 5000) if owner != ("localhost", 5000) else ("localhost", 5001)
+    client.routes = RoutingCache()
+    client.routes.learn({"id": (key_hash + 1) % 1024, "addr": wrong, "predecessor_id": (key_hash - 1) % 1024})
+    assert client.routes.lookup(key_hash) == wrong
+
+    assert client.get("route") == "one hop"
+    assert client.routes.lookup(key_hash) == owner
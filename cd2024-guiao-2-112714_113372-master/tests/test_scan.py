@@ -0,0 +1,89 @@
+"""Tests range scans on separate DHTs, with order preserving and hash placement."""
+import time
+import pytest
+import utils
+from DHTClient import DHTClient, RingView
+from DHTNode import ChordNode, DHTNode, scan_order
+
+ITEMS = {"{}-{:02d}".format(letter, i): i for letter in "abcdefghijklmnopqrstuvwxyz" for i in range(8)}
+
+
+def test_key_order():
+    try:
+        utils.configure(placement="order")
+        ids = utils.key_ids(sorted(ITEMS))
+        assert ids == sorted(ids)
+        assert utils.key_id("a") < utils.key_id("b") <= utils.key_id("b-07") < utils.key_id("c")
+        with pytest.raises(ValueError):
+            utils.configure(placement="range")
+    finally:
+        utils.configure(placement="hash")
+
+
+def test_owners():
+    ring = RingView([(100, "a"), (400, "b"), (900, "c")])
+    assert ring.owners(150, 300) == ["b"]
+    assert ring.owners(50, 500) == ["a", "b", "c"]
+    assert ring.owners(950, 1023) == ["a"]
+    assert ring.owners(800, 1000) == ["c", "a"]
+    assert ring.owners(0, 1023) == ["a", "b", "c"]
+
+
+@pytest.fixture(scope="module", params=["order", "hash"])
+def client(request):
+    utils.configure(placement=request.param)
+    port = 5900 if request.param == "order" else 5910
+    nodes = []
+    # with order placement the keys ("a-00" ... "z-07") have ids 388 to 488: spread them over the nodes
+    for i, identification in enumerate([420, 460, 1000]):
+        node = DHTNode(("localhost", port + i), ("localhost", port) if nodes else None, timeout=1,
+                       identification=identification if request.param == "order" else None)
+        node.start()
+        nodes.append(node)
+        time.sleep(0.1)
+    start = time.monotonic()
+    while any(node.predecessor_id is None for node in nodes) and time.monotonic() - start < 10:
+        time.sleep(0.1)
+    time.sleep(0.5)
+    client = DHTClient(("localhost", port), timeout=2)
+    assert client.put_many(ITEMS)
+    assert sum(1 for node in nodes if node.keystore) > 1
+    yield client
+    for node in nodes:
+        node.done = True
+        node.join()
+    utils.configure(placement="hash")
+
+
+def test_scan(client):
+    assert list(client.scan()) == sorted(ITEMS.items())
+    assert list(client.scan("c", "f")) == [(k, v) for k, v in sorted(ITEMS.items()) if "c" <= k < "f"]
+    assert list(client.scan("x-05")) == [("x-05", 5), ("x-06", 6), ("x-07", 7)] + [
+        (k, v) for k, v in sorted(ITEMS.items()) if k >= "y"]
+
+
+def test_scan_limit_and_pages(client):
+    assert list(client.scan("m", limit=10)) == sorted(ITEMS.items())[12 * 8:12 * 8 + 10]
+    assert list(client.scan(end="e", page_size=3)) == sorted(ITEMS.items())[:4 * 8]
+    assert list(client.scan("zz")) == []
+
+
+def test_scan_index():
+    node = ChordNode(("localhost", 5920), timeout=1)
+    sent = []
+    node.send = lambda address, msg: sent.append(msg)
+    for key, value in ITEMS.items():
+        node.keep(key, value, 1)
+    node.keep(3, "three", 1)  # keys of another type are kept apart
+    node.discard("b-03")
+    node.expire_keys(["c-00"])
+    assert node.key_order == sorted(map(scan_order, node.keystore))
+    keys, after = [], None
+    while True:
+        node.scan("b", "d", after, 5, None, 0)
+        args = sent.pop()["args"]
+        keys += [key for key, _ in args["items"]]
+        if not args["more"]:
+            break
+        after = keys[-1]
+    assert keys == [key for key in sorted(ITEMS) if "b" <= key < "d" and key not in ("b-03", "c-00")]
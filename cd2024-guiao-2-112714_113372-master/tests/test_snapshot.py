@@ -0,0 +1,68 @@
+"""Tests bulk import and export of snapshots."""
+import time
+import pytest
+from DHTClient import DHTClient
+from DHTNode import DHTNode
+from snapshot import SnapshotWriter, bulk_import, export, read_snapshot
+
+
+def test_snapshot_file(tmp_path):
+    path = str(tmp_path / "test.snap")
+    with SnapshotWriter(path) as snapshot:
+        snapshot.write("a", [1, 2, 3])
+        snapshot.write(b"b", {"x": None}, expires=1234.5)
+    assert list(read_snapshot(path)) == [("a", [1, 2, 3], None), (b"b", {"x": None}, 1234.5)]
+
+
+def start_ring(ports):
+    nodes = []
+    for port in ports:
+        node = DHTNode(("localhost", port), ("localhost", ports[0]) if nodes else None, timeout=1)
+        node.start()
+        nodes.append(node)
+        time.sleep(0.1)
+    start = time.monotonic()
+    while not all(node.predecessor_id is not None and node.unsettled_since is None for node in nodes) \
+            and time.monotonic() - start < 10:
+        time.sleep(0.1)
+    return nodes
+
+
+@pytest.fixture(scope="module")
+def rings():
+    source, target = start_ring([6850, 6851, 6852]), start_ring([6860, 6861, 6862, 6863, 6864])
+    yield source, target
+    for node in source + target:
+        node.done = True
+        node.join()
+
+
+def test_export_import(rings, tmp_path):
+    source, target = rings
+    items = {"snap-{}".format(i): "value-{}".format(i) * (i % 50) for i in range(3000)}
+    client = DHTClient(("localhost", 6850), timeout=2)
+    assert client.put_many(items)
+    assert client.put_many({"session-{}".format(i): i for i in range(10)}, ttl=60)
+
+    exported = export(client, str(tmp_path / "export"), page_size=500)
+    assert len(exported) == 3 and sum(exported.values()) == 3010
+    for node in source:
+        path = str(tmp_path / "export" / "localhost_{}.snap".format(node.addr[1]))
+        assert {key: value for key, value, _ in read_snapshot(path)} == dict(node.keystore)
+
+    # a later file overrides the values of the earlier ones, expired records are skipped
+    extra = str(tmp_path / "extra.snap")
+    with SnapshotWriter(extra) as snapshot:
+        snapshot.write("snap-0", "updated")
+        snapshot.write("gone", "value", expires=time.time() - 1)
+    report = bulk_import(DHTClient(("localhost", 6860), timeout=2), sorted(exported) + [extra],
+                         batch_bytes=20000, window=4)
+    assert report["keys"] == 3010 and report["missing"] == 0 and report["expired"] == 1
+    assert report["owners"] == 5 and report["batches"] >= 10
+
+    check = DHTClient(("localhost", 6860), timeout=2)
+    assert check.get_many(list(items)) == dict(items, **{"snap-0": "updated"})
+    assert check.get("gone") is None
+    owners = [node for node in target if "session-0" in node.keystore]
+    assert owners and owners[0].ttl.deadline("session-0") > time.time() + 50
+    assert sum(len(node.keystore) for node in target) == 3010
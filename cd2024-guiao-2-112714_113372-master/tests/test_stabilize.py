@@ -0,0 +1,42 @@
+"""Tests adaptive stabilization on a separate DHT."""
+import time
+import pytest
+from DHTNode import DHTNode
+
+
+def wait_for(condition, timeout=10):
+    start = time.monotonic()
+    while time.monotonic() - start < timeout:
+        if condition():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+@pytest.fixture(scope="module")
+def ring():
+    nodes = []
+    for port in (5500, 5501, 5502):
+        node = DHTNode(("localhost", port), ("localhost", 5500) if nodes else None, timeout=1, min_interval=0.05)
+        node.start()
+        nodes.append(node)
+        time.sleep(0.1)
+    yield nodes
+    for node in nodes:
+        node.done = True
+        node.join()
+
+
+def test_backoff_and_speed_up(ring):
+    # a settled ring backs off to max_interval (= timeout)
+    assert wait_for(lambda: all(node.interval == 1 for node in ring))
+    rounds = [node.stabilize_rounds for node in ring]
+    time.sleep(1.5)
+    assert all(node.stabilize_rounds - r <= 3 for node, r in zip(ring, rounds))
+
+    node = DHTNode(("localhost", 5503), ("localhost", 5500), timeout=1, min_interval=0.05)
+    node.start()
+    # its neighbours stabilize fast again, and back off once the ring settled
+    assert wait_for(lambda: any(n.interval < 1 for n in ring), 3)
+    ring.append(node)
+    assert wait_for(lambda: node.predecessor_id is not None and all(n.interval == 1 for n in ring))
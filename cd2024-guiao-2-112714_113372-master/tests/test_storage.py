@@ -0,0 +1,172 @@
+"""Tests the storage engines."""
+import os
+import time
+from DHTClient import DHTClient
+from DHTNode import DHTNode
+from storage import LogStorage, MemoryStorage
+from utils import contains, dht_hash
+
+
+def test_log_storage(tmp_path):
+    store = LogStorage(str(tmp_path))
+    store["a"] = "Aveiro"
+    store["b"] = [1, 2, {"c": b"bytes"}]
+    store["a"] = "Porto"
+    del store["b"]
+    assert store == {"a": "Porto"}
+    assert "b" not in store and store.get("b") is None
+    store["b"] = 3
+    store.close()
+
+    store = LogStorage(str(tmp_path))
+    assert store == {"a": "Porto", "b": 3}
+    store.close()
+
+
+def test_recovery_without_index(tmp_path):
+    # a crash leaves no index snapshot and possibly a torn record at the end of the log
+    store = LogStorage(str(tmp_path))
+    for i in range(100):
+        store[str(i)] = i
+    del store["0"]
+    size = store.size
+    os.close(store.fd)
+    with open(os.path.join(str(tmp_path), "data.log"), "ab") as f:
+        f.write(b"\x00\x00\x00\x00\x09partial")
+
+    store = LogStorage(str(tmp_path))
+    assert store.size == size == os.path.getsize(store.log_path)
+    assert len(store) == 99 and store["99"] == 99
+    store["new"] = "value"
+    store.close()
+    assert LogStorage(str(tmp_path))["new"] == "value"
+
+
+def test_recovery_scans_only_the_tail(tmp_path):
+    store = LogStorage(str(tmp_path))
+    store["old"] = "x" * 1000
+    store.close()
+    store = LogStorage(str(tmp_path))
+    store["new"] = 1
+    os.close(store.fd)  # crash: the index snapshot covers "old" only
+
+    store = LogStorage(str(tmp_path))
+    assert store == {"old": "x" * 1000, "new": 1}
+
+
+def test_compaction(tmp_path):
+    store = LogStorage(str(tmp_path), compact_min=10000)
+    for i in range(200):
+        store["key"] = "value {}".format(i) * 10
+    assert store.compactions > 0
+    assert store.size < 10000
+    store["other"] = 1
+    store.close()
+    store = LogStorage(str(tmp_path))
+    assert store == {"key": "value 199" * 10, "other": 1}
+
+
+def test_view(tmp_path):
+    store = LogStorage(str(tmp_path), compact_min=10000)
+    store["a"] = "Aveiro"
+    store["b"] = "Braga"
+    view = store.view()
+    for i in range(200):  # would compact the log away from under the view
+        store["a"] = "value {}".format(i) * 10
+    del store["b"]
+    store["c"] = "Coimbra"
+    assert store.compactions == 0
+    assert dict(view) == {"a": "Aveiro", "b": "Braga"}
+    view.close()
+    assert store.compactions == 1
+    assert store == {"a": "value 199" * 10, "c": "Coimbra"}
+    store.close()
+
+
+def test_versions(tmp_path):
+    store = LogStorage(str(tmp_path))
+    store.put("a", "Aveiro", 3)
+    store.put("b", "Braga", 1)
+    store["a"] = "Porto"  # keeps the version
+    del store["b"]
+    store.close()
+    store = LogStorage(str(tmp_path))
+    assert store.versions == {"a": 3}
+    store.put("c", "Coimbra", 7)
+    os.close(store.fd)  # crash: "c" is only in the log
+
+    store = LogStorage(str(tmp_path))
+    assert store.versions == {"a": 3, "c": 7} and store["c"] == "Coimbra"
+    store.close()
+
+
+def test_memory_storage():
+    store = MemoryStorage(a=1)
+    store.put("b", 2, 5)
+    store["c"] = 3
+    store["b"] = 4  # keeps the version
+    view = store.view()
+    del store["a"]
+    store.close()
+    assert store == {"b": 4, "c": 3} and store.versions == {"b": 5, "c": 0}
+    assert view == {"a": 1, "b": 4, "c": 3} and view.versions == {"a": 0, "b": 5, "c": 0}
+
+
+def start_node(port, path):
+    node = DHTNode(("localhost", port), timeout=1, storage=LogStorage(path))
+    node.start()
+    while node.predecessor_id is None:  # a lone node is its own predecessor after its first stabilize round
+        time.sleep(0.05)
+    return node
+
+
+def test_node_restart(tmp_path):
+    node = start_node(5800, str(tmp_path))
+    client = DHTClient(("localhost", 5800), timeout=2)
+    assert client.put("persistent", "value")
+    node.done = True
+    node.join()
+
+    node = start_node(5801, str(tmp_path))
+    try:
+        assert DHTClient(("localhost", 5801), timeout=2).get("persistent") == "value"
+    finally:
+        node.done = True
+        node.join()
+
+
+def test_owner_restart_keeps_versions(tmp_path):
+    # the replica holds the versions written before the restart: new writes must be newer
+    first = DHTNode(("localhost", 5802), timeout=0.5, replicas=2)
+    first.start()
+    time.sleep(0.2)
+    owner = DHTNode(("localhost", 5803), ("localhost", 5802), timeout=0.5, replicas=2, storage=LogStorage(str(tmp_path)))
+    owner.start()
+    nodes = [first, owner]
+    try:
+        while not (owner.replica_addrs() == [first.addr] and first.replica_addrs() == [owner.addr]):
+            time.sleep(0.05)
+        key = next(k for k in ("restart-{}".format(i) for i in range(1000))
+                   if contains(first.identification, owner.identification, dht_hash(k)))
+        client = DHTClient(owner.addr, timeout=2)
+        for i in range(5):
+            assert client.put(key, i)
+        owner.done = True
+        owner.join()
+
+        owner = DHTNode(("localhost", 5803), ("localhost", 5802), timeout=0.5, replicas=2,
+                        storage=LogStorage(str(tmp_path)))
+        owner.start()
+        nodes[1] = owner
+        assert owner.versions[key] == 5
+        while owner.replica_addrs() != [first.addr]:
+            time.sleep(0.05)
+        assert client.put(key, "new")
+        start = time.monotonic()
+        while first.replica_store.get(key) != (6, "new") and time.monotonic() - start < 5:
+            time.sleep(0.05)
+        assert first.replica_store[key] == (6, "new")
+    finally:
+        for node in nodes:
+            node.done = True
+            node.join()
@@ -0,0 +1,106 @@
+"""Tests the TCP transport of large messages."""
+import os
+import socket
+import time
+import pytest
+from codec import Codec, StreamDecoder, encode, CodecError
+from DHTClient import DHTClient
+from DHTNode import DHTNode
+from stream import Streams
+
+
+def test_stream_decoder():
+    messages = [{"method": "PUT", "args": {"key": str(i), "value": os.urandom(i * 1000)}} for i in range(5)]
+    data = b"".join(Codec().frames(msg)[0] for msg in messages)
+    decoder = StreamDecoder()
+    received = []
+    for i in range(0, len(data), 777):  # frames split anywhere
+        received += decoder.feed(data[i:i + 777])
+    assert received == messages
+
+    with pytest.raises(CodecError):
+        StreamDecoder(max_message=100).feed(Codec().frames(messages[1])[0])
+
+
+def test_fallback():
+    # a peer without a TCP listener (like an AsyncDHTNode) gets the message as datagrams
+    peer = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    peer.bind(("localhost", 6310))
+    sent = []
+    streams = Streams(6311, fallback=lambda address, body: sent.append((address, body)))
+    body = encode({"method": "PUT", "args": {"key": "k", "value": "v"}})
+    try:
+        if streams.send(("localhost", 6310), body):  # else refused straight away, the caller sends datagrams
+            start = time.monotonic()
+            while not sent and time.monotonic() - start < 2:
+                streams.poll(0.1)
+            assert sent == [(("localhost", 6310), body)]
+        assert not streams.send(("localhost", 6310), body)  # not tried again for a while
+    finally:
+        streams.close()
+        peer.close()
+
+
+def test_peer_address():
+    # the accepting side attributes messages to the host the other side announces, and answers on its connection
+    a = Streams(6320, host="localhost")
+    b = Streams(6321, host="localhost")
+    a.listen(("localhost", 6320))
+    b.listen(("localhost", 6321))
+    received = {a: [], b: []}
+
+    def poll(streams, count):
+        start = time.monotonic()
+        while len(received[streams]) < count and time.monotonic() - start < 2:
+            for other in (a, b):
+                received[other] += other.poll(0.01)[0]
+
+    try:
+        assert a.send(("localhost", 6321), encode({"method": "PUT", "args": {"key": "k", "value": "v"}}))
+        poll(b, 1)
+        assert [addr for _, addr in received[b]] == [("localhost", 6320)]
+        for address in (("127.0.0.1", 6320), ("localhost", 6320)):
+            assert b.send(address, encode({"method": "ACK", "args": "v"}))
+        poll(a, 2)
+        assert [addr for _, addr in received[a]] == [("localhost", 6321)] * 2
+        assert len(a.connections) == len(b.connections) == 1
+        assert len(a.selector.get_map()) == len(b.selector.get_map()) == 2  # listener and one connection
+    finally:
+        a.close()
+        b.close()
+
+
+@pytest.fixture(scope="module")
+def ring():
+    nodes = []
+    for port in (6300, 6301, 6302):
+        node = DHTNode(("localhost", port), ("localhost", 6300) if nodes else None, timeout=1, replicas=2)
+        node.start()
+        nodes.append(node)
+        time.sleep(0.1)
+    start = time.monotonic()
+    while not all(node.predecessor_id is not None for node in nodes) and time.monotonic() - start < 10:
+        time.sleep(0.1)
+    time.sleep(0.5)
+    yield nodes
+    for node in nodes:
+        node.done = True
+        node.join()
+
+
+def test_large_values(ring):
+    client = DHTClient(("localhost", 6300), timeout=5)
+    blobs = {"blob-{}".format(i): os.urandom(3 * 1024 * 1024) for i in range(4)}
+    for key, blob in blobs.items():
+        assert client.put(key, blob)
+    for key, blob in blobs.items():
+        assert client.get(key) == blob
+    assert client.get_many(list(blobs)) == blobs
+    assert client.streams.sent >= 4 and client.streams.received >= 4
+    # forwarded requests and replicas went over TCP too
+    assert sum(node.metrics.counters["streamed"] for node in ring) >= 8
+    # small messages still use UDP
+    assert client.put("small", "value") and client.get("small") == "value"
+    # a client that only sent small requests accepts the connection of the node answering
+    key, blob = next(iter(blobs.items()))
+    assert DHTClient(("localhost", 6300), timeout=5).get(key) == blob
@@ -0,0 +1,82 @@
+"""Tests key TTLs and the timing wheel expiring them."""
+import time
+import pytest
+from DHTClient import DHTClient
+from DHTNode import DHTNode
+from timers import TimingWheel
+
+
+def test_timing_wheel():
+    wheel = TimingWheel(tick=1, slots=4, levels=2, now=0)  # levels span 4 and 16 ticks
+    for item, deadline in (("a", 2.5), ("b", 7), ("c", 13), ("d", 40), ("e", 9)):
+        wheel.schedule(item, deadline)
+    wheel.cancel("e")
+    wheel.schedule("b", 11)  # rescheduled: its first entry is skipped
+    assert len(wheel) == 4 and "e" not in wheel
+
+    assert wheel.advance(2) == []  # never before the deadline
+    assert wheel.advance(3) == ["a"]
+    assert wheel.next_due() == 4  # level 1 cascades
+    assert wheel.advance(10.9) == []
+    assert wheel.advance(13) == ["b", "c"]
+    assert wheel.advance(39) == []
+    assert wheel.advance(41) == ["d"]  # beyond the last level, placed again on the way
+    assert wheel.next_due() is None and len(wheel) == 0
+
+
+def stable(nodes):
+    """ Whether every node has its final neighbours, successor list and replica range."""
+    ids = sorted(node.identification for node in nodes)
+    for node in nodes:
+        i = ids.index(node.identification)
+        successors = [ids[(i + 1) % len(ids)], ids[(i + 2) % len(ids)]]
+        if node.predecessor_id != ids[i - 1] or [node_id for node_id, _ in node.successor_list] != successors \
+                or node.replica_start is None:
+            return False
+    return True
+
+
+@pytest.fixture(scope="module")
+def ring():
+    nodes = []
+    for port in (6700, 6701, 6702):
+        node = DHTNode(("localhost", port), ("localhost", 6700) if nodes else None, timeout=1, replicas=2)
+        node.start()
+        nodes.append(node)
+        time.sleep(0.1)
+    start = time.monotonic()
+    # keys written before, while the replica sets change, may have replicas on the wrong nodes
+    while not stable(nodes) and time.monotonic() - start < 15:
+        time.sleep(0.1)
+    assert stable(nodes)
+    yield nodes
+    for node in nodes:
+        node.done = True
+        node.join()
+
+
+def test_keys_expire(ring):
+    client = DHTClient(("localhost", 6700), timeout=2)
+    for i in range(20):
+        assert client.put("session-{}".format(i), i, ttl=1)
+        assert client.put("kept-{}".format(i), i)
+    assert client.put_many({"batch-{}".format(i): i for i in range(20)}, ttl=1)
+    assert client.put("rewritten", 1, ttl=1) and client.put("rewritten", 2)  # the TTL is dropped
+    assert client.get("session-0") == 0
+    for key in ["session-{}".format(i) for i in range(20)] + ["batch-{}".format(i) for i in range(20)]:
+        (owner,) = [node for node in ring if key in node.keystore]
+        # one live replica with the expiry, on the owner's successor
+        assert [node.addr for node in ring if key in node.replica_expires] == [owner.successor_addr]
+
+    time.sleep(1.5)
+    assert client.get("session-0") is None
+    assert set(client.get_many(["batch-{}".format(i) for i in range(20)]).values()) == {None}
+    assert all(client.get("kept-{}".format(i)) == i for i in range(20))
+    assert client.get("rewritten") == 2
+    for node in ring:
+        assert not any(key.startswith(("session-", "batch-")) for key in node.keystore)
+        assert not any(key.startswith(("session-", "batch-")) for key in node.replica_store)
+        assert len(node.ttl) == 0
+    stats = [client.stats(node.addr) for node in ring]
+    assert sum(s["counters"]["expired"] for s in stats) == 40
+    assert sum(s["counters"]["replicas_expired"] for s in stats) == 40
@@ -1,6 +1,6 @@
 """Tests two clients."""
 import pytest
-from utils import contains
+from utils import contains, configure, dht_hash, dht_hash_many, ring_bits
 
 
 def test_contains():
@@ -17,3 +17,37 @@ def test_contains():
     assert contains(800, 300, 300)
     assert not contains(800, 300, 700)
     assert not contains(800, 300, 400)
+
+    # a node alone in the ring owns every id
+    assert contains(500, 500, 500)
+    assert contains(500, 500, 100)
+
+
+def test_dht_hash():
+    # same ids as the original per-character FNV-1a loop
+    assert dht_hash("A") == 716
+    assert dht_hash("('localhost', 5000)") == 770
+    assert dht_hash(b"('localhost', 5000)") == 770
+    assert dht_hash_many(["A", b"A", "('localhost', 5000)"]) == [716, 716, 770]
+    assert 0 <= dht_hash("A", maximum=2**64) < 2**64
+
+
+def test_configure():
+    try:
+        configure(160, "blake2b")
+        assert ring_bits() == 160
+        ids = dht_hash_many("key-{}".format(i) for i in range(100))
+        assert len(set(ids)) == 100
+        assert all(0 <= i < 2**160 for i in ids)
+        assert dht_hash("key-7") == ids[7]
+        assert dht_hash("key-7", seed=1) != ids[7]
+
+        configure(64, "fnv")
+        assert dht_hash("A") < 2**64
+        with pytest.raises(ValueError):
+            configure(65, "fnv")
+        with pytest.raises(ValueError):
+            configure(64, "md5")
+    finally:
+        configure(10, "fnv")
+    assert dht_hash("A") == 716
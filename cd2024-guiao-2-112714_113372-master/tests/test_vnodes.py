@@ -0,0 +1,57 @@
+"""Tests virtual nodes."""
+import statistics
+import time
+import pytest
+from bench import key_distribution
+from DHTClient import DHTClient
+from DHTNode import DHTHost, vnode_count, vnode_ids
+from utils import dht_hash
+
+
+def test_vnode_ids():
+    address = ("localhost", 5000)
+    assert vnode_ids(address, 1) == [dht_hash(str(address))]
+    ids = vnode_ids(address, 8)
+    assert len(set(ids)) == 8
+    assert ids[:4] == vnode_ids(address, 4)
+
+    assert vnode_count(4) == 4
+    assert vnode_count(4, 2.5) == 10
+    assert vnode_count(4, 0.1) == 1
+
+
+def test_key_distribution():
+    before = key_distribution(5, 1, keys=5000)
+    after = key_distribution(5, 16, keys=5000)
+    assert sum(before) == sum(after) == 5000
+    assert statistics.pvariance(after) < statistics.pvariance(before)
+
+    weighted = key_distribution(2, 16, capacities=(1.0, 3.0), keys=5000)
+    assert weighted[1] > weighted[0]
+
+
+@pytest.fixture(scope="module")
+def hosts():
+    first = DHTHost(("localhost", 5400), vnodes=3, timeout=0.5)
+    first.start()
+    second = DHTHost(("localhost", 5403), ("localhost", 5400), vnodes=3, timeout=0.5)
+    second.start()
+    nodes = first.vnodes + second.vnodes
+    start = time.monotonic()
+    while any(node.predecessor_id is None for node in nodes) and time.monotonic() - start < 15:
+        time.sleep(0.2)
+    yield first, second
+    for host in (first, second):
+        host.stop()
+        host.join()
+
+
+def test_hosts(hosts):
+    first, second = hosts
+    client = DHTClient(("localhost", 5400), timeout=2)
+    items = {"vnode-{}".format(i): i for i in range(100)}
+    for key, value in items.items():
+        assert client.put(key, value)
+    assert {**first.keystore, **second.keystore} == items
+    assert first.keystore and second.keystore
+    assert len(client.refresh_ring()) == 6
@@ -0,0 +1,110 @@
+"""Tests the binary wire format."""
+import socket
+import time
+import pytest
+import codec
+from codec import Codec, CodecError
+from DHTClient import DHTClient
+from DHTNode import DHTNode
+
+
+MESSAGES = [
+    {"method": "JOIN_REQ", "args": {"addr": ("localhost", 5001), "id": 959}},
+    {"method": "JOIN_REP", "args": {"successor_id": 770, "successor_addr": ("localhost", 5000)}},
+    {"method": "SUCCESSOR", "args": {"id": 142, "from": ("localhost", 5004)}},
+    {"method": "SUCCESSOR_REP", "args": {"req_id": 142, "successor_id": 257, "successor_addr": ("localhost", 5003)}},
+    {"method": "NOTIFY", "args": {"predecessor_id": 654, "predecessor_addr": ("localhost", 5004)}},
+    {"method": "PREDECESSOR"},
+    {"method": "STABILIZE", "args": None},
+    {"method": "STABILIZE", "args": 260},
+    {"method": "PUT", "args": {"key": "A", "value": [0, 1, 2], "from": ("127.0.0.1", 40000), "msg_id": 1}},
+    {"method": "ACK", "args": ("xpto", 1.5, b"\x00\xff", {"nested": [True, False, None]}), "msg_id": 7},
+    {"method": "CUSTOM", "args": {"big": 2 ** 100, "negative": -(2 ** 70), "small": -1}},
+]
+
+
+@pytest.mark.parametrize("msg", MESSAGES)
+def test_round_trip(msg):
+    assert codec.decode(codec.encode(msg)) == msg
+    assert Codec().feed(Codec().frames(msg)[0]) == msg
+
+
+def test_compact_layout():
+    msg = MESSAGES[2]
+    body = codec.encode(msg)
+    assert body[0] & codec.COMPACT
+    assert len(body) == 1 + 8 + 2 + 1 + len("localhost")
+
+    # an id that does not fit the compact layout falls back to the generic one
+    msg = {"method": "SUCCESSOR", "args": {"id": 2 ** 80, "from": ("localhost", 5004)}}
+    assert not codec.encode(msg)[0] & codec.COMPACT
+    assert codec.decode(codec.encode(msg)) == msg
+
+
+def test_unsupported_value():
+    with pytest.raises(CodecError):
+        codec.encode({"method": "PUT", "args": {"key": "A", "value": object()}})
+
+
+@pytest.mark.parametrize("datagram", [
+    b"",
+    b"\x01\x00",
+    b"\x02\x00\x00\x00\x00\x01\x05",  # unknown version
+    b"\x01\x00\x00\x00\x00\x05\x08d",  # length mismatch
+    b"\x01\x00\x00\x00\x00\x03\x08z\x00",  # unknown tag
+    b"\x01\x00\x00\x00\x00\x06\x08d\xff\xff\xff\xff",  # huge count
+    b"\x01\x00\xff\xff\xff\xff",  # above max_message
+])
+def test_malformed(datagram):
+    with pytest.raises(CodecError):
+        Codec().feed(datagram)
+
+
+def test_chunked_transfer():
+    sender = Codec(max_datagram=1000)
+    receiver = Codec()
+    msg = {"method": "PUT", "args": {"key": "big", "value": "x" * 10000}}
+    frames = sender.frames(msg)
+    assert len(frames) > 1
+    assert all(len(frame) <= 1000 for frame in frames)
+
+    results = [receiver.feed(frame, ("localhost", 1)) for frame in reversed(frames)]
+    assert results[:-1] == [None] * (len(frames) - 1)
+    assert results[-1] == msg
+    assert receiver.transfers == {}
+
+
+def test_max_message():
+    small = Codec(max_message=100)
+    with pytest.raises(CodecError):
+        small.frames({"method": "PUT", "args": {"key": "big", "value": "x" * 200}})
+    with pytest.raises(CodecError):
+        small.feed(Codec().frames({"method": "PUT", "args": {"key": "big", "value": "x" * 200}})[0])
+
+
+def test_large_value():
+    client = DHTClient(("localhost", 5000), timeout=5)
+    value = "y" * 200000
+    assert client.put("large value", value)
+    assert client.get("large value") == value
+
+
+def test_malformed_message():
+    node = DHTNode(("localhost", 6870), timeout=1)
+    node.start()
+    time.sleep(0.2)
+    try:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        for msg in [{"method": "GET", "args": {}}, {"method": "PUT"}, {"method": "NOTIFY", "args": 5},
+                    {"method": "JOIN_REQ", "args": {"addr": None}},
+                    {"method": "BATCH", "args": {"bodies": [codec.encode({"method": "GET", "args": {}})]}}]:
+            for frame in Codec().frames(msg):
+                sock.sendto(frame, ("localhost", 6870))
+        time.sleep(0.5)
+        assert node.is_alive()
+        assert node.metrics.counters["malformed"] == 5
+        client = DHTClient(("localhost", 6870), timeout=2)
+        assert client.put("A", 1) and client.get("A") == 1
+    finally:
+        node.done = True
+        node.join()
@@ -0,0 +1,121 @@
+""" Hierarchical timing wheel, expiring the keys written with a TTL (ChordNode.ttl). """
+import math
+
+
+class TimingWheel:
+    """ Items due at a deadline, expired in O(1) amortized time instead of scanning them all.
+
+    Level 0 has `slots` slots of `tick` seconds each, level 1 `slots` slots of
+    `slots` ticks each, and so on: an item goes to the lowest level whose
+    span covers its deadline. Every time level 0 completes a revolution, the
+    next slot of level 1 is cascaded down (spread over level 0), and so on
+    up the levels, so an item is moved at most `levels` times. Deadlines
+    beyond the last level wait in its farthest slot and are placed again
+    when it cascades.
+
+    Rescheduling or cancelling an item only updates its deadline: the stale
+    entry left in its old slot is skipped when that slot comes due. Items
+    are returned by advance() at most one tick after their deadline, never
+    before it.
+
+    Usage:
+        wheel = TimingWheel(tick=0.1)
+        wheel.schedule("key", time.time() + 30)
+        expired = wheel.advance(time.time())
+    """
+
+    def __init__(self, tick=0.1, slots=64, levels=4, now=0):
+        """Constructor
+
+        Parameters:
+            tick: seconds per level 0 slot, the precision of the expiry
+            slots: slots per level
+            levels: number of levels, deadlines up to tick * slots ** levels seconds ahead are placed directly
+            now: time the wheel starts at (any clock, as long as advance() is given the same one)
+        """
+        self.tick = tick
+        self.slots = slots
+        self.levels = levels
+        self.wheels = [[[] for _ in range(slots)] for _ in range(levels)]  # level -> slot -> [(item, deadline)]
+        self.deadlines = {}  # item -> deadline
+        self.current = int(now // tick)  # next tick to process
+        self.stale = False  # slots may hold entries of cancelled items
+        self.cascades = 0
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def __contains__(self, item):
+        return item in self.deadlines
+
+    def deadline(self, item):
+        """ Deadline of item, None if it is not scheduled."""
+        return self.deadlines.get(item)
+
+    def schedule(self, item, deadline):
+        """ (Re)schedule item to be returned by advance() once deadline passed."""
+        self.deadlines[item] = deadline
+        self._place(item, deadline)
+
+    def cancel(self, item):
+        if self.deadlines.pop(item, None) is not None:
+            self.stale = True
+
+    def _place(self, item, deadline):
+        due = max(math.ceil(deadline / self.tick), self.current)
+        # beyond the last level: the farthest slot, placed again when it cascades
+        due = min(due, self.current + self.slots ** self.levels - 1)
+        delta = due - self.current
+        level = 0
+        while delta >= self.slots ** (level + 1):
+            level += 1
+        self.wheels[level][(due // self.slots ** level) % self.slots].append((item, deadline))
+        self.stale = True
+
+    def _cascade(self, level):
+        """ Spread the slot of level that starts now over the levels below it."""
+        slot = (self.current // self.slots ** level) % self.slots
+        entries, self.wheels[level][slot] = self.wheels[level][slot], []
+        self.cascades += 1
+        for item, deadline in entries:
+            if self.deadlines.get(item) == deadline:
+                self._place(item, deadline)
+
+    def advance(self, now):
+        """ Move the wheel to time now; returns the items whose deadline passed."""
+        expired = []
+        last = int(now // self.tick)
+        if not self.deadlines:
+            # nothing to expire: skip the idle ticks, dropping the entries of cancelled items
+            if self.stale:
+                self.wheels = [[[] for _ in range(self.slots)] for _ in range(self.levels)]
+                self.stale = False
+            self.current = max(self.current, last + 1)
+            return expired
+        while self.current <= last and self.deadlines:
+            if self.current % self.slots == 0:
+                # higher levels first: their items may land in the slots of the level below
+                level = 1
+                while level < self.levels - 1 and self.current % self.slots ** (level + 1) == 0:
+                    level += 1
+                for cascaded in range(level, 0, -1):
+                    self._cascade(cascaded)
+            slot = self.current % self.slots
+            entries, self.wheels[0][slot] = self.wheels[0][slot], []
+            for item, deadline in entries:
+                if self.deadlines.get(item) == deadline:
+                    del self.deadlines[item]
+                    expired.append(item)
+            self.current += 1
+        return expired
+
+    def next_due(self):
+        """ Time advance() may have items to return at, None if nothing is scheduled."""
+        if not self.deadlines:
+            return None
+        # the start of the next revolution of level 0 (maybe the current tick), when higher levels cascade
+        boundary = -(-self.current // self.slots) * self.slots
+        for due in range(self.current, boundary):
+            if self.wheels[0][due % self.slots]:
+                return due * self.tick
+        return boundary * self.tick
@@ -1,16 +1,110 @@
-def dht_hash(text, seed=0, maximum=2**10):
-    """ FNV-1a Hash Function. """
-    fnv_prime = 16777619
-    offset_basis = 2166136261
-    h = offset_basis + seed
-    for char in text:
-        h = h ^ ord(char)
-        h = h * fnv_prime
+import hashlib
+
+# Identifier space of the ring: ids are in [0, 2**RING_BITS). Every node and
+# client of a DHT must use the same configuration (see configure).
+RING_BITS = 10
+HASH = "fnv"
+# Where keys go: "hash" spreads them over the ring with dht_hash, "order" keeps
+# them in key order (ids are the leading bits of the key) so ranges can be scanned
+PLACEMENT = "hash"
+PLACEMENTS = ("hash", "order")
+
+FNV32 = (16777619, 2166136261)
+FNV64 = (1099511628211, 14695981039346656037)
+
+
+def configure(bits=None, algorithm=None, placement=None):
+    """ Set the ring size (2**bits ids), hash function ("fnv" or "blake2b") used by dht_hash and key placement
+    ("hash" or "order", see key_id). """
+    global RING_BITS, HASH, PLACEMENT
+    bits = RING_BITS if bits is None else bits
+    algorithm = HASH if algorithm is None else algorithm
+    placement = PLACEMENT if placement is None else placement
+    if algorithm not in HASHES:
+        raise ValueError("unknown hash function: {}".format(algorithm))
+    if not 1 <= bits <= 512 or (algorithm == "fnv" and bits > 64):
+        raise ValueError("{} cannot produce {} bit ids".format(algorithm, bits))
+    if placement not in PLACEMENTS:
+        raise ValueError("unknown key placement: {}".format(placement))
+    RING_BITS, HASH, PLACEMENT = bits, algorithm, placement
+
+
+def ring_bits():
+    """ Number of bits of the ring identifiers. """
+    return RING_BITS
+
+
+def hash_algorithm():
+    """ Hash function of dht_hash: "fnv" or "blake2b". """
+    return HASH
+
+
+def placement():
+    """ Key placement: "hash" or "order" (see key_id). """
+    return PLACEMENT
+
+
+def _fnv(data, seed, maximum):
+    """ FNV-1a over bytes, 32 bit for rings up to 2**32 ids (same ids as the original per-character loop on
+    ASCII text) and 64 bit above. """
+    prime, h = FNV32 if maximum <= 2**32 else FNV64
+    mask = 0xFFFFFFFF if maximum <= 2**32 else 0xFFFFFFFFFFFFFFFF
+    h = (h + seed) & mask
+    for byte in data:
+        h = ((h ^ byte) * prime) & mask
     return h % maximum
 
 
+def _blake2b(data, seed, maximum):
+    digest = hashlib.blake2b(data, digest_size=min(64, (maximum.bit_length() + 7) // 8),
+                             key=seed.to_bytes(8, "big") if seed else b"").digest()
+    return int.from_bytes(digest, "big") % maximum
+
+
+HASHES = {"fnv": _fnv, "blake2b": _blake2b}
+
+
+def dht_hash(text, seed=0, maximum=None):
+    """ Ring id of text (str or bytes), using the configured hash function and ring size. """
+    if isinstance(text, str):
+        text = text.encode("utf-8")
+    return HASHES[HASH](text, seed, 2**RING_BITS if maximum is None else maximum)
+
+
+def dht_hash_many(texts, seed=0, maximum=None):
+    """ Ring ids of many keys, looking the configuration up once (for batch operations). """
+    hash_function = HASHES[HASH]
+    maximum = 2**RING_BITS if maximum is None else maximum
+    return [hash_function(text.encode("utf-8") if isinstance(text, str) else text, seed, maximum)
+            for text in texts]
+
+
+def _ordered(data, maximum):
+    """ Id made of the leading bits of data, so that data1 <= data2 implies id1 <= id2. """
+    size = (maximum.bit_length() - 1 + 7) // 8
+    return int.from_bytes(data[:size].ljust(size, b"\0"), "big") >> (8 * size - maximum.bit_length() + 1)
+
+
+def key_id(key):
+    """ Ring id a key is stored at: dht_hash(key), or with "order" placement an id preserving the key order
+    (byte-wise, i.e. code point order for str keys). Node ids always use dht_hash. """
+    if PLACEMENT == "order":
+        return _ordered(key.encode("utf-8") if isinstance(key, str) else key, 2**RING_BITS)
+    return dht_hash(key)
+
+
+def key_ids(keys):
+    """ Ring ids of many keys (see key_id). """
+    if PLACEMENT == "order":
+        maximum = 2**RING_BITS
+        return [_ordered(key.encode("utf-8") if isinstance(key, str) else key, maximum) for key in keys]
+    return dht_hash_many(keys)
+
+
 def contains(begin, end, node):
-    """Check node is contained between begin and end in a ring."""
+    """Check node is contained between begin and end in a ring: (begin, end], the whole ring if begin == end."""
+    if begin == end:  # a node alone in the ring (its own predecessor or successor) owns every id
+        return True
     if begin < end:
         if begin < node and node <= end:
             return True
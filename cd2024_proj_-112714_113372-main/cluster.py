@@ -0,0 +1,210 @@
+import argparse
+import json
+import logging
+import random
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+from pathlib import Path
+
+from sudoku_solver import solve_sudoku
+
+NODE_SCRIPT = str(Path(__file__).with_name('node.py'))
+
+
+def free_ports(count):
+    """Reserve `count` ephemeral ports that are free for both TCP (HTTP) and UDP (P2P)."""
+    ports = []
+    held = []
+    while len(ports) < count:
+        tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        tcp.bind(('localhost', 0))
+        port = tcp.getsockname()[1]
+        udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            udp.bind(('0.0.0.0', port))
+        except OSError:
+            tcp.close()
+            udp.close()
+            continue
+        held += [tcp, udp]
+        ports.append(port)
+    for s in held:
+        s.close()
+    return ports
+
+
+def make_puzzle(rng, empty_boxes):
+    """Generate a puzzle deterministically from rng (same idea as gen.py, without its rate limiter)."""
+    board = [[0] * 9 for _ in range(9)]
+    for n in range(0, 9, 3):
+        nums = rng.sample(range(1, 10), 9)
+        for i in range(3):
+            for j in range(3):
+                board[n + i][n + j] = nums.pop()
+    board = solve_sudoku(board)
+    cells = rng.sample([(i, j) for i in range(9) for j in range(9)], empty_boxes)
+    for row, col in cells:
+        board[row][col] = 0
+    return board
+
+
+def http_get(port, path, timeout=2):
+    with urllib.request.urlopen(f'http://localhost:{port}{path}', timeout=timeout) as response:
+        return json.loads(response.read().decode('utf-8'))
+
+
+def http_solve(port, sudoku, timeout):
+    data = json.dumps({'sudoku': sudoku}).encode('utf-8')
+    request = urllib.request.Request(f'http://localhost:{port}/solve', data=data,
+                                     headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return response.read()
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    k = min(len(values) - 1, max(0, round(p / 100 * (len(values) - 1))))
+    return values[k]
+
+
+class Cluster:
+    """Runs N node.py processes on ephemeral ports, node 0 being the anchor."""
+
+    def __init__(self, nodes, handicaps=(0,), latency=0, seed=0, log_level='WARNING'):
+        self.size = nodes
+        self.handicaps = [handicaps[i % len(handicaps)] for i in range(nodes)]
+        self.latency = latency
+        self.seed = seed
+        self.log_level = log_level
+        self.ports = []
+        self.procs = []
+
+    @property
+    def anchor(self):
+        return self.ports[0]
+
+    def start(self):
+        ports = free_ports(2 * self.size)
+        self.ports = list(zip(ports[::2], ports[1::2]))  # (http_port, p2p_port)
+        anchor_p2p = self.ports[0][1]
+        for i, (http_port, p2p_port) in enumerate(self.ports):
+            cmd = [sys.executable, NODE_SCRIPT, '-p', str(http_port), '-s', str(p2p_port),
+                   '-h', str(self.handicaps[i]), '--latency', str(self.latency),
+                   '--seed', str(self.seed + i), '--log-level', self.log_level]
+            if i > 0:
+                cmd += ['-a', f'localhost:{anchor_p2p}']
+            self.procs.append(subprocess.Popen(cmd))
+            # Joins are plain UDP datagrams; give the anchor time to bind before the others talk to it
+            time.sleep(0.2 if i == 0 else 0.05)
+        logging.info("Started %d nodes: %s", self.size, self.ports)
+
+    def wait_converged(self, timeout=30):
+        """Wait until the anchor sees every other node as a peer; returns the time it took."""
+        start = time.perf_counter()
+        while time.perf_counter() - start < timeout:
+            try:
+                if len(http_get(self.anchor[0], '/network')) >= self.size - 1:
+                    return time.perf_counter() - start
+            except OSError:
+                pass
+            time.sleep(0.1)
+        raise TimeoutError(f"membership did not converge in {timeout}s")
+
+    def run_workload(self, puzzles, empty_boxes, timeout):
+        """Solve the puzzles through the anchor, one at a time.
+
+        A node coordinates a single puzzle at a time (its HTTP server is not
+        threaded and the puzzle state is per node), so the puzzles are sent
+        one after the other: throughput is 1 / mean latency.
+        """
+        rng = random.Random(self.seed)
+        workload = [make_puzzle(rng, empty_boxes) for _ in range(puzzles)]
+        latencies = []
+        failures = 0
+        start = time.perf_counter()
+        for sudoku in workload:
+            t0 = time.perf_counter()
+            try:
+                http_solve(self.anchor[0], sudoku, timeout)
+                latencies.append(time.perf_counter() - t0)
+            except OSError as e:
+                failures += 1
+                logging.warning("Puzzle failed: %s", e)
+        elapsed = time.perf_counter() - start
+        return {
+            'puzzles': puzzles,
+            'solved': len(latencies),
+            'failed': failures,
+            'elapsed_s': elapsed,
+            'throughput_per_s': len(latencies) / elapsed if elapsed else 0,
+            'latency_s': {
+                'mean': statistics.mean(latencies) if latencies else None,
+                'p50': percentile(latencies, 50),
+                'p95': percentile(latencies, 95),
+                'p99': percentile(latencies, 99),
+                'max': max(latencies) if latencies else None,
+            },
+        }
+
+    def stop(self):
+        for proc in self.procs:
+            if proc.poll() is None:
+                proc.send_signal(signal.SIGINT)
+        for proc in self.procs:
+            try:
+                proc.wait(timeout=3)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+        self.procs = []
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Launch a local Sudoku node cluster and load test it')
+    parser.add_argument('-n', '--nodes', type=int, default=4)
+    parser.add_argument('--handicap', type=str, default='0', help='Comma separated handicaps (ms), cycled over the nodes')
+    parser.add_argument('--latency', type=float, default=0, help='Delay in ms added to each P2P message')
+    parser.add_argument('--puzzles', type=int, default=10)
+    parser.add_argument('--empty', type=int, default=40, help='Empty cells per puzzle')
+    parser.add_argument('--timeout', type=float, default=60, help='Timeout per puzzle in seconds')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=str, default=None, help='Write the JSON report to this file')
+    parser.add_argument('--node-log-level', type=str, default='WARNING')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    handicaps = [float(h) for h in args.handicap.split(',')]
+    cluster = Cluster(args.nodes, handicaps, args.latency, args.seed, args.node_log_level)
+    try:
+        cluster.start()
+        convergence = cluster.wait_converged()
+        logging.info("Membership converged in %.2fs", convergence)
+        report = {
+            'nodes': args.nodes,
+            'handicaps': cluster.handicaps,
+            'latency_ms': args.latency,
+            'seed': args.seed,
+            'empty_cells': args.empty,
+            'convergence_s': convergence,
+        }
+        report.update(cluster.run_workload(args.puzzles, args.empty, args.timeout))
+        report['stats'] = http_get(cluster.anchor[0], '/stats')
+    finally:
+        cluster.stop()
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,17 +2,22 @@ import argparse
 import threading
 import logging
 import json
+import random
 import socket
 from http.server import HTTPServer, BaseHTTPRequestHandler
 import time
+from profiling import Profiler
 
 class Node:
-    def __init__(self, http_port, p2p_port, address=None, handicap=0):
+    def __init__(self, http_port, p2p_port, address=None, handicap=0, profiler=None, loss=0, latency=0, seed=None):
         self.http_port = http_port
         self.p2p_port = p2p_port
         self.address = address
         self.my_id = f'localhost:{self.p2p_port}'
         self.handicap = handicap
+        self.loss = loss  # probability of dropping an outgoing message (fault injection)
+        self.latency = latency  # delay in ms added to every outgoing message (fault injection)
+        self.rng = random.Random(seed)
         self.doneFlag = False
         self.peers = []
         self.tasks = {}
@@ -24,6 +29,7 @@ class Node:
         self.peers_lock = threading.Lock()
         self.expected_results = 0
         self.sudoku = None
+        self.profiler = profiler or Profiler()
 
     def get_network_info(self):
         network_info = {}
@@ -54,6 +60,10 @@ class Node:
             self.send_message(peer, {'type': 'TASK', 'task_id': idx, 'cell': cell, 'sudoku': sudoku})
 
     def solve_sudoku(self, sudoku):
+        with self.profiler.section('solve_sudoku'):
+            return self._solve_sudoku(sudoku)
+
+    def _solve_sudoku(self, sudoku):
         def solve(board):
             find = self.find_empty(board)
             if not find:
@@ -79,6 +89,10 @@ class Node:
             return None
 
     def solve_sudoku_cell(self, sudoku, cell):
+        with self.profiler.section('solve_sudoku_cell'):
+            return self._solve_sudoku_cell(sudoku, cell)
+
+    def _solve_sudoku_cell(self, sudoku, cell):
         row, col = cell
         possible_numbers = []
         for num in range(1, 10):
@@ -154,7 +168,8 @@ class Node:
             logging.info(f'Starting P2P server on port {self.p2p_port}')
             while True:
                 data, addr = self.sock.recvfrom(1024)
-                message = json.loads(data.decode('utf-8'))
+                with self.profiler.section('deserialize'):
+                    message = json.loads(data.decode('utf-8'))
                 threading.Thread(target=self.handle_message, args=(message, addr)).start()
         except KeyboardInterrupt:
             logging.info("P2P server shutting down...")
@@ -168,7 +183,12 @@ class Node:
         logging.info(f"Sent JOIN message to {address}")
 
     def handle_message(self, message, addr):
-        logging.info(f"Received message from {addr}: {message}")
+        with self.profiler.section('handle_message'):
+            self._handle_message(message, addr)
+
+    def _handle_message(self, message, addr):
+        # Message bodies carry the full grid; keep formatting lazy so it costs nothing unless DEBUG is on
+        logging.debug("Received message from %s: %s", addr, message)
 
         if message['type'] == 'JOIN':
             with self.peers_lock:
@@ -229,8 +249,16 @@ class Node:
             peer_address, peer_port = peer
         else:
             peer_address, peer_port = peer.split(':')
-        self.sock.sendto(json.dumps(message).encode('utf-8'), (peer_address, int(peer_port)))
-        logging.info(f"Sent message to {peer_address}:{peer_port}: {message}")
+        with self.profiler.section('serialize'):
+            data = json.dumps(message).encode('utf-8')
+        if self.loss and self.rng.random() < self.loss:
+            logging.debug("Dropped message to %s:%s: %s", peer_address, peer_port, message)
+            return
+        if self.latency:
+            threading.Timer(self.latency / 1000, self.sock.sendto, args=(data, (peer_address, int(peer_port)))).start()
+        else:
+            self.sock.sendto(data, (peer_address, int(peer_port)))
+        logging.debug("Sent message to %s:%s: %s", peer_address, peer_port, message)
 
     def run(self):
         logging.info(f"Node {self.my_id} started")
@@ -240,7 +268,8 @@ class Node:
             try:
                 payload, address = self.recv()
                 if payload:
-                    message = json.loads(payload)
+                    with self.profiler.section('deserialize'):
+                        message = json.loads(payload)
                     self.handle_message(message, address)
             except KeyboardInterrupt:
                 self.done()
@@ -324,12 +353,27 @@ if __name__ == "__main__":
     parser.add_argument('-s', '--p2p_port', type=int, required=True, help='P2P port')
     parser.add_argument('-a', '--address', type=str, required=False, help='Anchor node address (host:port)')
     parser.add_argument('-h', '--handicap', type=float, required=False, default=0, help='Handicap (delay in ms) for validation')
+    parser.add_argument('--profile', action='store_true', help='Time message handling, solving and serialization')
+    parser.add_argument('--profile-out', type=str, default=None, help='Output prefix for profile files (default: profile-<p2p_port>)')
+    parser.add_argument('--profile-interval', type=float, default=5, help='Stack sampling interval in ms (0 disables sampling)')
+    parser.add_argument('--profile-cprofile', action='store_true', help='Also run cProfile on the main node thread')
+    parser.add_argument('--loss', type=float, default=0, help='Probability of dropping each outgoing message')
+    parser.add_argument('--latency', type=float, default=0, help='Delay in ms added to each outgoing message')
+    parser.add_argument('--seed', type=int, default=None, help='Seed for the fault injection RNG')
+    parser.add_argument('--log-level', type=str, default='INFO', help='Logging level (DEBUG logs full message bodies)')
     args = parser.parse_args()
 
-    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    logging.basicConfig(level=args.log_level.upper(), format='%(asctime)s - %(levelname)s - %(message)s')
 
-    node = Node(args.http_port, args.p2p_port, args.address, args.handicap)
+    profiler = Profiler(args.profile, args.profile_interval / 1000, args.profile_cprofile)
+    node = Node(args.http_port, args.p2p_port, args.address, args.handicap, profiler,
+                args.loss, args.latency, args.seed)
     http_thread = threading.Thread(target=run_http_server, args=(node, args.http_port))
     http_thread.daemon = True
     http_thread.start()
-    node.run()
\ No newline at end of file
+    profiler.start()
+    try:
+        node.run()
+    finally:
+        profiler.stop()
+        profiler.dump(args.profile_out or f'profile-{args.p2p_port}')
\ No newline at end of file
@@ -0,0 +1,122 @@
+import cProfile
+import logging
+import pstats
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+class _NullSection:
+    """Shared no-op context manager used when profiling is disabled."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SECTION = _NullSection()
+
+
+class Profiler:
+    """Low-overhead timers for the node hot path.
+
+    When disabled every call returns a shared no-op object, so the instrumented
+    code pays a single attribute lookup. When enabled it accumulates
+    count/total/max per section with time.perf_counter and, optionally, samples
+    the stacks of all threads to produce collapsed-stack output (one
+    "frame;frame;frame count" line per stack) for flamegraph.pl/speedscope.
+    """
+
+    def __init__(self, enabled=False, sample_interval=0.005, use_cprofile=False):
+        self.enabled = enabled
+        self.sample_interval = sample_interval
+        self.use_cprofile = use_cprofile
+        self.timings = defaultdict(lambda: [0, 0.0, 0.0])  # name -> [count, total, max]
+        self.stacks = defaultdict(int)
+        self.lock = threading.Lock()
+        self.cprofile = None
+        self._sampler = None
+        self._stop = threading.Event()
+
+    def section(self, name):
+        """Time a block: `with profiler.section("solve"): ...`."""
+        if not self.enabled:
+            return _NULL_SECTION
+        return self._timed(name)
+
+    @contextmanager
+    def _timed(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                entry = self.timings[name]
+                entry[0] += 1
+                entry[1] += elapsed
+                if elapsed > entry[2]:
+                    entry[2] = elapsed
+
+    def start(self):
+        if not self.enabled:
+            return
+        if self.use_cprofile:
+            # cProfile only follows the thread that enabled it; run_p2p_server
+            # hands messages to worker threads, so prefer the stack sampler there.
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+        if self.sample_interval:
+            self._sampler = threading.Thread(target=self._sample, daemon=True)
+            self._sampler.start()
+
+    def stop(self):
+        if not self.enabled:
+            return
+        self._stop.set()
+        if self._sampler is not None:
+            self._sampler.join()
+        if self.cprofile is not None:
+            self.cprofile.disable()
+
+    def _sample(self):
+        me = threading.get_ident()
+        while not self._stop.wait(self.sample_interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                with self.lock:
+                    self.stacks[";".join(reversed(stack))] += 1
+
+    def summary(self):
+        with self.lock:
+            return {
+                name: {'count': count, 'total_ms': total * 1000, 'avg_us': total / count * 1e6, 'max_ms': peak * 1000}
+                for name, (count, total, peak) in self.timings.items()
+            }
+
+    def dump(self, prefix):
+        """Write <prefix>.folded (collapsed stacks), <prefix>.timings and <prefix>.pstats."""
+        if not self.enabled:
+            return
+        with self.lock:
+            stacks = sorted(self.stacks.items())
+        with open(f"{prefix}.folded", 'w') as f:
+            for stack, count in stacks:
+                f.write(f"{stack} {count}\n")
+        with open(f"{prefix}.timings", 'w') as f:
+            for name, stat in sorted(self.summary().items()):
+                f.write(f"{name} count={stat['count']} total_ms={stat['total_ms']:.3f} "
+                        f"avg_us={stat['avg_us']:.1f} max_ms={stat['max_ms']:.3f}\n")
+        if self.cprofile is not None:
+            pstats.Stats(self.cprofile).dump_stats(f"{prefix}.pstats")
+        logging.info("Profile written to %s.folded / %s.timings", prefix, prefix)